@@ -0,0 +1,316 @@
+"""
+Benchmark suite: synthetic episodes at several sizes through merge, dataset
+loading, training, BCPolicy inference and both exporters. Results go to JSON and
+are compared metric by metric against a stored baseline.
+
+    python -m benchmarks.run                          # sizes from config `benchmarks.episodes`
+    python -m benchmarks.run --episodes 300 10000 --only merge load train
+    python -m benchmarks.run --save_baseline          # record this machine's numbers
+    python -m benchmarks.run --check                  # exit 1 on regressions
+
+Metric names ending in _s / _ms are lower-is-better, _per_s higher-is-better;
+anything else (rows, sizes) is reported but not compared.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+import yaml
+
+from benchmarks.synth import generate
+from episode_store import load_store, update_store
+from paddy_sim import SimParams, rollout
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CASES = ["generate", "merge", "load", "train", "policy", "export_table", "export_grid"]
+BENCH_DEFAULTS = {
+    "episodes": [300, 1000],
+    "seed": 0,
+    "workdir": "cache/bench",
+    "out": "reports/bench.json",
+    "baseline": "benchmarks/baseline.json",
+    "n_estimators": 50,          # training cost grows with rows; keep the forest small
+    "act_calls": 2000,
+    "batch_sizes": [256, 4096],
+    "tolerance": 0.25,           # flag metrics more than 25% worse than baseline
+    "min_seconds": 0.05,         # _s metrics below this in both runs are timer noise
+}
+
+
+def read_config(path: str) -> Dict[str, Any]:
+    with open(path, "r", encoding="utf-8") as f:
+        return yaml.safe_load(f)
+
+
+def timed(fn, *args, **kwargs):
+    t0 = time.perf_counter()
+    out = fn(*args, **kwargs)
+    return out, time.perf_counter() - t0
+
+
+def best_time(fn, *args, repeats: int = 5, min_total: float = 0.2, **kwargs) -> float:
+    """Fastest of at least `repeats` calls, repeating until `min_total` seconds were spent (short cases are noisy)."""
+    times: List[float] = []
+    while (len(times) < repeats or sum(times) < min_total) and len(times) < 1000:
+        times.append(timed(fn, *args, **kwargs)[1])
+    return min(times)
+
+
+# ----------------- Cases -----------------
+
+def bench_merge(files: List[str], store: str) -> Dict[str, float]:
+    shutil.rmtree(store, ignore_errors=True)
+    _, cold = timed(update_store, store, {"rule": files})
+    _, warm = timed(update_store, store, {"rule": files})     # nothing changed: stat checks only
+    df, load = timed(load_store, store)
+    return {"cold_s": cold, "warm_s": warm, "load_store_s": load, "rows": len(df),
+            "rows_per_s": len(df) / max(cold, 1e-9)}
+
+
+def bench_load(files: List[str], cfg: Dict[str, Any], workdir: str) -> Dict[str, float]:
+    from train_bc import load_dataset
+    (X, _), csv_s = timed(load_dataset, files, {**cfg, "feature_cache": ""})
+    out = {"csv_s": csv_s, "rows": len(X), "csv_rows_per_s": len(X) / max(csv_s, 1e-9)}
+    if os.path.isdir(cfg["data_glob"]):
+        _, out["store_s"] = timed(load_dataset, [cfg["data_glob"]], {**cfg, "feature_cache": ""})
+    cache = os.path.join(workdir, "features")
+    shutil.rmtree(cache, ignore_errors=True)
+    _, out["cache_miss_s"] = timed(load_dataset, files, {**cfg, "feature_cache": cache})
+    _, out["cache_hit_s"] = timed(load_dataset, files, {**cfg, "feature_cache": cache})
+    return out
+
+
+def bench_train(cfg: Dict[str, Any]) -> Dict[str, float]:
+    from train_bc import train
+    arts, total = timed(train, {**cfg, "feature_cache": ""})
+    return {"total_s": total, "fit_s": arts.fit_s, "predict_rows_per_s": arts.predict_rows_per_s,
+            "rows": arts.n_rows, "val_mae_mean": float(np.mean(list(arts.val_mae.values())))}
+
+
+def bench_policy(cfg: Dict[str, Any], files: List[str], calls: int, batch_sizes: List[int],
+                 seed: int) -> Dict[str, float]:
+    from policy import BCPolicy
+    from train_bc import load_dataset
+    X, _ = load_dataset(files[:200], {**cfg, "feature_cache": ""})
+    rng = np.random.default_rng(seed)
+    sample = X.to_numpy(dtype=float)[rng.integers(0, len(X), size=max(calls, max(batch_sizes)))]
+    feats = list(X.columns)
+    obs = [dict(zip(feats, row)) for row in sample[:calls]]
+    out: Dict[str, float] = {}
+    for engine in ("sklearn", "compiled"):
+        pol, out[f"{engine}_load_s"] = timed(BCPolicy, cfg["bc_model_path"], cfg["meta_file"], engine=engine)
+        pol.act(obs[0])                             # warm-up
+        lat = np.empty(len(obs))
+        for i, o in enumerate(obs):
+            t0 = time.perf_counter()
+            pol.act(o)
+            lat[i] = time.perf_counter() - t0
+        out[f"{engine}_act_p50_ms"] = float(np.percentile(lat, 50) * 1e3)
+        out[f"{engine}_act_p99_ms"] = float(np.percentile(lat, 99) * 1e3)
+        for b in batch_sizes:
+            out[f"{engine}_batch{b}_rows_per_s"] = b / max(best_time(pol.act_batch, sample[:b]), 1e-9)
+    return out
+
+
+def _run_script(args: List[str]) -> float:
+    env = dict(os.environ, PADDY_PROFILE="1")
+    t0 = time.perf_counter()
+    subprocess.run([sys.executable] + args, cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - t0
+
+
+def _profile_stages(path: str) -> Dict[str, float]:
+    with open(path, "r", encoding="utf-8") as f:
+        spans = json.load(f)["spans"]
+    return {f"{name.replace('/', '.')}_s": st["wall_s"] for name, st in spans.items()}
+
+
+def bench_export_table(cfg_path: str, cfg: Dict[str, Any]) -> Dict[str, float]:
+    # --no_cache: time a full export, not a cache hit
+    total = _run_script(["export_policy_table.py", "-c", cfg_path, "--no_cache"])
+    return {"total_s": total,
+            **_profile_stages(os.path.splitext(cfg["policy_table_csv"])[0] + ".profile.json")}
+
+
+def bench_export_grid(cfg: Dict[str, Any], workdir: str) -> Dict[str, float]:
+    out_csv = os.path.join(workdir, "policy_grid.csv")
+    total = _run_script(["export_policy_grid.py", "--model", cfg["bc_model_path"],
+                         "--meta", cfg["meta_file"], "--out", out_csv, "--no_cache"])
+    return {"total_s": total, **_profile_stages(os.path.splitext(out_csv)[0] + ".profile.json")}
+
+
+# ----------------- Suite -----------------
+
+def bench_config(cfg: Dict[str, Any], workdir: str, n_estimators: int) -> Dict[str, Any]:
+    """Project config with every output redirected into `workdir`."""
+    return {
+        **cfg,
+        "data_glob": os.path.join(workdir, "episodes"),
+        "bc_model_path": os.path.join(workdir, "models", "bc_model.joblib"),
+        "meta_file": os.path.join(workdir, "models", "bc_meta.json"),
+        "policy_table_csv": os.path.join(workdir, "models", "policy_table.csv"),
+        "policy_table_bin": os.path.join(workdir, "models", "policy_table.bin"),
+        "feature_cache": "",
+        "model": {**cfg["model"], "n_estimators": int(n_estimators)},
+    }
+
+
+def run_size(n: int, cfg: Dict[str, Any], bcfg: Dict[str, Any], only: List[str]) -> Dict[str, Dict[str, float]]:
+    seed = int(bcfg["seed"])
+    workdir = os.path.abspath(os.path.join(bcfg["workdir"], f"n{n}"))
+    params = SimParams.from_config(cfg)
+    res: Dict[str, Dict[str, float]] = {}
+
+    # CSVs are written once per (n, seed, sim params) and reused; the case times the simulation itself
+    files = generate(n, os.path.join(bcfg["workdir"], f"synth_{n}_s{seed}"), params, seed)
+    if "generate" in only:
+        sim_s = best_time(rollout, params, n, "rule", seed, repeats=3, min_total=1.0)
+        rows = n * params.n_ticks
+        res["generate"] = {"sim_s": sim_s, "rows": rows, "rows_per_s": rows / max(sim_s, 1e-9)}
+    bcfg_n = bench_config(cfg, workdir, bcfg["n_estimators"])
+    os.makedirs(os.path.dirname(bcfg_n["bc_model_path"]), exist_ok=True)
+    cfg_path = os.path.join(workdir, "config.yaml")
+    with open(cfg_path, "w", encoding="utf-8") as f:
+        yaml.safe_dump(bcfg_n, f, sort_keys=False)
+
+    steps = [
+        ("merge", lambda: bench_merge(files, bcfg_n["data_glob"])),
+        ("load", lambda: bench_load(files, bcfg_n, workdir)),
+        ("train", lambda: bench_train(bcfg_n)),
+        ("policy", lambda: bench_policy(bcfg_n, files, int(bcfg["act_calls"]),
+                                        [int(b) for b in bcfg["batch_sizes"]], seed)),
+        ("export_table", lambda: bench_export_table(cfg_path, bcfg_n)),
+        ("export_grid", lambda: bench_export_grid(bcfg_n, workdir)),
+    ]
+    for name, fn in steps:
+        if name not in only:
+            continue
+        if name in ("train", "policy", "export_table", "export_grid") and \
+                not os.path.isdir(bcfg_n["data_glob"]):
+            update_store(bcfg_n["data_glob"], {"rule": files})      # merge was skipped
+        if name in ("policy", "export_table", "export_grid") and \
+                not os.path.isfile(bcfg_n["meta_file"]):
+            bench_train(bcfg_n)                                      # train was skipped
+        print(f"[info] n={n:,}: {name} ...", flush=True)
+        res[name] = fn()
+    return res
+
+
+def environment() -> Dict[str, Any]:
+    import pandas as pd
+    import sklearn
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"started": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": commit,
+            "python": platform.python_version(), "platform": platform.platform(),
+            "cpu_count": os.cpu_count(), "numpy": np.__version__, "pandas": pd.__version__,
+            "sklearn": sklearn.__version__}
+
+
+# ----------------- Baseline comparison -----------------
+
+def direction(metric: str) -> int:
+    """-1 lower is better, +1 higher is better, 0 not compared."""
+    if metric.endswith("_per_s"):
+        return 1
+    if metric.endswith(("_s", "_ms")):
+        return -1
+    return 0
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], tolerance: float,
+            min_seconds: float) -> List[Dict[str, Any]]:
+    """One row per metric present in both runs; `ratio` > 1 means slower/worse."""
+    rows = []
+    for size, cases in current["results"].items():
+        for case, metrics in cases.items():
+            base = baseline.get("results", {}).get(size, {}).get(case, {})
+            for metric, cur in metrics.items():
+                d = direction(metric)
+                old = base.get(metric)
+                if not d or old is None:
+                    continue
+                if metric.endswith("_s") and not metric.endswith("_per_s") and max(cur, old) < min_seconds:
+                    continue
+                ratio = (cur / old if d < 0 else old / cur) if min(cur, old) > 0 else float("nan")
+                status = "regression" if ratio > 1 + tolerance else \
+                    "improved" if ratio < 1 / (1 + tolerance) else "ok"
+                rows.append({"size": size, "case": case, "metric": metric, "baseline": old,
+                             "current": cur, "ratio": ratio, "status": status})
+    return rows
+
+
+def main():
+    ap = argparse.ArgumentParser("Benchmark merge / load / train / inference / export on synthetic episodes.")
+    ap.add_argument("--config", "-c", default="config.yaml")
+    ap.add_argument("--episodes", "-n", nargs="*", type=int, default=None,
+                    help="Episode counts (default: benchmarks.episodes).")
+    ap.add_argument("--only", nargs="*", choices=CASES, default=None, help="Run only these cases.")
+    ap.add_argument("--out", default=None, help="Results JSON (default: benchmarks.out).")
+    ap.add_argument("--baseline", default=None, help="Baseline JSON (default: benchmarks.baseline).")
+    ap.add_argument("--save_baseline", action="store_true", help="Write the results as the new baseline.")
+    ap.add_argument("--check", action="store_true", help="Exit 1 if any metric regressed past the tolerance.")
+    args = ap.parse_args()
+
+    cfg = read_config(args.config)
+    bcfg = {**BENCH_DEFAULTS, **(cfg.get("benchmarks") or {})}
+    sizes = args.episodes or [int(n) for n in bcfg["episodes"]]
+    only = args.only or CASES
+
+    current = {"environment": environment(),
+               "settings": {"episodes": sizes, "cases": only,
+                            **{k: bcfg[k] for k in ("seed", "n_estimators", "act_calls", "batch_sizes")}},
+               "results": {}}
+    for n in sizes:
+        current["results"][f"n{n}"] = run_size(n, cfg, bcfg, only)
+
+    out = args.out or bcfg["out"]
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(current, f, indent=2)
+    print(f"[ok] Results -> {out}")
+
+    baseline_path = args.baseline or bcfg["baseline"]
+    if args.save_baseline:
+        with open(baseline_path, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=2)
+        print(f"[ok] Baseline -> {baseline_path}")
+        return
+    if not os.path.isfile(baseline_path):
+        print(f"[warn] No baseline at {baseline_path}; run with --save_baseline to create one.")
+        return
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    env, base_env = current["environment"], baseline.get("environment", {})
+    if (env["cpu_count"], env["platform"]) != (base_env.get("cpu_count"), base_env.get("platform")):
+        print(f"[warn] Baseline is from another machine ({base_env.get('platform')}, "
+              f"{base_env.get('cpu_count')} CPUs); ratios are indicative only.")
+
+    import pandas as pd
+    rows = compare(current, baseline, float(bcfg["tolerance"]), float(bcfg["min_seconds"]))
+    if not rows:
+        print("[warn] No metrics in common with the baseline.")
+        return
+    table = pd.DataFrame(rows)
+    with pd.option_context("display.float_format", "{:,.4g}".format, "display.width", 160,
+                           "display.max_rows", None):
+        print(table.to_string(index=False))
+    bad = table[table["status"] == "regression"]
+    print(f"=== {len(bad)} regression(s), {int((table['status'] == 'improved').sum())} improvement(s) "
+          f"over {len(table)} metrics (tolerance {float(bcfg['tolerance']):.0%}) ===")
+    if args.check and len(bad):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
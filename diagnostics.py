@@ -1,65 +1,244 @@
-import argparse, glob
-from typing import Dict, Any, List
+import argparse, glob, hashlib, io, json, os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Any, List, Tuple
 import yaml
 import pandas as pd
 import numpy as np
 
+from episode_store import file_sha1, is_store, read_manifest, iter_store_episodes
+
+# Bump when checks change so cached per-file results are recomputed
+CHECKS_VERSION = 2
+
+REQUIRED = ["stage", "month", "north_mm", "south_mm", "pool_mm", "canal_mm", "lake_mm",
+            "pool_ratio", "irrigateN_mm", "irrigateS_mm", "drainN_mm", "drainS_mm"]
+NONNEG = ["north_mm", "south_mm", "pool_mm", "canal_mm", "lake_mm", "rain_mm", "loss_mm"]
+RENAMES = {"rain_today_mm": "rain_mm", "actual_loss_mm": "loss_mm"}
+
 def read_config(path: str) -> Dict[str, Any]:
     with open(path, "r", encoding="utf-8") as f:
         return yaml.safe_load(f)
 
-def scan(files: List[str], features: List[str], actions: List[str]) -> pd.DataFrame:
-    recs = []
-    for f in files:
-        df = pd.read_csv(f)
-        # Back-compat rename if needed
-        if ("rain_mm" not in df.columns) and ("rain_today_mm" in df.columns):
-            df = df.rename(columns={"rain_today_mm": "rain_mm"})
-        if ("loss_mm" not in df.columns) and ("actual_loss_mm" in df.columns):
-            df = df.rename(columns={"actual_loss_mm": "loss_mm"})
-        issues = []
-        # Required cols
-        req = set(["stage","month","north_mm","south_mm","pool_mm","canal_mm","lake_mm",
-                   "pool_ratio","irrigateN_mm","irrigateS_mm","drainN_mm","drainS_mm"])
-        missing = sorted(list(req - set(df.columns)))
+# ----------------- Parsing (worker side) -----------------
+
+def parse_episode(path: str) -> Tuple[Dict[str, Any], pd.DataFrame]:
+    """(file-level facts, frame) for one CSV; truncation is judged on the raw bytes."""
+    with open(path, "rb") as f:
+        raw = f.read()
+    info = {"bytes": len(raw), "truncated": False}
+    header, _, body = raw.partition(b"\n")
+    if not header.strip():
+        info["truncated"] = True
+        return info, pd.DataFrame()
+    n_fields = header.count(b",") + 1
+    if not body.strip():
+        info["truncated"] = True             # header only: the run never logged a tick
+    if body and not raw.endswith(b"\n"):
+        info["truncated"] = True             # cut mid-line
+    lines = body.rstrip(b"\n").split(b"\n") if body.strip() else []
+    if lines and lines[-1].count(b",") + 1 != n_fields:
+        info["truncated"] = True             # last row is missing fields
+        body = b"\n".join(lines[:-1])
+    df = pd.read_csv(io.BytesIO(header + b"\n" + body)) if body.strip() else \
+        pd.DataFrame(columns=header.decode("utf-8").strip().split(","))
+    return info, df.rename(columns={k: v for k, v in RENAMES.items() if v not in df.columns})
+
+def _parse_many(paths: List[str]) -> List[Tuple[Dict[str, Any], pd.DataFrame]]:
+    return [parse_episode(p) for p in paths]
+
+# ----------------- Checks (one vectorized pass) -----------------
+
+def check_episodes(frames: List[pd.DataFrame], infos: List[Dict[str, Any]],
+                   features: List[str], actions: List[str], stage_durations: List[int]) -> List[List[str]]:
+    """
+    Issues per episode. All episodes are concatenated with an episode key and every
+    check is a single array expression followed by a per-episode count.
+    """
+    n_ep = len(frames)
+    lengths = np.array([len(df) for df in frames], dtype=np.int64)
+    ep = np.repeat(np.arange(n_ep), lengths)
+    starts = np.concatenate([[0], np.cumsum(lengths)])[:-1]
+    first = np.zeros(len(ep), dtype=bool)
+    first[starts[lengths > 0]] = True
+
+    cols = sorted(set(REQUIRED + NONNEG + features + actions + ["tick"]))
+    has = {c: np.array([c in df.columns for df in frames], dtype=bool) for c in cols}
+    data = {c: np.concatenate([pd.to_numeric(df[c], errors="coerce").to_numpy(dtype=float) if c in df.columns
+                               else np.full(len(df), np.nan) for df in frames]) if n_ep else np.zeros(0)
+            for c in cols}
+    count = lambda mask: np.bincount(ep[mask], minlength=n_ep)
+
+    counts: Dict[str, np.ndarray] = {}
+    with np.errstate(invalid="ignore"):
+        pr = data["pool_ratio"]
+        counts["pool_ratio_out_of_range"] = count((pr < -1e-6) | (pr > 1 + 1e-6))
+        for c in NONNEG:
+            counts[f"{c}_neg"] = count(data[c] < -1e-9)
+        for c in ("rain_mm", "loss_mm"):
+            counts[f"{c}_very_large"] = count(data[c] > 150)    # absurd single-day values
+        nan_rows = sum(np.isnan(data[c]) & has[c][ep] for c in set(features + actions) if c in data)
+        counts["NaNs"] = np.bincount(ep, weights=nan_rows, minlength=n_ep).astype(int) \
+            if np.ndim(nan_rows) else np.zeros(n_ep, dtype=int)
+        st = data["stage"]
+        counts["stage_out_of_bounds"] = count((st < 1) | (st > len(stage_durations)))
+
+        # progression inside an episode: tick +1 per row from 0, stage never drops or skips
+        d_tick = np.diff(data["tick"], prepend=np.nan)
+        d_stage = np.diff(st, prepend=np.nan)
+        inner = ~first
+        counts["tick_not_from_0"] = count(first & (data["tick"] != 0) & has["tick"][ep])
+        counts["tick_non_monotonic"] = count(inner & (d_tick != 1) & has["tick"][ep])
+        counts["stage_decreasing"] = count(inner & (d_stage < 0))
+        counts["stage_skipped"] = count(inner & (d_stage > 1))
+
+    expected = int(sum(stage_durations))
+    issues: List[List[str]] = []
+    for i, df in enumerate(frames):
+        out = []
+        if infos[i].get("truncated"):
+            out.append(f"truncated:{infos[i]['bytes']}B")
+        missing = [c for c in REQUIRED if not has[c][i]]
         if missing:
-            issues.append(f"missing_cols:{missing}")
-
-        # Ranges
-        if "pool_ratio" in df:  # 0..1
-            bad = ((df["pool_ratio"] < -1e-6) | (df["pool_ratio"] > 1+1e-6)).sum()
-            if bad: issues.append(f"pool_ratio_out_of_range:{bad}")
-
-        for c in ["north_mm","south_mm","pool_mm","canal_mm","lake_mm","rain_mm","loss_mm"]:
-            if c in df:
-                neg = (df[c] < -1e-9).sum()
-                if neg: issues.append(f"{c}_neg:{neg}")
-                if c in ("rain_mm","loss_mm"):
-                    # absurdly large single-day values?
-                    big = (df[c] > 150).sum()
-                    if big: issues.append(f"{c}_very_large:{big}")
-
-        na = df[ list(set(features+actions) & set(df.columns)) ].isna().sum().sum()
-        if na: issues.append(f"NaNs:{int(na)}")
-
-        # inconsistent stage progression?
-        if "stage" in df:
-            s = df["stage"].astype(int).values
-            if (s.min()<1) or (s.max()>8):
-                issues.append("stage_out_of_bounds")
-        recs.append({"file": f, "issues": ";".join(issues) if issues else ""})
-    return pd.DataFrame(recs)
+            out.append(f"missing_cols:{missing}")
+        if lengths[i] < expected:
+            out.append(f"short:{lengths[i]}/{expected}")
+        out += [f"{k}:{int(v[i])}" if k != "stage_out_of_bounds" else k
+                for k, v in counts.items() if v[i]]
+        issues.append(out)
+    return issues
+
+# ----------------- Cache -----------------
+
+def check_spec(features: List[str], actions: List[str], stage_durations: List[int]) -> str:
+    spec = {"version": CHECKS_VERSION, "features": features, "actions": actions,
+            "stage_durations": stage_durations}
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+def load_cache(path: str, spec: str) -> Dict[str, Any]:
+    if path and os.path.isfile(path):
+        with open(path, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+        if cache.get("spec") == spec:
+            return cache
+    return {"spec": spec, "files": {}, "stores": {}, "by_hash": {}}
+
+def save_cache(path: str, cache: Dict[str, Any]) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(cache, f)
+    os.replace(tmp, path)
+
+# ----------------- Scan -----------------
+
+def scan(files: List[str], features: List[str], actions: List[str], stage_durations: List[int],
+         cache_path: str = "", workers: int = 0) -> pd.DataFrame:
+    """
+    One row per episode (CSV, or store episode) with its issues. CSVs whose content
+    hash was scanned before under the same checks are answered from the cache;
+    the rest are parsed in a process pool and checked together.
+    """
+    spec = check_spec(features, actions, stage_durations)
+    cache = load_cache(cache_path, spec)
+    results: Dict[str, Dict[str, Any]] = {}
+    todo: List[Tuple[str, str]] = []        # (path, sha1)
+    stores = []
+    for f in files:
+        if is_store(f):
+            stores.append(f)
+            continue
+        st = os.stat(f)
+        old = cache["files"].get(f)
+        if old and old["size"] == st.st_size and old["mtime"] == st.st_mtime:
+            digest = old["sha1"]
+        else:
+            digest = file_sha1(f)
+            cache["files"][f] = {"size": st.st_size, "mtime": st.st_mtime, "sha1": digest}
+        if digest in cache["by_hash"]:
+            results[f] = dict(cache["by_hash"][digest], cached=True)
+        else:
+            todo.append((f, digest))
+
+    # store episodes are keyed by the source hash recorded in the manifest;
+    # only segments holding an uncached episode are decoded
+    store_eps = []
+    for s in stores:
+        manifest = read_manifest(s)["files"]
+        uncached = []
+        for path, e in manifest.items():
+            if e["sha1"] in cache["by_hash"]:
+                results[f"{s}::{path}"] = dict(cache["by_hash"][e["sha1"]], cached=True)
+            else:
+                uncached.append(path)
+        if not uncached:
+            continue
+        for path, df in iter_store_episodes(s, paths=uncached):
+            store_eps.append((f"{s}::{path}", manifest[path]["sha1"], {"bytes": 0, "truncated": False},
+                              df.rename(columns={k: v for k, v in RENAMES.items() if v not in df.columns})))
+
+    paths = [p for p, _ in todo]
+    workers = min(workers or os.cpu_count() or 1, max(1, len(paths)))
+    step = max(1, -(-len(paths) // (4 * workers)))
+    chunks = [paths[i:i + step] for i in range(0, len(paths), step)]
+    if workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            parsed = [r for part in ex.map(_parse_many, chunks) for r in part]
+    else:
+        parsed = [r for c in chunks for r in _parse_many(c)]
+
+    keys = paths + [k for k, _, _, _ in store_eps]
+    digests = [d for _, d in todo] + [d for _, d, _, _ in store_eps]
+    infos = [i for i, _ in parsed] + [i for _, _, i, _ in store_eps]
+    frames = [df for _, df in parsed] + [df for _, _, _, df in store_eps]
+    for key, digest, df, iss in zip(keys, digests, frames,
+                                    check_episodes(frames, infos, features, actions, stage_durations)):
+        rec = {"rows": len(df), "issues": ";".join(iss)}
+        cache["by_hash"][digest] = rec
+        results[key] = dict(rec, cached=False)
+
+    if cache_path:
+        # keep results still referenced by an existing CSV or a store manifest
+        cache["files"] = {p: e for p, e in cache["files"].items() if os.path.exists(p)}
+        cache["stores"] = {s: d for s, d in cache.get("stores", {}).items() if is_store(s)}
+        for s in stores:
+            cache["stores"][s] = sorted({e["sha1"] for e in read_manifest(s)["files"].values()})
+        live = {e["sha1"] for e in cache["files"].values()}
+        live.update(d for ds in cache["stores"].values() for d in ds)
+        cache["by_hash"] = {d: r for d, r in cache["by_hash"].items() if d in live}
+        save_cache(cache_path, cache)
+
+    order = [f for f in files if not is_store(f)] + sorted(k for k in results if "::" in k)
+    return pd.DataFrame([{"file": k, **results[k]} for k in order], columns=["file", "rows", "issues", "cached"])
+
+def expand_sources(patterns: List[str]) -> List[str]:
+    files: List[str] = []
+    for p in patterns:
+        files += [p] if is_store(p) else sorted(glob.glob(p))
+    return list(dict.fromkeys(files))
 
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--config", "-c", default="config.yaml")
+    ap.add_argument("sources", nargs="*",
+                    help="CSV globs / episode stores (default: diagnostics.globs, else data_glob).")
+    ap.add_argument("--workers", type=int, default=None, help="Parsing processes (0 = all cores).")
+    ap.add_argument("--no_cache", action="store_true", help="Rescan every file.")
+    ap.add_argument("--all", action="store_true", help="List clean episodes too.")
     args = ap.parse_args()
     cfg = read_config(args.config)
+    dcfg = cfg.get("diagnostics", {})
 
-    files = sorted(glob.glob(cfg["data_glob"]))
-    df = scan(files, cfg["features"], cfg["actions"])
-    print(df.to_string(index=False))
-    print("\nFiles with issues:", (df["issues"]!="").sum(), "/", len(df))
+    patterns = args.sources or dcfg.get("globs") or [cfg["data_glob"]]
+    files = expand_sources(patterns)
+    df = scan(files, cfg["features"], cfg["actions"], cfg["stage_durations"],
+              cache_path="" if args.no_cache else dcfg.get("cache", ""),
+              workers=int(dcfg.get("workers", 0) if args.workers is None else args.workers))
+    bad = df[df["issues"] != ""]
+    shown = df if args.all else bad
+    if len(shown):
+        print(shown.to_string(index=False))
+    print(f"\nScanned {len(df)} episodes from {patterns} ({int(df['cached'].sum())} from cache)")
+    print("Files with issues:", len(bad), "/", len(df))
 
 if __name__ == "__main__":
     main()
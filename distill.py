@@ -0,0 +1,190 @@
+import argparse
+import json
+import os
+import time
+from typing import Any, Dict
+
+import numpy as np
+import pandas as pd
+from joblib import dump, load
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.tree import DecisionTreeRegressor
+
+from export_policy_table import make_grid, synth_features_df
+from train_bc import list_csvs, load_dataset, mae_by_action, read_config, safe_clip_actions
+
+
+# ----------------- Sampling -----------------
+
+def sample_states(n: int, rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Uniform states over the box make_grid spans (table conventions: stage 0..7),
+    with continuous def/canal/pool values and norm_day in [0, 1].
+    """
+    grid = make_grid()
+    lo = grid.min()
+    hi = grid.max()
+    return pd.DataFrame({
+        "stage": rng.integers(lo["stage"], hi["stage"] + 1, n),
+        "month": rng.integers(lo["month"], hi["month"] + 1, n),
+        "defN_mm": rng.uniform(lo["defN_mm"], hi["defN_mm"], n),
+        "defS_mm": rng.uniform(lo["defS_mm"], hi["defS_mm"], n),
+        "canal_mm": rng.uniform(lo["canal_mm"], hi["canal_mm"], n),
+        "pool_ratio": rng.uniform(0.0, 1.0, n),
+        "norm_day": rng.uniform(0.0, 1.0, n),
+    })
+
+
+def teacher_dataset(teacher, meta: Dict[str, Any], n: int, rng: np.random.Generator,
+                    with_grid: bool = True, batch_size: int = 200_000):
+    """Random states (plus every make_grid point), labelled by the teacher's own predictions."""
+    states = sample_states(n, rng)
+    if with_grid:
+        states = pd.concat([states, make_grid()], ignore_index=True)
+    X = synth_features_df(states, meta).to_numpy(dtype=np.float32)
+    Y = np.vstack([teacher.predict(X[s:s + batch_size]) for s in range(0, len(X), batch_size)])
+    return X, Y
+
+
+# continuous features perturbed around logged states; def*_mm follow their depth (see DEPTH_DEFICIT)
+JITTER_FEATURES = ("north_mm", "south_mm", "canal_mm", "rain_mm", "loss_mm")
+DEPTH_DEFICIT = {"north_mm": "defN_mm", "south_mm": "defS_mm"}
+
+
+def logged_states(cfg: Dict[str, Any], meta: Dict[str, Any], copies: int, scale: float,
+                  rng: np.random.Generator) -> np.ndarray:
+    """
+    Training-log states plus `copies` jittered replicas of each. The export grid
+    holds rain_mm/loss_mm at 0, so without these the student never sees the
+    weather the policy actually runs under. Field depths are jittered and their
+    deficits recomputed as max(target - depth, 0), as synth_features_df does.
+    """
+    features = meta["features"]
+    X, _ = load_dataset(list_csvs(cfg["data_glob"]), cfg)
+    X = X[features].to_numpy(dtype=np.float32)
+    col = {c: j for j, c in enumerate(features)}
+    if "target_mm" in col:
+        target = X[:, col["target_mm"]]
+    else:
+        by_stage = np.asarray(meta.get("target_by_stage", [15, 35, 25, 0, 25, 25, 25, 0]), dtype=np.float32)
+        target = by_stage[np.clip(X[:, col["stage"]].astype(int) - 1, 0, len(by_stage) - 1)]
+    # a deficit without its depth column has nothing to stay consistent with: jitter it directly
+    cols = [col[c] for c in JITTER_FEATURES if c in col] + \
+           [col[d] for c, d in DEPTH_DEFICIT.items() if d in col and c not in col]
+    reps = [X]
+    for _ in range(max(0, copies)):
+        Xj = X.copy()
+        Xj[:, cols] = np.maximum(Xj[:, cols] + rng.normal(0.0, scale, (len(X), len(cols))), 0.0)
+        for c, d in DEPTH_DEFICIT.items():
+            if c in col and d in col:
+                Xj[:, col[d]] = np.maximum(target - Xj[:, col[c]], 0.0)
+        reps.append(Xj)
+    return np.vstack(reps)
+
+
+# ----------------- Student -----------------
+
+def build_student(dcfg: Dict[str, Any], seed: int):
+    kind = dcfg.get("student", "tree")
+    depth = int(dcfg.get("max_depth", 10))
+    if kind == "tree":
+        return DecisionTreeRegressor(max_depth=depth, min_samples_leaf=int(dcfg.get("min_samples_leaf", 5)),
+                                     random_state=seed)
+    if kind == "forest":
+        return RandomForestRegressor(n_estimators=int(dcfg.get("n_estimators", 10)), max_depth=depth,
+                                     min_samples_leaf=int(dcfg.get("min_samples_leaf", 5)),
+                                     random_state=seed, n_jobs=-1)
+    raise ValueError(f"Unknown distill.student {kind!r} (expected 'tree' or 'forest')")
+
+
+def latency_ms(model, X: np.ndarray, repeats: int = 50) -> float:
+    x = X[:1]
+    model.predict(x)
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        model.predict(x)
+    return (time.perf_counter() - t0) / repeats * 1e3
+
+
+def distill(cfg: Dict[str, Any]) -> Dict[str, Any]:
+    dcfg = cfg.get("distill", {})
+    seed = int(dcfg.get("seed", 0))
+    rng = np.random.default_rng(seed)
+    teacher = load(cfg["bc_model_path"])
+    with open(cfg["meta_file"], "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    actions = meta["actions"]
+    limits = meta.get("limits", {"irrigate_max": 5.0, "drain_max": 3.0})
+
+    X, Y = teacher_dataset(teacher, meta, int(dcfg.get("n_samples", 500_000)), rng)
+    X_log = logged_states(cfg, meta, int(dcfg.get("logged_copies", 20)),
+                          float(dcfg.get("jitter_mm", 1.0)), rng)
+    X = np.vstack([X, X_log])
+    Y = np.vstack([Y, teacher.predict(X_log)])
+    # held-out teacher-labelled states for fidelity
+    X_ho, Y_ho = teacher_dataset(teacher, meta, int(dcfg.get("n_holdout", 50_000)), rng, with_grid=False)
+    Y_ho = safe_clip_actions(Y_ho, limits, actions)
+
+    student = build_student(dcfg, seed)
+    t0 = time.perf_counter()
+    student.fit(X, Y)
+    fit_s = time.perf_counter() - t0
+    if hasattr(student, "n_jobs"):
+        student.n_jobs = 1
+
+    student_path = cfg.get("student_model_path", "models/bc_student.joblib")
+    os.makedirs(os.path.dirname(student_path) or ".", exist_ok=True)
+    dump(student, student_path)
+
+    # fidelity vs the teacher (held-out synthetic states) and vs rule-labelled logs
+    # (logged states were seen with teacher labels, never with the rule labels)
+    S_ho = safe_clip_actions(student.predict(X_ho), limits, actions)
+    X_rule, Y_rule = load_dataset(list_csvs(dcfg.get("rule_glob", "data/rule/rule_ep*.csv")), cfg)
+    X_rule = X_rule[meta["features"]].to_numpy(dtype=np.float32)
+    Y_rule = Y_rule.to_numpy()
+
+    report = {
+        "student": dcfg.get("student", "tree"),
+        "n_samples": int(len(X)),
+        "fit_s": round(fit_s, 3),
+        "mae_vs_teacher": mae_by_action(Y_ho, S_ho, actions),
+        "mae_vs_rule": {
+            "teacher": mae_by_action(Y_rule, safe_clip_actions(teacher.predict(X_rule), limits, actions), actions),
+            "student": mae_by_action(Y_rule, safe_clip_actions(student.predict(X_rule), limits, actions), actions),
+        },
+        "size_bytes": {"teacher": os.path.getsize(cfg["bc_model_path"]),
+                       "student": os.path.getsize(student_path)},
+        "latency_ms": {"teacher": round(latency_ms(teacher, X_ho), 4),
+                       "student": round(latency_ms(student, X_ho), 4)},
+    }
+
+    # the student is a drop-in for BCPolicy: same features/actions/limits
+    student_meta = {**meta, "distill": report, "teacher_model_path": cfg["bc_model_path"]}
+    student_meta_path = cfg.get("student_meta_file", "models/bc_student_meta.json")
+    with open(student_meta_path, "w", encoding="utf-8") as f:
+        json.dump(student_meta, f, indent=2)
+    report["model_path"] = student_path
+    report["meta_path"] = student_meta_path
+    return report
+
+
+def main():
+    ap = argparse.ArgumentParser("Distill the BC forest into a compact student policy.")
+    ap.add_argument("--config", "-c", default="config.yaml")
+    args = ap.parse_args()
+
+    rep = distill(read_config(args.config))
+    sz, lat = rep["size_bytes"], rep["latency_ms"]
+    print("=== Distillation complete ===")
+    print(f"Student: {rep['student']}  samples: {rep['n_samples']:,}  fit {rep['fit_s']:.1f}s")
+    print(f"Size    : {sz['teacher']:,} -> {sz['student']:,} bytes ({sz['teacher'] / max(sz['student'], 1):.0f}x)")
+    print(f"Latency : {lat['teacher']:.3f} -> {lat['student']:.3f} ms ({lat['teacher'] / max(lat['student'], 1e-9):.0f}x)")
+    print("MAE vs teacher      :", rep["mae_vs_teacher"])
+    print("MAE vs rule (teacher):", rep["mae_vs_rule"]["teacher"])
+    print("MAE vs rule (student):", rep["mae_vs_rule"]["student"])
+    print(f"Saved student -> {rep['model_path']}")
+    print(f"Saved meta    -> {rep['meta_path']}")
+
+
+if __name__ == "__main__":
+    main()
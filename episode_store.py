@@ -0,0 +1,252 @@
+import hashlib
+import json
+import os
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# ----------------- Layout -----------------
+#
+# <store>/manifest.json   one entry per source CSV:
+#                         {path: {size, mtime, sha1, source, segment, episode, rows, stats}}
+#                         stats: the sanity figures merge_data.py prints (episode_stats)
+# <store>/seg_NNNNN.npz   the episodes ingested by one merge run, column-wise:
+#                         one array per column, concatenated over episodes, plus
+#                         __offsets__ (row offsets, n_episodes + 1) and
+#                         __cats__<col> (categories of categorical columns).
+#
+# A changed CSV is re-ingested into the new segment and its manifest entry moved;
+# segments no live entry points to are deleted.
+
+MANIFEST = "manifest.json"
+INT_COLUMNS = ("tick", "stage", "month")
+CATEGORICAL_COLUMNS = ("control_mode", "source")
+# must stay >= 0; episode_stats flags an episode with a negative value in any of them
+NONNEGATIVE_COLUMNS = ("north_mm", "south_mm", "pool_mm", "canal_mm", "lake_mm")
+_OFFSETS = "__offsets__"
+_CATS = "__cats__"
+
+
+def is_store(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, MANIFEST))
+
+
+def file_sha1(path: str, chunk: int = 1 << 20) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def read_manifest(store: str) -> Dict[str, dict]:
+    p = os.path.join(store, MANIFEST)
+    if not os.path.isfile(p):
+        return {"version": 1, "next_segment": 0, "files": {}}
+    with open(p, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_manifest(store: str, manifest: Dict[str, dict]) -> None:
+    p = os.path.join(store, MANIFEST)
+    tmp = p + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, p)
+
+
+# ----------------- Write -----------------
+
+def episode_stats(df: pd.DataFrame) -> Dict[str, object]:
+    """Per-episode sanity figures kept in the manifest, so summaries never decode segments."""
+    stage = pd.to_numeric(df["stage"], errors="coerce") if "stage" in df.columns else pd.Series(dtype=float)
+    cols = [c for c in NONNEGATIVE_COLUMNS if c in df.columns]
+    return {
+        "stage_min": None if stage.isna().all() else stage.min().item(),
+        "stage_max": None if stage.isna().all() else stage.max().item(),
+        "negative": bool((df[cols] < 0).any().any()) if cols else False,
+        "control_modes": ({str(k): int(v) for k, v in df["control_mode"].value_counts().items() if v}
+                          if "control_mode" in df.columns else {}),
+    }
+
+
+def _compact(df: pd.DataFrame) -> Dict[str, np.ndarray]:
+    cols: Dict[str, np.ndarray] = {}
+    for c in df.columns:
+        s = df[c]
+        if c in CATEGORICAL_COLUMNS or s.dtype == object:
+            cat = s.astype("category")
+            cols[c] = cat.cat.codes.to_numpy()
+            cols[_CATS + c] = np.asarray(cat.cat.categories.astype(str), dtype=str)
+        elif c in INT_COLUMNS and not s.isna().any():
+            cols[c] = pd.to_numeric(s, downcast="integer").to_numpy()
+        else:
+            cols[c] = s.to_numpy(dtype=np.float32)
+    return cols
+
+
+def update_store(store: str, sources: Dict[str, List[str]]) -> Dict[str, int]:
+    """
+    Bring the store in line with `sources` (label -> CSV paths).
+    Unchanged files (same size+mtime, or same content hash) are not parsed.
+    Returns counts of added/changed/unchanged/removed episodes.
+    """
+    os.makedirs(store, exist_ok=True)
+    manifest = read_manifest(store)
+    files = manifest["files"]
+    seen, new = set(), []
+    stats = {"added": 0, "changed": 0, "unchanged": 0, "removed": 0}
+
+    for label, paths in sources.items():
+        for p in paths:
+            key = os.path.normpath(p)
+            seen.add(key)
+            st = os.stat(p)
+            old = files.get(key)
+            if old and old["size"] == st.st_size and old["mtime"] == st.st_mtime and old["source"] == label:
+                stats["unchanged"] += 1
+                continue
+            digest = file_sha1(p)
+            if old and old["sha1"] == digest and old["source"] == label:
+                old["mtime"] = st.st_mtime
+                stats["unchanged"] += 1
+                continue
+            stats["changed" if old else "added"] += 1
+            new.append((key, label, st, digest))
+
+    for key in [k for k in files if k not in seen]:
+        del files[key]
+        stats["removed"] += 1
+
+    if new:
+        seg = f"seg_{manifest['next_segment']:05d}.npz"
+        manifest["next_segment"] += 1
+        frames, offsets = [], [0]
+        for i, (key, label, st, digest) in enumerate(new):
+            df = pd.read_csv(key)
+            df["source"] = label  # tag so we know if rule or agent
+            frames.append(df)
+            offsets.append(offsets[-1] + len(df))
+            files[key] = {"size": st.st_size, "mtime": st.st_mtime, "sha1": digest, "source": label,
+                          "segment": seg, "episode": i, "rows": len(df), "stats": episode_stats(df)}
+        cols = _compact(pd.concat(frames, ignore_index=True))
+        cols[_OFFSETS] = np.asarray(offsets, dtype=np.int64)
+        np.savez(os.path.join(store, seg), **cols)
+
+    # stores written before per-episode stats: fill them in once, one segment at a time
+    if any("stats" not in e for e in files.values()):
+        _write_manifest(store, manifest)
+        for paths, df in iter_store_segments(store):
+            ep = df["__ep__"].to_numpy()
+            bounds = np.searchsorted(ep, np.arange(len(paths) + 1))
+            for i, path in enumerate(paths):
+                if "stats" not in files[path]:
+                    files[path]["stats"] = episode_stats(df.iloc[bounds[i]:bounds[i + 1]])
+
+    live = {e["segment"] for e in files.values()}
+    for name in os.listdir(store):
+        if name.startswith("seg_") and name.endswith(".npz") and name not in live:
+            os.remove(os.path.join(store, name))
+
+    _write_manifest(store, manifest)
+    return stats
+
+
+# ----------------- Read -----------------
+
+def _segment_frame(npz) -> Tuple[pd.DataFrame, np.ndarray]:
+    data = {}
+    for k in npz.files:
+        if k == _OFFSETS or k.startswith(_CATS):
+            continue
+        if _CATS + k in npz.files:
+            data[k] = pd.Categorical.from_codes(npz[k], categories=npz[_CATS + k].tolist())
+        else:
+            data[k] = npz[k]
+    return pd.DataFrame(data), npz[_OFFSETS]
+
+
+def iter_store_episodes(store: str, columns: Optional[List[str]] = None,
+                        paths: Optional[Iterable[str]] = None) -> Iterator[Tuple[str, pd.DataFrame]]:
+    """
+    Yield (source path, episode frame) for every live episode (or only `paths`),
+    grouped by segment and ordered by path within it. Built on iter_store_segments,
+    so one segment is decoded at a time.
+    """
+    for paths, df in iter_store_segments(store, columns, paths):
+        ep = df.pop("__ep__").to_numpy()
+        bounds = np.searchsorted(ep, np.arange(len(paths) + 1))
+        for i, path in enumerate(paths):
+            yield path, df.iloc[bounds[i]:bounds[i + 1]].reset_index(drop=True)
+
+
+def iter_store_segments(store: str, columns: Optional[List[str]] = None,
+                        paths: Optional[Iterable[str]] = None) -> Iterator[Tuple[List[str], pd.DataFrame]]:
+    """
+    Per segment: (source paths of its live episodes, ordered by path, and one frame
+    of those episodes with `__ep__` = index into the paths). Only `columns` and
+    `paths` (if given) are decoded, segments without a wanted episode are not
+    opened, and one segment is held at a time, so memory stays bounded by the
+    largest segment.
+    """
+    wanted = None if paths is None else set(paths)
+    by_seg: Dict[str, List[Tuple[str, int]]] = {}
+    for path, e in sorted(read_manifest(store)["files"].items()):
+        if wanted is None or path in wanted:
+            by_seg.setdefault(e["segment"], []).append((path, e["episode"]))
+    for seg, eps in sorted(by_seg.items()):
+        with np.load(os.path.join(store, seg)) as npz:
+            offsets = npz[_OFFSETS]
+            keep = [k for k in npz.files if k != _OFFSETS and not k.startswith(_CATS)
+                    and (columns is None or k in columns)]
+            starts, ends = offsets[[ep for _, ep in eps]], offsets[[ep + 1 for _, ep in eps]]
+            rows = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)]) if eps else np.zeros(0, int)
+            data = {}
+            for k in keep:
+                a = npz[k][rows]
+                if _CATS + k in npz.files:
+                    a = pd.Categorical.from_codes(a, categories=npz[_CATS + k].tolist())
+                data[k] = a
+        df = pd.DataFrame(data)
+        df["__ep__"] = np.repeat(np.arange(len(eps), dtype=np.int32), ends - starts)
+        yield [p for p, _ in eps], df
+
+
+def store_summary(store: str) -> Dict[str, object]:
+    """Rows, stage range, negatives and control-mode counts over live episodes, from the manifest alone."""
+    eps = list(read_manifest(store)["files"].values())
+    stats = [e["stats"] for e in eps]
+    lo = [s["stage_min"] for s in stats if s["stage_min"] is not None]
+    hi = [s["stage_max"] for s in stats if s["stage_max"] is not None]
+    modes: Dict[str, int] = {}
+    for s in stats:
+        for k, v in s["control_modes"].items():
+            modes[k] = modes.get(k, 0) + v
+    return {"rows": sum(int(e["rows"]) for e in eps), "stage_min": min(lo, default=None),
+            "stage_max": max(hi, default=None), "negative": any(s["negative"] for s in stats),
+            "control_modes": dict(sorted(modes.items(), key=lambda kv: -kv[1]))}
+
+
+def load_store(store: str) -> pd.DataFrame:
+    """All live episodes in one frame, with an `__ep__` episode key column."""
+    frames = []
+    for path, df in iter_store_episodes(store):
+        df["__ep__"] = os.path.splitext(os.path.basename(path))[0]
+        frames.append(df)
+    if not frames:
+        return pd.DataFrame()
+    out = pd.concat(frames, ignore_index=True)
+    for c in CATEGORICAL_COLUMNS + ("__ep__",):
+        if c in out.columns:
+            out[c] = out[c].astype("category")
+    return out
+
+
+def iter_frames(paths: List[str]) -> Iterator[Tuple[str, pd.DataFrame]]:
+    """(name, frame) per CSV path, or per episode when a path is an episode store."""
+    for p in paths:
+        if is_store(p):
+            yield from iter_store_episodes(p)
+        else:
+            yield p, pd.read_csv(p)
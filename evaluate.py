@@ -0,0 +1,226 @@
+import argparse
+import glob
+import io
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from episode_store import is_store, iter_store_episodes
+
+# Log columns the KPIs need (nothing else is parsed)
+KPI_COLUMNS = ["tick", "irrigateN_mm", "irrigateS_mm", "drainN_mm", "drainS_mm", "defN_mm", "defS_mm",
+               "delta_lake_L", "delta_N_to_lake_mg", "delta_P_to_lake_mg", "growth_avg_pct"]
+
+# KPI -> True when lower is better (for the agent win rate)
+KPIS = {
+    "irrigation_mm": True,
+    "drainage_mm": True,
+    "deficit_days": True,
+    "lake_withdrawn_L": True,
+    "N_to_lake_mg": True,
+    "P_to_lake_mg": True,
+    "final_growth_pct": False,
+}
+
+_EP = re.compile(r"ep(\d+)")
+
+
+def episode_index(name: str) -> int:
+    m = _EP.findall(os.path.basename(name))
+    return int(m[-1]) if m else -1
+
+
+# ----------------- Loading -----------------
+
+def read_kpi_columns(paths: List[str]) -> List[Dict[str, np.ndarray]]:
+    """
+    KPI columns of several CSVs. Files sharing a header are concatenated and parsed
+    by one read_csv call, so the per-file parser overhead is paid once per chunk.
+    """
+    groups: Dict[bytes, List[Tuple[int, bytes]]] = {}
+    for i, p in enumerate(paths):
+        with open(p, "rb") as f:
+            header, _, body = f.read().partition(b"\n")
+        body = body.rstrip()
+        if body:
+            groups.setdefault(header.strip(), []).append((i, body + b"\n"))
+    out: List[Dict[str, np.ndarray]] = [{} for _ in paths]
+    for header, items in groups.items():
+        names = header.decode("utf-8").split(",")
+        df = pd.read_csv(io.BytesIO(b"".join(b for _, b in items)), header=None, names=names,
+                         usecols=[c for c in names if c in KPI_COLUMNS], skip_blank_lines=False)
+        arrays = {c: df[c].to_numpy(dtype=np.float64) for c in df.columns}
+        lengths = [b.count(b"\n") for _, b in items]
+        for (i, _), s, e in zip(items, np.cumsum([0] + lengths[:-1]), np.cumsum(lengths)):
+            out[i] = {c: a[s:e] for c, a in arrays.items()}
+    return out
+
+
+def load_runs(paths: List[str], workers: int = 0) -> Tuple[List[str], np.ndarray, Dict[str, np.ndarray]]:
+    """
+    All episodes of `paths` (CSVs, parsed in chunks over a process pool, and/or
+    episode stores) concatenated column-wise: (names, row offsets (n_episodes + 1),
+    columns). Empty episodes are skipped with a warning.
+    """
+    csvs = [p for p in paths if not is_store(p)]
+    workers = min(workers or os.cpu_count() or 1, max(1, len(csvs)))
+    step = max(1, min(500, -(-len(csvs) // (4 * workers))))
+    chunks = [csvs[s:s + step] for s in range(0, len(csvs), step)]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            results = list(ex.map(read_kpi_columns, chunks))
+    else:
+        results = [read_kpi_columns(c) for c in chunks]
+    parsed = {p: cols for chunk, res in zip(chunks, results) for p, cols in zip(chunk, res)}
+
+    names, parts = [], []
+    for p in paths:
+        if is_store(p):
+            for name, df in iter_store_episodes(p):
+                names.append(name)
+                parts.append({c: df[c].to_numpy(dtype=np.float64) for c in KPI_COLUMNS if c in df.columns})
+        else:
+            names.append(p)
+            parts.append(parsed[p])
+
+    keep = [i for i, cols in enumerate(parts) if cols and len(cols.get("tick", ())) > 0]
+    for i in sorted(set(range(len(parts))) - set(keep)):
+        print(f"[warn] Skipping empty episode {names[i]}")
+    names = [names[i] for i in keep]
+    parts = [parts[i] for i in keep]
+    lengths = np.array([len(cols["tick"]) for cols in parts], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    cols = {c: np.concatenate([cols.get(c, np.zeros(n)) for cols, n in zip(parts, lengths)])
+            for c in KPI_COLUMNS}
+    return names, offsets, cols
+
+
+# ----------------- KPIs -----------------
+
+def episode_kpis(names: List[str], offsets: np.ndarray, cols: Dict[str, np.ndarray],
+                 deficit_tol: float = 1.0) -> pd.DataFrame:
+    """
+    Per-episode KPIs with one segmented reduction per column:
+    irrigation/drainage summed over both fields (mm), deficit_days = field-days with
+    def*_mm > deficit_tol averaged over the two fields, nutrient export to the lake
+    (mg), lake withdrawal (L), growth_avg_pct on the last tick and the episode length.
+    """
+    starts = offsets[:-1]
+    seg = lambda x: np.add.reduceat(x, starts) if len(starts) else np.zeros(0)
+    deficit = (cols["defN_mm"] > deficit_tol).astype(float) + (cols["defS_mm"] > deficit_tol)
+    out = pd.DataFrame({
+        "episode": [episode_index(n) for n in names],
+        "n_ticks": np.diff(offsets),
+        "irrigation_mm": seg(cols["irrigateN_mm"] + cols["irrigateS_mm"]),
+        "drainage_mm": seg(cols["drainN_mm"] + cols["drainS_mm"]),
+        "deficit_days": seg(deficit) / 2.0,
+        "lake_withdrawn_L": seg(cols["delta_lake_L"]),
+        "N_to_lake_mg": seg(cols["delta_N_to_lake_mg"]),
+        "P_to_lake_mg": seg(cols["delta_P_to_lake_mg"]),
+        "final_growth_pct": cols["growth_avg_pct"][offsets[1:] - 1] if len(starts) else np.zeros(0),
+    }, index=pd.Index(names, name="path"))
+    return out
+
+
+def frame_kpis(frames: List[pd.DataFrame], deficit_tol: float = 1.0) -> pd.DataFrame:
+    """episode_kpis for in-memory episode frames (e.g. simulator output)."""
+    frames = [df for df in frames if len(df)]
+    offsets = np.concatenate([[0], np.cumsum([len(df) for df in frames])]).astype(np.int64)
+    cols = {c: np.concatenate([df[c].to_numpy(dtype=np.float64) for df in frames]) for c in KPI_COLUMNS}
+    return episode_kpis([f"ep{i}" for i in range(len(frames))], offsets, cols, deficit_tol)
+
+
+# ----------------- Paired statistics -----------------
+
+def pair_episodes(agent: pd.DataFrame, rule: pd.DataFrame) -> pd.DataFrame:
+    """Inner join on episode index (same NetLogo seed); columns suffixed _agent/_rule."""
+    a = agent.reset_index().set_index("episode")
+    r = rule.reset_index().set_index("episode")
+    paired = a.join(r, how="inner", lsuffix="_agent", rsuffix="_rule")
+    short = paired["n_ticks_agent"] != paired["n_ticks_rule"]
+    if short.any():
+        print(f"[warn] {int(short.sum())} pairs differ in length (truncated episodes?): "
+              f"{paired.index[short].tolist()[:10]}")
+    return paired.sort_index()
+
+
+def paired_stats(paired: pd.DataFrame) -> pd.DataFrame:
+    """Per KPI: means, mean/sd of agent - rule, 95% CI, paired t-test, agent win rate."""
+    from scipy import stats
+    rows = {}
+    n = len(paired)
+    for k, lower_better in KPIS.items():
+        a = paired[f"{k}_agent"].to_numpy(dtype=float)
+        r = paired[f"{k}_rule"].to_numpy(dtype=float)
+        d = a - r
+        sd = float(d.std(ddof=1)) if n > 1 else float("nan")
+        half = float(stats.t.ppf(0.975, n - 1) * sd / np.sqrt(n)) if n > 1 else float("nan")
+        if n > 1 and sd > 0:
+            t, p = stats.ttest_rel(a, r)
+        else:
+            t, p = float("nan"), float("nan")
+        better = (d < 0) if lower_better else (d > 0)
+        rows[k] = {
+            "agent_mean": a.mean(), "rule_mean": r.mean(),
+            "diff_mean": d.mean(), "diff_sd": sd,
+            "ci95_lo": d.mean() - half, "ci95_hi": d.mean() + half,
+            "t": float(t), "p": float(p),
+            "agent_better_pct": 100.0 * better.mean() if n else float("nan"),
+        }
+    out = pd.DataFrame.from_dict(rows, orient="index")
+    out.index.name = "kpi"
+    return out
+
+
+# ----------------- CLI -----------------
+
+def expand(pattern: str) -> List[str]:
+    return [pattern] if is_store(pattern) else sorted(glob.glob(pattern), key=lambda p: (episode_index(p), p))
+
+
+def main():
+    ap = argparse.ArgumentParser("Paired agent-vs-rule evaluation over logged (or simulated) episodes.")
+    ap.add_argument("--agent", default="data/paired/agent_ep*.csv",
+                    help="Agent episodes (CSV glob or episode store). data/eval/eval_agent_ep*.csv "
+                         "pairs with data/paired/rule_ep*.csv: both use NetLogo seed 12345 + i.")
+    ap.add_argument("--rule", default="data/paired/rule_ep*.csv", help="Rule episodes (CSV glob or store).")
+    ap.add_argument("--deficit_tol", type=float, default=1.0,
+                    help="mm below target_mm before a field-day counts as a deficit day.")
+    ap.add_argument("--workers", type=int, default=0, help="CSV parsing processes (0 = all cores).")
+    ap.add_argument("--out", default="reports/eval", help="Output prefix for _episodes.csv / _summary.csv / .json.")
+    args = ap.parse_args()
+
+    runs = {}
+    for label, pattern in (("agent", args.agent), ("rule", args.rule)):
+        paths = expand(pattern)
+        if not paths:
+            raise SystemExit(f"No {label} episodes match {pattern!r}")
+        runs[label] = episode_kpis(*load_runs(paths, args.workers), deficit_tol=args.deficit_tol)
+        print(f"[info] {label}: {len(runs[label]):,} episodes from {pattern}")
+
+    paired = pair_episodes(runs["agent"], runs["rule"])
+    if paired.empty:
+        raise SystemExit("No episode indices in common between agent and rule runs.")
+    summary = paired_stats(paired)
+
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    paired.to_csv(args.out + "_episodes.csv")
+    summary.to_csv(args.out + "_summary.csv")
+    with open(args.out + ".json", "w", encoding="utf-8") as f:
+        json.dump({"agent": args.agent, "rule": args.rule, "n_pairs": len(paired),
+                   "deficit_tol": args.deficit_tol,
+                   "summary": summary.reset_index().to_dict(orient="records")}, f, indent=2)
+
+    print(f"=== Paired evaluation: {len(paired):,} episodes (agent - rule) ===")
+    with pd.option_context("display.float_format", "{:,.3f}".format, "display.width", 160):
+        print(summary.to_string())
+    print(f"Saved -> {args.out}_episodes.csv, {args.out}_summary.csv, {args.out}.json")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+from typing import Any, Dict, Iterable, Optional
+
+import numpy as np
+
+from episode_store import file_sha1
+
+# ----------------- Layout -----------------
+#
+# <dir>/hashes.json        sha1 of model files, reused while (size, mtime) are unchanged
+# <dir>/outputs.json       per written output: {key, size, mtime} of the export that wrote it
+# <dir>/<key>.npy          one (stage, month) shard: clipped/rounded action values
+# <dir>/<key>.csv          the same shard rendered as CSV rows (no header)
+#
+# A shard key hashes everything its rows depend on (model bytes, the meta fields
+# the exporter reads, the shard's grid spec and the exporter's format version),
+# so entries never need invalidating: a changed input is simply a new key.
+# Unused entries age out by access time once the directory exceeds max_mb.
+
+HASHES = "hashes.json"
+OUTPUTS = "outputs.json"
+
+
+def spec_key(spec: Dict[str, Any]) -> str:
+    """sha1 of a JSON-able spec (key order and int/float spelling do not matter)."""
+    blob = json.dumps(spec, sort_keys=True, default=float, separators=(",", ":"))
+    return hashlib.sha1(blob.encode("utf-8")).hexdigest()
+
+
+def _read_json(path: str) -> Dict[str, Any]:
+    if not os.path.isfile(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_json(path: str, data: Dict[str, Any]) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+class ExportCache:
+    """Content-addressed shard store for the policy exporters (see Layout)."""
+
+    def __init__(self, root: str, max_mb: float = 2000.0):
+        self.root = root
+        self.max_bytes = int(float(max_mb) * 1e6)
+        os.makedirs(root, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    # ---- inputs ----
+
+    def model_sha1(self, path: str) -> str:
+        """File sha1, memoized on (size, mtime) so a multi-MB model is hashed once."""
+        hashes = _read_json(os.path.join(self.root, HASHES))
+        key = os.path.abspath(path)
+        st = os.stat(path)
+        old = hashes.get(key)
+        if old and old["size"] == st.st_size and old["mtime"] == st.st_mtime:
+            return old["sha1"]
+        digest = file_sha1(path)
+        hashes[key] = {"size": st.st_size, "mtime": st.st_mtime, "sha1": digest}
+        _write_json(os.path.join(self.root, HASHES), hashes)
+        return digest
+
+    # ---- shards ----
+
+    def _path(self, key: str, ext: str) -> str:
+        return os.path.join(self.root, key + ext)
+
+    def has(self, key: str) -> bool:
+        return os.path.isfile(self._path(key, ".npy")) and os.path.isfile(self._path(key, ".csv"))
+
+    def get_values(self, key: str) -> np.ndarray:
+        return np.load(self._path(key, ".npy"))
+
+    def get_csv(self, key: str) -> bytes:
+        with open(self._path(key, ".csv"), "rb") as f:
+            return f.read()
+
+    def put(self, key: str, values: np.ndarray, csv_rows: bytes) -> None:
+        """Store one shard (written to temp names and renamed, so readers never see half a shard)."""
+        for ext, write in ((".npy", lambda f: np.save(f, np.ascontiguousarray(values))),
+                           (".csv", lambda f: f.write(csv_rows))):
+            tmp = self._path(key, ext + ".tmp")
+            with open(tmp, "wb") as f:
+                write(f)
+            os.replace(tmp, self._path(key, ext))
+
+    def touch(self, keys: Iterable[str]) -> None:
+        for k in keys:
+            for ext in (".npy", ".csv"):
+                if os.path.isfile(self._path(k, ext)):
+                    os.utime(self._path(k, ext))
+
+    def prune(self, keep: Iterable[str] = ()) -> int:
+        """Drop least recently used shards until the directory fits max_bytes; returns files removed."""
+        keep = set(keep)
+        entries = []
+        for name in os.listdir(self.root):
+            stem, ext = os.path.splitext(name)
+            if ext in (".npy", ".csv") and stem not in keep:
+                p = os.path.join(self.root, name)
+                st = os.stat(p)
+                entries.append((st.st_mtime, st.st_size, p))
+        total = sum(sz for _, sz, _ in entries) + sum(
+            os.path.getsize(self._path(k, e)) for k in keep for e in (".npy", ".csv") if os.path.isfile(self._path(k, e)))
+        removed = 0
+        for _, sz, p in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(p)
+            total -= sz
+            removed += 1
+        return removed
+
+    # ---- outputs ----
+
+    def output_current(self, path: str, key: str) -> bool:
+        """True when `path` is still the file an export with `key` wrote (not edited or replaced since)."""
+        rec = _read_json(os.path.join(self.root, OUTPUTS)).get(os.path.abspath(path))
+        if not rec or rec["key"] != key or not os.path.isfile(path):
+            return False
+        st = os.stat(path)
+        return rec["size"] == st.st_size and rec["mtime"] == st.st_mtime
+
+    def record_output(self, path: str, key: str) -> None:
+        outputs = _read_json(os.path.join(self.root, OUTPUTS))
+        st = os.stat(path)
+        outputs[os.path.abspath(path)] = {"key": key, "size": st.st_size, "mtime": st.st_mtime}
+        _write_json(os.path.join(self.root, OUTPUTS), outputs)
+
+
+def open_cache(root: Optional[str], max_mb: float = 2000.0) -> Optional[ExportCache]:
+    """ExportCache at `root`, or None when caching is off ("" / None)."""
+    return ExportCache(root, max_mb) if root else None
@@ -1,14 +1,19 @@
 #!/usr/bin/env python3
 import argparse
+import contextlib
 import json
 from pathlib import Path
-from itertools import product
-from typing import List, Dict, Any
+from typing import Iterator, List, Dict, Any, Optional
 
 import joblib
 import numpy as np
 import pandas as pd
 
+import profiling
+from export_cache import ExportCache, open_cache, spec_key
+from parallel_predict import PredictPool
+from policy import SHARD_INDEX, PolicyShardWriter, save_policy_shards
+
 # ---- Defaults that mirror your NetLogo + sensible export grid ----------------
 
 TARGET_BY_STAGE_DEFAULT = [15, 35, 25, 0, 25, 25, 25, 0]  # stage 0..7
@@ -34,6 +39,10 @@ OPTIONAL_DROP_ORDER = [
     "rain_mm","loss_mm",
 ]
 
+# bump when the rows written for a given model/meta/grid change (shards cached by older code are ignored)
+EXPORT_FORMAT = 1
+KEY_COLS = ["stage","month","defN_mm","defS_mm","canal_mm","pool_ratio"]
+
 # -----------------------------------------------------------------------------
 
 def parse_args():
@@ -42,6 +51,10 @@ def parse_args():
     p.add_argument("--meta",  required=True, help="Path to models/bc_meta.json")
     p.add_argument("--out",   required=True, help="Path to models/policy_table.csv")
     p.add_argument("--batch_size", type=int, default=200_000)
+    p.add_argument("--workers", type=int, default=1,
+                   help="Prediction processes (each loads the model once).")
+    p.add_argument("--no_compress", action="store_true",
+                   help="Predict every grid row instead of one row per tree-threshold cell.")
 
     # grid controls
     p.add_argument("--stages",      nargs="*", type=int,   default=DEFAULT_STAGES)
@@ -53,6 +66,19 @@ def parse_args():
 
     # duplicate handling (e.g., if you include multiple norm_days)
     p.add_argument("--dedupe", choices=["first","median","mean","none"], default="first")
+    p.add_argument("--stream", action="store_true",
+                   help="Generate/predict/write the grid in --batch_size chunks (bounded memory). "
+                        "The cached export (default) always streams shard by shard.")
+    p.add_argument("--profile", action="store_true",
+                   help=f"Time/memory per stage -> <out>.profile.json (or set {profiling.PROFILE_ENV}=1).")
+    p.add_argument("--shards", choices=["stage", "stage_month"], default=None,
+                   help="Also write compact NetLogo shards (one CSV per stage or per (stage, month) + index.csv).")
+    p.add_argument("--shard_dir", default=None, help="Shard directory (default: <out stem>_shards next to --out).")
+    p.add_argument("--shard_decimals", type=int, default=2, help="Actions stored as round(mm * 10**d) integers.")
+    p.add_argument("--cache_dir", default="cache/export",
+                   help="Export cache: per-(stage, month) shards keyed by model bytes + meta + grid (\"\" = off).")
+    p.add_argument("--cache_max_mb", type=float, default=2000.0)
+    p.add_argument("--no_cache", action="store_true", help="Recompute everything (same as --cache_dir \"\").")
     return p.parse_args()
 
 def load_meta(meta_path: Path) -> Dict[str, Any]:
@@ -93,34 +119,62 @@ def align_features_to_model(feature_cols: List[str], model) -> List[str]:
         print(f"[warn] Dropped extra features to match model: {removed}")
     return pruned
 
+def grid_frame(stage: np.ndarray, month: np.ndarray, norm_day: np.ndarray,
+               defN: np.ndarray, defS: np.ndarray, canal: np.ndarray, pool_ratio: np.ndarray,
+               target_by_stage: List[float]) -> pd.DataFrame:
+    """Vectorized grid rows (same columns as one record per grid point)."""
+    n = len(stage)
+    tgt = np.asarray(target_by_stage, dtype=float)[stage.astype(int)]
+    pr = pool_ratio.astype(float)
+    return pd.DataFrame({
+        "stage": stage.astype(int),
+        "month": month.astype(int),
+        "norm_day": norm_day.astype(float),
+        "defN_mm": defN.astype(float),
+        "defS_mm": defS.astype(float),
+        "canal_mm": canal.astype(float),
+        "pool_ratio": pr,
+        "target_mm": tgt,
+        "north_mm": np.maximum(tgt - defN, 0.0),
+        "south_mm": np.maximum(tgt - defS, 0.0),
+        # optional/nominal features (only used if the model expects them)
+        "pool_mm": pr * POOL_MM_SCALE,
+        "lake_mm": np.full(n, NOMINAL_LAKE_MM),
+        "poolN_mgL":  np.full(n, NOMINAL_WQ), "poolP_mgL":  np.full(n, NOMINAL_WQ),
+        "canalN_mgL": np.full(n, NOMINAL_WQ), "canalP_mgL": np.full(n, NOMINAL_WQ),
+        "lakeN_mgL":  np.full(n, NOMINAL_WQ), "lakeP_mgL":  np.full(n, NOMINAL_WQ),
+        "rain_mm": np.zeros(n), "loss_mm": np.zeros(n),  # new weather features default to 0
+    })
+
 def build_grid(args, target_by_stage: List[float]) -> pd.DataFrame:
-    recs = []
-    for st, mo, nd, dN, dS, canal, pr in product(
-        args.stages, args.months, args.norm_days, args.def_bins, args.def_bins, args.canal_bins, args.pool_ratios
-    ):
-        tgt = float(target_by_stage[int(st)])
-        north_mm = max(tgt - float(dN), 0.0)
-        south_mm = max(tgt - float(dS), 0.0)
-        recs.append({
-            "stage": int(st),
-            "month": int(mo),
-            "norm_day": float(nd),
-            "defN_mm": float(dN),
-            "defS_mm": float(dS),
-            "canal_mm": float(canal),
-            "pool_ratio": float(pr),
-            "target_mm": tgt,
-            "north_mm": north_mm,
-            "south_mm": south_mm,
-            # optional/nominal features (only used if the model expects them)
-            "pool_mm": float(pr) * POOL_MM_SCALE,
-            "lake_mm": NOMINAL_LAKE_MM,
-            "poolN_mgL":  NOMINAL_WQ, "poolP_mgL":  NOMINAL_WQ,
-            "canalN_mgL": NOMINAL_WQ, "canalP_mgL": NOMINAL_WQ,
-            "lakeN_mgL":  NOMINAL_WQ, "lakeP_mgL":  NOMINAL_WQ,
-            "rain_mm": 0.0, "loss_mm": 0.0,  # new weather features default to 0
-        })
-    return pd.DataFrame.from_records(recs)
+    axes = [np.asarray(a) for a in (args.stages, args.months, args.norm_days, args.def_bins,
+                                    args.def_bins, args.canal_bins, args.pool_ratios)]
+    # same row order as itertools.product over the axes
+    idx = np.unravel_index(np.arange(int(np.prod([len(a) for a in axes]))), [len(a) for a in axes])
+    st, mo, nd, dN, dS, canal, pr = (a[i] for a, i in zip(axes, idx))
+    return grid_frame(st, mo, nd, dN, dS, canal, pr, target_by_stage)
+
+def stream_axes(args) -> List[np.ndarray]:
+    """
+    Axes for the streaming export, in output sort order.
+    Key axes are sorted/unique; norm_day is innermost (as given) so all rows of one
+    output key are adjacent and never straddle a chunk boundary.
+    """
+    keys = [np.unique(np.asarray(a)) for a in (args.stages, args.months, args.def_bins,
+                                               args.def_bins, args.canal_bins, args.pool_ratios)]
+    return keys + [np.asarray(args.norm_days, dtype=float)]
+
+def iter_grid_chunks(args, target_by_stage: List[float], chunk_rows: int) -> Iterator[pd.DataFrame]:
+    """Yield the grid lazily in index-space chunks of whole output keys."""
+    axes = stream_axes(args)
+    shape = [len(a) for a in axes]
+    k = shape[-1]
+    step = max(k, (max(1, int(chunk_rows)) // k) * k)
+    total = int(np.prod(shape))
+    for start in range(0, total, step):
+        idx = np.unravel_index(np.arange(start, min(start + step, total)), shape)
+        st, mo, dN, dS, canal, pr, nd = (a[i] for a, i in zip(axes, idx))
+        yield grid_frame(st, mo, nd, dN, dS, canal, pr, target_by_stage)
 
 def add_stage_flags(df: pd.DataFrame, drain_stages: List[int], flood_stages: List[int]) -> pd.DataFrame:
     df = df.copy()
@@ -129,15 +183,6 @@ def add_stage_flags(df: pd.DataFrame, drain_stages: List[int], flood_stages: Lis
     df["is_flood_stage"] = np.isin(st, np.asarray(flood_stages, dtype=int)).astype(float)
     return df
 
-def predict_in_batches(model, X: np.ndarray, batch_size: int) -> np.ndarray:
-    preds = []
-    n = X.shape[0]
-    b = max(1, int(batch_size))
-    for s in range(0, n, b):
-        e = min(s + b, n)
-        preds.append(model.predict(X[s:e]))
-    return np.vstack(preds)
-
 def clip_actions(df: pd.DataFrame) -> pd.DataFrame:
     out = df.copy()
     for c in ("irrigateN_mm","irrigateS_mm"):
@@ -159,8 +204,214 @@ def dedupe(out: pd.DataFrame, how: str) -> pd.DataFrame:
           {"irrigateN_mm":"mean","irrigateS_mm":"mean","drainN_mm":"mean","drainS_mm":"mean"}
     return out.groupby(keys, as_index=False).agg(agg).reset_index(drop=True)
 
+def predict_table(pool: PredictPool, grid: pd.DataFrame, features: List[str], actions: List[str],
+                  batch_size: int) -> pd.DataFrame:
+    """Predict, clip and assemble the (keys + actions) table for a grid frame."""
+    # ensure all expected features exist; fill missing with zeros (rare)
+    for f in features:
+        if f not in grid.columns:
+            grid[f] = 0.0
+
+    X = grid[features].to_numpy(dtype=float, copy=False)
+    with profiling.span("predict", rows=len(X)):
+        Y = pool.predict(X, batch_size)
+    if Y.ndim == 1:
+        Y = Y.reshape(-1, 1)
+    if Y.shape[1] != len(actions):
+        raise ValueError(f"Pred target dim {Y.shape[1]} != len(actions) {len(actions)}")
+
+    ydf = pd.DataFrame(Y, columns=actions)
+    with profiling.span("clip_actions", rows=len(ydf)):
+        ydf = clip_actions(ydf)
+
+    return pd.concat([
+        grid[["stage","month","defN_mm","defS_mm","canal_mm","pool_ratio"]].reset_index(drop=True),
+        ydf.reset_index(drop=True)
+    ], axis=1)
+
+def export_table(args, pool: PredictPool, features: List[str], actions: List[str],
+                 target_by_stage: List[float], drain_stages: List[int], flood_stages: List[int],
+                 out_path: Path) -> np.ndarray:
+    """Build the whole grid in memory, predict, dedupe/sort and write it; returns the action values."""
+    # grid
+    with profiling.span("build_grid") as sp:
+        grid = build_grid(args, target_by_stage)
+        sp.rows = len(grid)
+    with profiling.span("add_stage_flags", rows=len(grid)):
+        grid = add_stage_flags(grid, drain_stages, flood_stages)
+    print(f"[info] actions: {actions}")
+    print(f"[info] Grid rows: {len(grid):,}, X.shape: {(len(grid), len(features))}")
+
+    out = predict_table(pool, grid, features, actions, args.batch_size)
+
+    with profiling.span("dedupe_sort", rows=len(out)):
+        out = dedupe(out, args.dedupe).sort_values(
+            by=["stage","month","defN_mm","defS_mm","canal_mm","pool_ratio"]
+        ).reset_index(drop=True)
+
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    with profiling.span("to_csv", rows=len(out)):
+        out.to_csv(out_path, index=False)
+
+    st_dom = sorted(out["stage"].unique().tolist())
+    print(f"[ok] Wrote policy table with {len(out):,} rows -> {out_path}")
+    print(f"Stage domain in CSV: {st_dom}")
+    return out[actions].to_numpy(dtype=np.float32)
+
+def export_streaming(args, pool: PredictPool, features: List[str], actions: List[str],
+                     target_by_stage: List[float], drain_stages: List[int], flood_stages: List[int],
+                     out_path: Path) -> None:
+    """
+    Predict the grid chunk by chunk and append each chunk to the CSV.
+    Peak memory is bounded by --batch_size; rows come out already sorted by key.
+    """
+    total = int(np.prod([len(a) for a in stream_axes(args)]))
+    print(f"[info] actions: {actions}")
+    print(f"[info] Streaming {total:,} grid rows in chunks of ~{args.batch_size:,}")
+
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    n_rows, st_dom = 0, set()
+    with open(out_path, "w", newline="", encoding="utf-8") as fh:
+        for grid in iter_grid_chunks(args, target_by_stage, args.batch_size):
+            with profiling.span("chunk", rows=len(grid)):
+                grid = add_stage_flags(grid, drain_stages, flood_stages)
+                out = dedupe(predict_table(pool, grid, features, actions, args.batch_size), args.dedupe)
+                with profiling.span("to_csv", rows=len(out)):
+                    out.to_csv(fh, index=False, header=(n_rows == 0))
+            n_rows += len(out)
+            st_dom.update(out["stage"].unique().tolist())
+
+    print(f"[ok] Wrote policy table with {n_rows:,} rows -> {out_path}")
+    print(f"Stage domain in CSV: {sorted(st_dom)}")
+
+def shard_spec(args, meta: Dict[str, Any], model_sha1: str, stage: int, month: int) -> Dict[str, Any]:
+    """Inputs of one (stage, month) shard; meta enters only through the fields this stage uses."""
+    target = meta.get("target_by_stage", TARGET_BY_STAGE_DEFAULT)
+    return {
+        "exporter": "export_policy_grid", "format": EXPORT_FORMAT, "model": model_sha1,
+        "features": meta["features"], "actions": meta["actions"],
+        "stage": int(stage), "month": int(month), "target": float(target[int(stage)]),
+        "is_drain": int(stage) in meta.get("drain_stages", [3, 7]),
+        "is_flood": int(stage) in meta.get("flood_stages", [1, 2, 5]),
+        "norm_days": list(args.norm_days), "def_bins": list(args.def_bins),
+        "canal_bins": list(args.canal_bins), "pool_ratios": list(args.pool_ratios),
+        "dedupe": args.dedupe,
+    }
+
+def grid_shards(args) -> List[tuple]:
+    """(stage, month) pairs in output order."""
+    return [(int(s), int(m)) for s in np.unique(args.stages) for m in np.unique(args.months)]
+
+def shard_axes(args) -> Dict[str, List[float]]:
+    """Sorted key axes of the deduplicated table (what the NetLogo shards index)."""
+    return {k: np.unique(np.asarray(a, dtype=float)).tolist() for k, a in
+            zip(KEY_COLS, (args.stages, args.months, args.def_bins, args.def_bins, args.canal_bins, args.pool_ratios))}
+
+def predict_shards(pool: PredictPool, args, shards: List[tuple], part: List[int], features: List[str],
+                   actions: List[str], meta: Dict[str, Any]) -> Dict[int, tuple]:
+    """Predict the (stage, month) shards `part` in one batch; {shard: (values, csv rows)}."""
+    target_by_stage = meta.get("target_by_stage", TARGET_BY_STAGE_DEFAULT)
+    grids = []
+    for i in part:
+        a = argparse.Namespace(**{**vars(args), "stages": [shards[i][0]], "months": [shards[i][1]]})
+        grids.append(build_grid(a, target_by_stage))
+    per = len(grids[0])
+    grid = add_stage_flags(pd.concat(grids, ignore_index=True),
+                           meta.get("drain_stages", [3, 7]), meta.get("flood_stages", [1, 2, 5]))
+    out = predict_table(pool, grid, features, actions, args.batch_size)
+    done = {}
+    for j, i in enumerate(part):
+        with profiling.span("dedupe_sort_csv", rows=per):
+            shard = dedupe(out.iloc[j * per:(j + 1) * per].reset_index(drop=True), args.dedupe)
+            shard = shard.sort_values(by=KEY_COLS).reset_index(drop=True)
+            text = shard.to_csv(index=False, header=False).encode("utf-8")
+        done[i] = (shard[actions].to_numpy(dtype=np.float32), text)
+    return done
+
+def export_cached(args, cache: ExportCache, keys: List[str], model_path: Path, meta: Dict[str, Any],
+                  out_path: Path, shard_dir: Optional[Path] = None) -> None:
+    """
+    Shard-wise export in output order: cached shards are copied from the cache as
+    CSV rows; a missing shard is predicted together with the next missing ones
+    (about --batch_size rows), stored, and written before moving on. At most one
+    such group, plus with --shards one NetLogo shard of values, is held at a time,
+    so memory stays bounded as with --stream. Output equals export_table's.
+    """
+    shards = grid_shards(args)
+    todo = [i for i, k in enumerate(keys) if not cache.has(k)]
+    print(f"[info] {len(shards) - len(todo)} of {len(shards)} (stage, month) shards cached, {len(todo)} to export")
+
+    actions = meta["actions"]
+    axes = shard_axes(args)
+    per_key = int(np.prod([len(v) for v in list(axes.values())[2:]]))
+    netlogo = PolicyShardWriter(str(shard_dir), axes, actions, args.shards, args.shard_decimals) if shard_dir else None
+    block: List[np.ndarray] = []        # values of the NetLogo shard being filled
+
+    with contextlib.ExitStack() as stack:
+        if todo:
+            with profiling.span("load_model"):
+                model = joblib.load(model_path)
+            features = align_features_to_model(meta["features"], model)
+            print(f"[info] model.n_features_in_: {getattr(model, 'n_features_in_', 'unknown')}")
+            print(f"[info] features used: {features} (len={len(features)})")
+            pool = stack.enter_context(PredictPool(model, model_path, args.workers, compress=not args.no_compress))
+            per = int(np.prod([len(a) for a in (args.norm_days, args.def_bins, args.def_bins,
+                                                args.canal_bins, args.pool_ratios)]))
+            group = max(1, args.batch_size // max(per, 1))
+
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = out_path.with_name(out_path.name + ".tmp")
+        n_rows, next_todo, fresh = 0, 0, {}
+        with open(tmp, "wb") as fh:
+            fh.write((",".join(KEY_COLS + actions) + "\n").encode("utf-8"))
+            for i, key in enumerate(keys):
+                if next_todo < len(todo) and todo[next_todo] == i:
+                    if i not in fresh:
+                        part = todo[next_todo:next_todo + group]
+                        fresh = predict_shards(pool, args, shards, part, features, actions, meta)
+                        for j in part:
+                            cache.put(keys[j], *fresh[j])
+                    v, text = fresh.pop(i)
+                    next_todo += 1
+                else:
+                    v, text = cache.get_values(key), cache.get_csv(key)
+                with profiling.span("write_shard", rows=len(v)):
+                    fh.write(text)
+                n_rows += len(v)
+                if netlogo is not None:
+                    if len(v) != per_key:
+                        raise ValueError(f"--shards needs one row per grid key ({per_key:,} per (stage, month)), "
+                                         f"shard has {len(v):,}; use --dedupe first/median/mean")
+                    block.append(v)
+                    if args.shards == "stage_month" or len(block) == len(axes["month"]):
+                        with profiling.span("save_shards", rows=sum(len(b) for b in block)):
+                            netlogo.add(np.concatenate(block))
+                        block = []
+        if todo:
+            print(f"[info] Model evaluated on {pool.n_predicted:,} of {pool.n_rows:,} grid rows")
+    tmp.replace(out_path)
+    print(f"[ok] Wrote policy table with {n_rows:,} rows -> {out_path}")
+    print(f"Stage domain in CSV: {sorted({s for s, _ in shards})}")
+    if netlogo is not None:
+        files = netlogo.close()
+        print(f"[ok] Wrote {len(files)} NetLogo shards (per {args.shards}) -> {shard_dir}/")
+
+def write_netlogo_shards(args, actions: List[str], values: np.ndarray, shard_dir: Path) -> None:
+    """Dense per-stage (or per (stage, month)) shards of the sorted, deduplicated table."""
+    axes = shard_axes(args)
+    n = int(np.prod([len(v) for v in axes.values()]))
+    if len(values) != n:
+        raise ValueError(f"--shards needs one row per grid key ({n:,}), the table has {len(values):,}; "
+                         f"use --dedupe first/median/mean")
+    with profiling.span("save_shards", rows=n):
+        files = save_policy_shards(str(shard_dir), axes, actions, values, per=args.shards,
+                                   decimals=args.shard_decimals)
+    print(f"[ok] Wrote {len(files)} NetLogo shards (per {args.shards}) -> {shard_dir}/")
+
+
 def main():
     args = parse_args()
+    profiling.start("export_policy_grid --stream" if args.stream else "export_policy_grid", args.profile)
 
     model_path = Path(args.model)
     meta_path  = Path(args.meta)
@@ -168,8 +419,34 @@ def main():
     if not model_path.exists(): raise FileNotFoundError(model_path)
     if not meta_path.exists():  raise FileNotFoundError(meta_path)
 
-    model = joblib.load(model_path)
-    meta  = load_meta(meta_path)
+    meta = load_meta(meta_path)
+    shard_dir = Path(args.shard_dir) if args.shard_dir else out_path.with_name(out_path.stem + "_shards")
+    cache: Optional[ExportCache] = None if args.no_cache else open_cache(args.cache_dir, args.cache_max_mb)
+    if args.shards and args.stream and cache is None:
+        raise ValueError("--shards with --stream needs the export cache (drop --no_cache or --stream)")
+    if args.stream and cache is not None:
+        print("[info] --stream: the cached export already writes shard by shard with bounded memory")
+    if cache is not None:
+        with profiling.span("cache_keys"):
+            sha = cache.model_sha1(str(model_path))
+            keys = [spec_key(shard_spec(args, meta, sha, s, m)) for s, m in grid_shards(args)]
+        netlogo = [args.shards, args.shard_decimals] if args.shards else None
+        export_key = spec_key({"shards": keys, "netlogo": netlogo})
+        outputs = [str(out_path)] + ([str(shard_dir / SHARD_INDEX)] if args.shards else [])
+        if all(cache.output_current(p, export_key) for p in outputs):
+            cache.touch(keys)
+            print(f"[ok] {out_path} is up to date ({len(keys)} cached shards, model and grid unchanged)")
+        else:
+            export_cached(args, cache, keys, model_path, meta, out_path, shard_dir if args.shards else None)
+            for p in outputs:
+                cache.record_output(p, export_key)
+            cache.touch(keys)
+            cache.prune(keep=keys)
+        profiling.finish(str(out_path.with_suffix(".profile.json")))
+        return
+
+    with profiling.span("load_model"):
+        model = joblib.load(model_path)
 
     features: List[str] = meta["features"]
     actions:  List[str] = meta["actions"]
@@ -182,46 +459,16 @@ def main():
     drain_stages    = meta.get("drain_stages", [3, 7])
     flood_stages    = meta.get("flood_stages", [1, 2, 5])
 
-    # grid
-    grid = build_grid(args, target_by_stage)
-    grid = add_stage_flags(grid, drain_stages, flood_stages)
-
-    # ensure all expected features exist; fill missing with zeros (rare)
-    for f in features:
-        if f not in grid.columns:
-            grid[f] = 0.0
-
-    X = grid[features].to_numpy(dtype=float, copy=False)
     print(f"[info] model.n_features_in_: {getattr(model, 'n_features_in_', 'unknown')}")
     print(f"[info] features used: {features} (len={len(features)})")
-    print(f"[info] actions: {actions}")
-    print(f"[info] Grid rows: {len(grid):,}, X.shape: {X.shape}")
 
-    # predict
-    Y = predict_in_batches(model, X, args.batch_size)
-    if Y.ndim == 1:
-        Y = Y.reshape(-1, 1)
-    if Y.shape[1] != len(actions):
-        raise ValueError(f"Pred target dim {Y.shape[1]} != len(actions) {len(actions)}")
-
-    ydf = pd.DataFrame(Y, columns=actions)
-    ydf = clip_actions(ydf)
-
-    out = pd.concat([
-        grid[["stage","month","defN_mm","defS_mm","canal_mm","pool_ratio"]].reset_index(drop=True),
-        ydf.reset_index(drop=True)
-    ], axis=1)
-
-    out = dedupe(out, args.dedupe).sort_values(
-        by=["stage","month","defN_mm","defS_mm","canal_mm","pool_ratio"]
-    ).reset_index(drop=True)
-
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    out.to_csv(out_path, index=False)
-
-    st_dom = sorted(out["stage"].unique().tolist())
-    print(f"[ok] Wrote policy table with {len(out):,} rows -> {out_path}")
-    print(f"Stage domain in CSV: {st_dom}")
+    with PredictPool(model, model_path, args.workers, compress=not args.no_compress) as pool:
+        export = export_streaming if args.stream else export_table
+        values = export(args, pool, features, actions, target_by_stage, drain_stages, flood_stages, out_path)
+        print(f"[info] Model evaluated on {pool.n_predicted:,} of {pool.n_rows:,} grid rows")
+    if args.shards:
+        write_netlogo_shards(args, actions, values, shard_dir)
+    profiling.finish(str(out_path.with_suffix(".profile.json")))
 
 if __name__ == "__main__":
     main()
@@ -2,13 +2,19 @@
 import argparse
 import json
 import os
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Sequence, Tuple
 
 import numpy as np
 import pandas as pd
 from joblib import load
 import yaml
 
+import profiling
+from export_cache import ExportCache, open_cache, spec_key
+from parallel_predict import PredictPool
+from policy import (SHARD_INDEX, AdaptivePolicyTable, corner_bits, save_adaptive_table, save_policy_shards,
+                    save_policy_table_bin)
+
 
 # ----------------- I/O -----------------
 
@@ -17,11 +23,13 @@ def read_config(path: str) -> Dict[str, Any]:
         return yaml.safe_load(f)
 
 
-def load_model_and_meta(cfg: Dict[str, Any]):
-    model = load(cfg["bc_model_path"])
+def load_meta(cfg: Dict[str, Any]) -> Dict[str, Any]:
     with open(cfg["meta_file"], "r", encoding="utf-8") as f:
-        meta = json.load(f)
-    return model, meta
+        return json.load(f)
+
+
+def load_model_and_meta(cfg: Dict[str, Any]):
+    return load(cfg["bc_model_path"]), load_meta(cfg)
 
 
 # ----------------- Grid -----------------
@@ -140,53 +148,456 @@ def clip_and_round(y: np.ndarray, actions: List[str], limits: Dict[str, float])
     return pd.DataFrame(out)
 
 
-# ----------------- Main -----------------
-
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--config", "-c", default="config.yaml")
-    ap.add_argument("--batch_size", type=int, default=200_000,
-                    help="Prediction batch size to control memory/throughput.")
-    args = ap.parse_args()
+# ----------------- Adaptive refinement -----------------
+
+# Refined axes; stage and month stay categorical (one kd-tree per (stage, month) and coarse cell).
+ADAPTIVE_AXES = ["defN_mm", "defS_mm", "canal_mm", "pool_ratio"]
+ADAPTIVE_DEFAULTS = {
+    "tol": 0.5,
+    "coarse": {"defN_mm": [0, 10, 20, 40], "defS_mm": [0, 10, 20, 40],
+               "canal_mm": [0, 25, 50, 100], "pool_ratio": [0.0, 0.5, 1.0]},
+    "min_width": {"defN_mm": 5.0, "defS_mm": 5.0, "canal_mm": 12.5, "pool_ratio": 0.125},
+    "max_leaves": 2_000_000,
+    "batch_cells": 50_000,
+    "verify_rounds": 4,
+    "n_verify": 200_000,
+    "n_check": 200_000,
+    "seed": 0,
+    "strict": False,
+    "out": "models/policy_adaptive",
+}
+_BITS = corner_bits(len(ADAPTIVE_AXES))                          # (16, 4)
+# per axis k: the 8 corners on the lower face of k (their partner on the upper face is c + 2**k)
+_FACE_LO = [np.flatnonzero(~_BITS[:, k]) for k in range(len(ADAPTIVE_AXES))]
+
+
+def predict_states(pool: PredictPool, meta: Dict[str, Any], stage: np.ndarray, month: np.ndarray,
+                   X: np.ndarray, batch_size: int) -> np.ndarray:
+    """Clipped model actions (float32) at table-convention stage/month and ADAPTIVE_AXES points X."""
+    grid = pd.DataFrame({"stage": stage, "month": month, "norm_day": 0.5,
+                         **{a: X[:, k] for k, a in enumerate(ADAPTIVE_AXES)}})
+    Y = pool.predict(synth_features_df(grid, meta).to_numpy(dtype=float), batch_size)
+    limits = meta.get("limits", {"irrigate_max": 5.0, "drain_max": 3.0})
+    return clip_and_round(Y, meta["actions"], limits).to_numpy(dtype=np.float32)
 
-    cfg = read_config(args.config)
-    model, meta = load_model_and_meta(cfg)
 
-    # Build grid (stage 0..7 for the TABLE)
+def adaptive_refine(pool: PredictPool, meta: Dict[str, Any], acfg: Dict[str, Any], batch_size: int,
+                    stages: Sequence[int] = range(8), months: Sequence[int] = range(1, 13)
+                    ) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+    """
+    Start from the coarse grid of each (stage, month) and bisect cells while the
+    leaf value (the model's action at the cell centre) is more than `tol` off the
+    model at any of the 16 corners, until a split would go below `min_width`.
+    The split axis is the one with the largest corner-to-corner change along it
+    (widest relative to min_width otherwise). The forest is piecewise constant,
+    so a cell value beats interpolating across a step.
+
+    Corners miss steps that cut a cell without reaching them, so the tree is then
+    checked `verify_rounds` times on `n_verify` fresh random states and every
+    leaf that misses `tol` there is split again. Returns the kd-tree / leaf arrays
+    for save_adaptive_table and the stats of the last check (leaves still over
+    tol, and how many of them are already at min_width).
+    """
+    stages, months = np.asarray(stages), np.asarray(months)
+    coarse = [np.asarray(acfg["coarse"][a], dtype=float) for a in ADAPTIVE_AXES]
+    min_w = np.array([float(acfg["min_width"][a]) for a in ADAPTIVE_AXES])
+    tol, max_leaves, chunk = float(acfg["tol"]), int(acfg["max_leaves"]), int(acfg["batch_cells"])
+    n_act = len(meta["actions"])
+    D, cshape = len(ADAPTIVE_AXES), [len(e) - 1 for e in coarse]
+
+    # coarse vertices, evaluated once per (stage, month)
+    vidx = np.stack(np.unravel_index(np.arange(int(np.prod([len(e) for e in coarse]))),
+                                     [len(e) for e in coarse]), axis=1)
+    verts = np.column_stack([coarse[k][vidx[:, k]] for k in range(D)])
+    sm = np.stack(np.unravel_index(np.arange(len(stages) * len(months)), (len(stages), len(months))), axis=1)
+    Vv = predict_states(pool, meta, np.repeat(stages[sm[:, 0]], len(verts)), np.repeat(months[sm[:, 1]], len(verts)),
+                        np.tile(verts, (len(sm), 1)), batch_size)
+    Vv = Vv.reshape([len(sm)] + [len(e) for e in coarse] + [n_act])
+
+    # one root cell per (stage, month, coarse cell)
+    cidx = np.stack(np.unravel_index(np.arange(int(np.prod(cshape))), cshape), axis=1)
+    cell_sm = np.repeat(np.arange(len(sm)), len(cidx))
+    cell_c = np.tile(cidx, (len(sm), 1))
+    lo = np.column_stack([coarse[k][cell_c[:, k]] for k in range(D)])
+    hi = np.column_stack([coarse[k][cell_c[:, k] + 1] for k in range(D)])
+    corner = cell_c[:, None, :] + _BITS[None].astype(int)                   # (n, 16, D)
+    V = Vv[(cell_sm[:, None],) + tuple(corner[..., k] for k in range(D))]  # (n, 16, A)
+    node = np.arange(len(lo), dtype=np.int32)
+    roots = node.reshape([len(stages), len(months)] + cshape)
+
+    n_nodes = len(lo)
+    node_axis, node_split = [np.full(n_nodes, -1, np.int8)], [np.zeros(n_nodes, np.float32)]
+    node_left, node_right = [np.zeros(n_nodes, np.int32)], [np.zeros(n_nodes, np.int32)]
+    leaves = {"node": [], "sm": [], "lo": [], "hi": [], "values": [], "depth": []}
+    n_leaves = 0
+    splittable = lambda l, h: (h - l) / 2 >= min_w * (1 - 1e-9)
+
+    def refine(lo, hi, V, cell_sm, node, depth, force):
+        nonlocal n_nodes, n_leaves, node_axis, node_split, node_left, node_right
+        while len(lo):
+            nxt = {"lo": [], "hi": [], "V": [], "sm": [], "node": [], "depth": []}
+            for b in range(0, len(lo), chunk):
+                l, h, v, c_sm, nd, dp, fc = (x[b:b + chunk] for x in (lo, hi, V, cell_sm, node, depth, force))
+                mid = (l + h) / 2
+                st, mo = stages[sm[c_sm, 0]], months[sm[c_sm, 1]]
+                centre = predict_states(pool, meta, st, mo, mid, batch_size)
+                err = np.abs(v - centre[:, None]).max(axis=(1, 2))         # leaf value vs its corners
+                can = splittable(l, h)
+                split = ((err > tol) | fc) & can.any(axis=1)
+                # every split adds one leaf net; stop splitting once the budget is spent
+                budget = max_leaves - n_leaves - (len(lo) - b)
+                if split.sum() > max(budget, 0):
+                    split[np.flatnonzero(split)[max(budget, 0):]] = False
+                change = np.stack([np.abs(v[:, _FACE_LO[k] + (1 << k)] - v[:, _FACE_LO[k]]).max(axis=(1, 2))
+                                   for k in range(D)], axis=1)
+                change = np.where(can, change, -1.0)
+                axis = np.where(change.max(axis=1) > tol, change.argmax(axis=1),
+                                np.where(can, (h - l) / min_w, -1.0).argmax(axis=1))
+
+                lf = ~split
+                for k, x in (("node", nd), ("sm", c_sm), ("lo", l), ("hi", h), ("values", centre), ("depth", dp)):
+                    leaves[k].append(x[lf])
+                n_leaves += int(lf.sum())
+
+                s = np.flatnonzero(split)
+                m = len(s)
+                if not m:
+                    continue
+                ax, at, r = axis[s], mid[s, axis[s]], np.arange(m)
+                # corners of the split plane: lower-face corners of `ax` moved to the midpoint
+                plane = np.where(np.stack([_BITS[f] for f in _FACE_LO])[ax], h[s, None], l[s, None])
+                plane[r, :, ax] = at[:, None]
+                pv = predict_states(pool, meta, np.repeat(st[s], 8), np.repeat(mo[s], 8),
+                                    plane.reshape(-1, D), batch_size).reshape(m, 8, n_act)
+                face = np.stack(_FACE_LO)[ax]                                   # (m, 8)
+                v_lo, v_hi = v[s].copy(), v[s].copy()
+                v_lo[r[:, None], face + (1 << ax)[:, None]] = pv                # lower child: its upper face
+                v_hi[r[:, None], face] = pv                                     # upper child: its lower face
+                l_hi, h_lo = h[s].copy(), l[s].copy()
+                l_hi[r, ax] = at
+                h_lo[r, ax] = at
+
+                kids = n_nodes + np.arange(2 * m, dtype=np.int32)
+                n_nodes += 2 * m
+                node_axis.append(np.full(2 * m, -1, np.int8)); node_split.append(np.zeros(2 * m, np.float32))
+                node_left.append(np.zeros(2 * m, np.int32)); node_right.append(np.zeros(2 * m, np.int32))
+                node_axis[0][nd[s]] = ax
+                node_split[0][nd[s]] = at
+                node_left[0][nd[s]] = kids[:m]
+                node_right[0][nd[s]] = kids[m:]
+                nxt["lo"] += [l[s], h_lo]; nxt["hi"] += [l_hi, h[s]]; nxt["V"] += [v_lo, v_hi]
+                nxt["sm"] += [c_sm[s], c_sm[s]]; nxt["node"] += [kids[:m], kids[m:]]
+                nxt["depth"] += [dp[s] + 1, dp[s] + 1]
+
+            node_axis, node_split = [np.concatenate(node_axis)], [np.concatenate(node_split)]
+            node_left, node_right = [np.concatenate(node_left)], [np.concatenate(node_right)]
+            if not nxt["lo"]:
+                break
+            lo, hi, V, cell_sm, node, depth = (np.concatenate(nxt[k]) for k in ("lo", "hi", "V", "sm", "node", "depth"))
+            force = np.zeros(len(lo), dtype=bool)
+
+    def build(cat: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        node_leaf = np.full(n_nodes, -1, np.int32)
+        node_leaf[cat["node"]] = np.arange(len(cat["node"]), dtype=np.int32)
+        leaf_sm = sm[cat["sm"]]
+        tree = {"roots": roots, "node_axis": node_axis[0], "node_split": node_split[0],
+                "node_left": node_left[0], "node_right": node_right[0], "node_leaf": node_leaf,
+                "leaf_lo": cat["lo"].astype(np.float32), "leaf_hi": cat["hi"].astype(np.float32),
+                "leaf_values": cat["values"].astype(np.float32), "max_depth": np.int32(cat["depth"].max()),
+                "leaf_stage": stages[leaf_sm[:, 0]].astype(np.int8), "leaf_month": months[leaf_sm[:, 1]].astype(np.int8)}
+        tree.update({f"coarse_{k}": coarse[k] for k in range(D)})
+        return tree
+
+    refine(lo, hi, V, cell_sm, node, np.zeros(len(lo), np.int32), np.zeros(len(lo), dtype=bool))
+
+    rounds, n_verify = int(acfg["verify_rounds"]), int(acfg["n_verify"])
+    for rnd in range(rounds + 1):
+        cat = {k: np.concatenate(v) for k, v in leaves.items()}
+        tree = build(cat)
+        table = AdaptivePolicyTable.from_tree(tree, meta["actions"], ADAPTIVE_AXES, stages, months)
+        vs, vm, vX = check_states(n_verify, acfg, int(acfg["seed"]) + 10 + rnd)
+        err = np.abs(table.act_rows(vs, vm, vX) - predict_states(pool, meta, vs, vm, vX, batch_size)).max(axis=1)
+        bad = np.unique(table.leaf_index(vs, vm, vX)[err > tol])
+        redo = bad[splittable(cat["lo"][bad], cat["hi"][bad]).any(axis=1)]
+        bound = {"verify_rounds": rnd, "verify_points": n_verify, "points_over_tol": int((err > tol).sum()),
+                 "leaves_over_tol": int(len(bad)), "at_min_width": int(len(bad) - len(redo))}
+        if rnd == rounds or not len(redo) or n_leaves >= max_leaves:
+            break
+        # drop the failing leaves, re-probe their corners and split each at least once more
+        keep = np.ones(len(cat["node"]), dtype=bool)
+        keep[redo] = False
+        for k in leaves:
+            leaves[k] = [cat[k][keep]]
+        n_leaves -= len(redo)
+        l, h, c_sm = cat["lo"][redo], cat["hi"][redo], cat["sm"][redo]
+        corners = np.where(_BITS[None], h[:, None], l[:, None])            # (m, 16, D)
+        Vc = predict_states(pool, meta, np.repeat(stages[sm[c_sm, 0]], len(_BITS)),
+                            np.repeat(months[sm[c_sm, 1]], len(_BITS)), corners.reshape(-1, D),
+                            batch_size).reshape(len(redo), len(_BITS), n_act)
+        refine(l, h, Vc, c_sm, cat["node"][redo], cat["depth"][redo], np.ones(len(redo), dtype=bool))
+    return tree, bound
+
+
+def check_states(n: int, acfg: Dict[str, Any], seed: int):
+    """Uniform random (stage, month, ADAPTIVE_AXES) states inside the coarse box."""
+    rng = np.random.default_rng(seed)
+    X = np.column_stack([rng.uniform(acfg["coarse"][a][0], acfg["coarse"][a][-1], n) for a in ADAPTIVE_AXES])
+    return rng.integers(0, 8, n), rng.integers(1, 13, n), X
+
+
+def adaptive_report(pool: PredictPool, meta: Dict[str, Any], table: AdaptivePolicyTable,
+                    acfg: Dict[str, Any], batch_size: int) -> Dict[str, Any]:
+    """Max / p99 / mean |table - model| and share of states over tol on held-out random states,
+    next to make_grid nearest-bin lookup."""
+    stage, month, X = check_states(int(acfg["n_check"]), acfg, int(acfg["seed"]) + 1)
+    truth = predict_states(pool, meta, stage, month, X, batch_size)
+    err = {"adaptive": np.abs(table.act_rows(stage, month, X) - truth)}
+    # the fixed export answers with its nearest make_grid bin
     grid = make_grid()
+    bins = [np.sort(grid[a].unique()).astype(float) for a in ADAPTIVE_AXES]
+    Xs = np.column_stack([b[AdaptivePolicyTable._nearest(b, X[:, k])] for k, b in enumerate(bins)])
+    err["fixed_grid"] = np.abs(predict_states(pool, meta, stage, month, Xs, batch_size) - truth)
+    tol = float(acfg["tol"])
+    return {name: {a: {"max": float(e[:, j].max()), "p99": float(np.percentile(e[:, j], 99)),
+                       "mean": float(e[:, j].mean()), "over_tol": float((e[:, j] > tol).mean())}
+                   for j, a in enumerate(meta["actions"])}
+            for name, e in err.items()}
+
+
+def export_adaptive(cfg: Dict[str, Any], model, meta: Dict[str, Any], args) -> None:
+    acfg = {**ADAPTIVE_DEFAULTS, **(cfg.get("adaptive_export") or {})}
+    if args.tol is not None:
+        acfg["tol"] = args.tol
+    if args.strict:
+        acfg["strict"] = True
+    out = args.adaptive_out or acfg["out"]
+    with PredictPool(model, cfg["bc_model_path"], args.workers, compress=not args.no_compress) as pool:
+        with profiling.span("adaptive_refine"):
+            tree, bound = adaptive_refine(pool, meta, acfg, args.batch_size)
+        n_req, n_pred = pool.n_rows, pool.n_predicted
+        os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+        save_adaptive_table(out + ".npz", tree, meta["actions"], ADAPTIVE_AXES,
+                            stages=range(8), months=range(1, 13), obs_offsets={"stage": 1})
+        table = AdaptivePolicyTable(out + ".npz")
+        with profiling.span("adaptive_report"):
+            report = adaptive_report(pool, meta, table, acfg, args.batch_size)
+
+    # variable-resolution table: one row per leaf cell
+    lo, hi = tree["leaf_lo"], tree["leaf_hi"]
+    rows = pd.DataFrame({"stage": tree["leaf_stage"], "month": tree["leaf_month"],
+                         **{f"{a}_lo": lo[:, k] for k, a in enumerate(ADAPTIVE_AXES)},
+                         **{f"{a}_hi": hi[:, k] for k, a in enumerate(ADAPTIVE_AXES)},
+                         **{a: np.round(tree["leaf_values"][:, j], 3) for j, a in enumerate(meta["actions"])}})
+    rows = rows.sort_values(["stage", "month"] + [f"{a}_lo" for a in ADAPTIVE_AXES], kind="stable")
+    rows.to_csv(out + ".csv", index=False)
+
+    held_max = max(v["max"] for v in report["adaptive"].values())
+    bound.update({"tol": float(acfg["tol"]), "heldout_max": held_max, "met": held_max <= float(acfg["tol"])})
+
+    fixed_rows = len(make_grid())
+    summary = {
+        "tol": acfg["tol"], "leaves": int(len(lo)), "nodes": int(len(tree["node_axis"])),
+        "max_depth": int(tree["max_depth"]),
+        "model_rows_requested": int(n_req), "model_rows_evaluated": int(n_pred),
+        "table_bytes": int(sum(np.asarray(v).nbytes for v in tree.values())),
+        "fixed_grid_rows": fixed_rows,
+        "fixed_grid_bytes": fixed_rows * len(meta["actions"]) * 4,
+        "error": report,
+        "bound": bound,
+    }
+    with open(out + ".json", "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2)
+    print(f"[ok] Adaptive table: {summary['leaves']:,} leaves (depth <= {summary['max_depth']}), "
+          f"{summary['table_bytes'] / 1e6:.1f} MB vs {summary['fixed_grid_bytes'] / 1e6:.1f} MB fixed grid "
+          f"-> {out}.npz / .csv / .json")
+    print(f"[info] Refinement evaluated the model on {n_pred:,} of {n_req:,} requested rows "
+          f"(fixed grid: {fixed_rows:,} rows)")
+    for name, e in report.items():
+        print(f"[info] {name:>10} |error| max " +
+              "  ".join(f"{a}={v['max']:.3f}" for a, v in e.items()) +
+              "   mean " + "  ".join(f"{v['mean']:.4f}" for v in e.values()) +
+              "   over tol " + "  ".join(f"{v['over_tol']:.2%}" for v in e.values()))
+    if bound["met"]:
+        print(f"[ok] Held-out |error| <= tol={bound['tol']} everywhere")
+    else:
+        msg = (f"tol={bound['tol']} NOT met: held-out max |error| {held_max:.3f}; after "
+               f"{bound['verify_rounds']} verify round(s) {bound['leaves_over_tol']:,} leaves still miss tol "
+               f"({bound['at_min_width']:,} already at min_width, the rest out of rounds/max_leaves)")
+        if acfg["strict"]:
+            raise SystemExit(f"[error] Adaptive table {msg}")
+        print(f"[warn] !!! Adaptive table {msg}. Lower min_width or raise verify_rounds / max_leaves, "
+              f"or pass --strict to fail the export.")
+
+
+# ----------------- Export cache -----------------
+
+# Bump when the rows written for a given model / meta / grid change (rounding, CSV
+# layout, feature synthesis), so cached shards from older code are not reused.
+EXPORT_FORMAT = 1
+TABLE_KEYS = ["stage", "month", "defN_mm", "defS_mm", "canal_mm", "pool_ratio"]
+
+
+def shard_spec(meta: Dict[str, Any], model_sha1: str, grid_axes: Dict[str, list],
+               stage: int, month: int) -> Dict[str, Any]:
+    """Everything the rows of one (stage, month) shard depend on: only this stage's meta, not all of it."""
+    target = meta.get("target_by_stage", [15, 35, 25, 0, 25, 25, 25, 0])
+    flags = {k: sorted(int(x) for x in meta.get(k, d)) for k, d in
+             (("drain_stages", [3, 7]), ("flood_stages", [1, 2, 5]))}
+    return {
+        "exporter": "export_policy_table", "format": EXPORT_FORMAT, "model": model_sha1,
+        "features": meta["features"], "actions": meta["actions"],
+        "limits": meta.get("limits", {"irrigate_max": 5.0, "drain_max": 3.0}),
+        "stage": int(stage), "month": int(month), "target": float(target[stage]),
+        # synth_features_df accepts 0- or 1-based stage lists
+        "is_drain": any(stage in (x, x - 1) for x in flags["drain_stages"]),
+        "is_flood": any(stage in (x, x - 1) for x in flags["flood_stages"]),
+        "grid": {k: v for k, v in grid_axes.items() if k not in ("stage", "month")},
+    }
 
-    # Features to the model (stage 1..8 to the MODEL)
-    feats = synth_features_df(grid, meta)
-
-    # Predict in batches
-    N = len(grid)
-    bs = max(1, int(args.batch_size))
-    preds = []
-    X = feats.to_numpy(dtype=float, copy=False)
-    for start in range(0, N, bs):
-        stop = min(start + bs, N)
-        preds.append(model.predict(X[start:stop]))
-    Y = np.vstack(preds)
 
-    # Clip to action limits and round
+def export_fixed(cfg: Dict[str, Any], args) -> None:
+    """
+    make_grid export in (stage, month) shards. With the export cache, shards whose
+    spec key is cached are copied from it (CSV rows and values) and only the rest
+    go through the model; when the outputs are still those of an identical run
+    nothing is loaded or written.
+    """
+    meta = load_meta(cfg)
     actions = meta["actions"]
     limits = meta.get("limits", {"irrigate_max": 5.0, "drain_max": 3.0})
-    act_df = clip_and_round(Y, actions, limits)
+    csv_out, bin_out = cfg["policy_table_csv"], args.bin_out or cfg.get("policy_table_bin")
+    scfg = cfg.get("netlogo_shards") or {}
+    layout = args.shards or (scfg.get("per") if scfg.get("enabled") else None)
+    shard_dir = args.shard_dir or scfg.get("dir", "models/policy_shards")
+    decimals = int(scfg.get("decimals", 2))
+    ccfg = cfg.get("export_cache") or {}
+    cache: Optional[ExportCache] = None if args.no_cache else open_cache(ccfg.get("dir"), ccfg.get("max_mb", 2000))
+
+    # Build grid (stage 0..7 for the TABLE); a full product, so each (stage, month) is one block
+    with profiling.span("make_grid") as sp:
+        grid = make_grid()
+        sp.rows = len(grid)
+    axes = {k: grid[k].unique().tolist() for k in TABLE_KEYS}
+    shards = [(s, m) for s in axes["stage"] for m in axes["month"]]
+    per = len(grid) // len(shards)
+
+    keys: List[Optional[str]] = [None] * len(shards)
+    if cache is not None:
+        with profiling.span("cache_keys"):
+            sha = cache.model_sha1(cfg["bc_model_path"])
+            keys = [spec_key(shard_spec(meta, sha, axes, s, m)) for s, m in shards]
+        export_key = spec_key({"shards": keys, "bin": bool(bin_out), "netlogo": [layout, decimals] if layout else None})
+        outputs = [csv_out] + ([bin_out] if bin_out else []) + ([os.path.join(shard_dir, SHARD_INDEX)] if layout else [])
+        if all(cache.output_current(p, export_key) for p in outputs):
+            cache.touch(keys)
+            print(f"[ok] {csv_out} is up to date ({len(shards)} cached shards, model and grid unchanged)")
+            return
+    todo = [i for i, k in enumerate(keys) if k is None or not cache.has(k)]
+    print(f"[info] {len(shards) - len(todo)} of {len(shards)} (stage, month) shards cached, {len(todo)} to export")
+
+    new_rows: Dict[int, pd.DataFrame] = {}
+    if todo:
+        rows = np.concatenate([np.arange(i * per, (i + 1) * per) for i in todo])
+        sub = grid.iloc[rows].reset_index(drop=True)
+        with profiling.span("load_model"):
+            model = load(cfg["bc_model_path"])
+        # Features to the model (stage 1..8 to the MODEL)
+        with profiling.span("synth_features", rows=len(sub)):
+            X = synth_features_df(sub, meta).to_numpy(dtype=float)
+        # Predict in batches (optionally across --workers processes)
+        with profiling.span("predict", rows=len(X)), \
+                PredictPool(model, cfg["bc_model_path"], args.workers, compress=not args.no_compress) as pool:
+            Y = pool.predict(X, args.batch_size)
+        print(f"Model evaluated on {pool.n_predicted:,} of {pool.n_rows:,} grid rows")
+        # Clip to action limits and round; CSV uses 0..7 stage from the grid
+        with profiling.span("clip_and_round", rows=len(Y)):
+            act_df = clip_and_round(Y, actions, limits)
+        out = pd.concat([sub[TABLE_KEYS], act_df], axis=1)
+        for j, i in enumerate(todo):
+            new_rows[i] = out.iloc[j * per:(j + 1) * per]
+
+    # Save: shard by shard, rendering only the new ones
+    os.makedirs(os.path.dirname(csv_out), exist_ok=True)
+    values = np.empty((len(grid), len(actions)), dtype=np.float32)
+    tmp = csv_out + ".tmp"
+    with profiling.span("to_csv", rows=len(grid)), open(tmp, "wb") as f:
+        f.write((",".join(TABLE_KEYS + actions) + "\n").encode("utf-8"))
+        for i, key in enumerate(keys):
+            if i in new_rows:
+                v = new_rows[i][actions].to_numpy(dtype=np.float32)
+                text = new_rows[i].to_csv(index=False, header=False).encode("utf-8")
+                if cache is not None:
+                    cache.put(key, v, text)
+            else:
+                v, text = cache.get_values(key), cache.get_csv(key)
+            values[i * per:(i + 1) * per] = v
+            f.write(text)
+    os.replace(tmp, csv_out)
+    print(f"Exported {len(grid):,} rows -> {csv_out}")
+
+    if bin_out:
+        # CSV/table stage is 0..7; observations (like the model) use 1..8
+        with profiling.span("save_bin", rows=len(values)):
+            save_policy_table_bin(bin_out, axes, actions, values, obs_offsets={"stage": 1})
+        dims = " x ".join(f"{k}={len(v)}" for k, v in axes.items())
+        print(f"Exported binary table [{dims} x actions={len(actions)}] -> {bin_out}")
+    if layout:
+        with profiling.span("save_shards", rows=len(values)):
+            files = save_policy_shards(shard_dir, axes, actions, values, per=layout, decimals=decimals)
+        print(f"Exported {len(files)} NetLogo shards (per {layout}, {decimals} decimals) -> {shard_dir}/")
+    if cache is not None:
+        for p in outputs:
+            cache.record_output(p, export_key)
+        cache.touch(keys)
+        removed = cache.prune(keep=keys)
+        if removed:
+            print(f"[info] Pruned {removed} old files from the export cache")
+    print("Columns:", TABLE_KEYS + actions)
+    # Small spot-check for stage domain
+    print("Stage domain in CSV:", sorted(int(s) for s in axes["stage"]))
 
-    # Assemble final table (CSV uses 0..7 stage from the grid)
-    out = pd.concat([
-        grid[["stage", "month", "defN_mm", "defS_mm", "canal_mm", "pool_ratio"]].reset_index(drop=True),
-        act_df.reset_index(drop=True)
-    ], axis=1)
 
-    # Save
-    os.makedirs(os.path.dirname(cfg["policy_table_csv"]), exist_ok=True)
-    out.to_csv(cfg["policy_table_csv"], index=False)
+# ----------------- Main -----------------
 
-    print(f"Exported {len(out):,} rows -> {cfg['policy_table_csv']}")
-    print("Columns:", list(out.columns))
-    # Small spot-check for stage domain
-    print("Stage domain in CSV:", sorted(out['stage'].unique().tolist()))
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--config", "-c", default="config.yaml")
+    ap.add_argument("--batch_size", type=int, default=200_000,
+                    help="Prediction batch size to control memory/throughput.")
+    ap.add_argument("--workers", type=int, default=1,
+                    help="Prediction processes; rows are split across them and reassembled in order.")
+    ap.add_argument("--bin_out", default=None,
+                    help="Also write a binary memory-mappable table (default: config policy_table_bin).")
+    ap.add_argument("--no_compress", action="store_true",
+                    help="Predict every grid row instead of one row per tree-threshold cell.")
+    ap.add_argument("--profile", action="store_true",
+                    help=f"Time/memory per stage -> <table>.profile.json (or set {profiling.PROFILE_ENV}=1).")
+    ap.add_argument("--shards", choices=["stage", "stage_month"], default=None,
+                    help="Also write compact NetLogo shards, one CSV per stage or per (stage, month) (netlogo_shards).")
+    ap.add_argument("--shard_dir", default=None, help="Shard directory (default: netlogo_shards.dir).")
+    ap.add_argument("--no_cache", action="store_true",
+                    help="Ignore the export cache (export_cache.dir) and recompute every shard.")
+    ap.add_argument("--adaptive", action="store_true",
+                    help="Export a variable-resolution table refined where actions vary (adaptive_export).")
+    ap.add_argument("--tol", type=float, default=None, help="Adaptive: max |action error| at probe points.")
+    ap.add_argument("--adaptive_out", default=None, help="Adaptive: output prefix (.npz / .csv / .json).")
+    ap.add_argument("--strict", action="store_true",
+                    help="Adaptive: fail when held-out |error| exceeds tol anywhere.")
+    args = ap.parse_args()
+
+    cfg = read_config(args.config)
+    profiling.start("export_policy_table", args.profile)
+
+    if args.adaptive:
+        with profiling.span("load_model"):
+            model, meta = load_model_and_meta(cfg)
+        export_adaptive(cfg, model, meta, args)
+        profiling.finish(os.path.splitext(args.adaptive_out or (cfg.get("adaptive_export") or {}).get(
+            "out", ADAPTIVE_DEFAULTS["out"]))[0] + ".profile.json")
+        return
+
+    export_fixed(cfg, args)
+    profiling.finish(os.path.splitext(cfg["policy_table_csv"])[0] + ".profile.json")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,349 @@
+import argparse
+import json
+import os
+import shutil
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+# sklearn/joblib/yaml are imported where needed: loading a saved CompiledForest
+# (BCPolicy cold start) must not pay for them.
+
+# ----------------- Compile -----------------
+
+def _forests(model) -> List[Tuple[list, List[int]]]:
+    """
+    Split a fitted model into (trees, output columns) groups:
+    - MultiOutputRegressor -> one group per wrapped estimator / output column
+    - RandomForest/ExtraTrees (native multi-output) -> one group covering all outputs
+    - single DecisionTreeRegressor -> one group with one tree
+    """
+    from sklearn.multioutput import MultiOutputRegressor
+
+    if isinstance(model, MultiOutputRegressor):
+        groups = []
+        for j, est in enumerate(model.estimators_):
+            (trees, _), = _forests(est)
+            groups.append((trees, [j]))
+        return groups
+    if hasattr(model, "tree_"):
+        return [([model], list(range(int(model.n_outputs_))))]
+    if hasattr(model, "estimators_") and all(hasattr(t, "tree_") for t in model.estimators_):
+        return [(list(model.estimators_), list(range(int(model.n_outputs_))))]
+    raise TypeError(f"Cannot compile {type(model).__name__}: expected tree ensembles.")
+
+
+class CompiledForest:
+    """
+    All trees of a fitted forest flattened into contiguous node arrays.
+
+    Nodes of every tree are concatenated; children are global node indices and
+    leaves point to themselves, so vectorized steps walk every (row, tree) pair
+    to its leaf, dropping pairs once they get there. Predictions reproduce sklearn bit for bit:
+    float32 inputs, float64 thresholds, trees summed in order, then divided.
+    """
+
+    def __init__(self, arrays: Dict[str, np.ndarray], groups: List[Tuple[int, int, List[int]]],
+                 n_features: int, n_outputs: int):
+        self.feature = arrays["feature"]
+        self.threshold = arrays["threshold"]
+        self.left = arrays["left"]
+        self.right = arrays["right"]
+        self.missing_left = arrays["missing_left"]
+        self.value = arrays["value"]
+        self.roots = arrays["roots"]
+        self.depth = int(arrays["depth"])
+        self.is_leaf = self.left == np.arange(len(self.left), dtype=self.left.dtype)
+        self.groups = groups                  # (first tree, end tree, output columns)
+        self.n_features_in_ = n_features
+        self.n_outputs = n_outputs
+
+    @classmethod
+    def from_model(cls, model) -> "CompiledForest":
+        groups_in = _forests(model)
+        n_outputs = sum(len(cols) for _, cols in groups_in)
+        width = max(len(cols) for _, cols in groups_in)
+
+        feats, thrs, lefts, rights, mls, vals, roots = [], [], [], [], [], [], []
+        groups, offset, n_trees, depth = [], 0, 0, 0
+        for trees, cols in groups_in:
+            groups.append((n_trees, n_trees + len(trees), cols))
+            for est in trees:
+                t = est.tree_
+                n = int(t.node_count)
+                leaf = t.children_left == -1
+                own = np.arange(n) + offset
+                left = np.where(leaf, own, t.children_left + offset)
+                right = np.where(leaf, own, t.children_right + offset)
+                ml = getattr(t, "missing_go_to_left", np.zeros(n, dtype=np.uint8))
+                v = np.zeros((n, width), dtype=np.float64)
+                v[:, :len(cols)] = t.value[:, :len(cols), 0]
+
+                feats.append(np.where(leaf, 0, t.feature).astype(np.int32))
+                thrs.append(t.threshold.astype(np.float64))
+                lefts.append(left.astype(np.int32))
+                rights.append(right.astype(np.int32))
+                mls.append(np.asarray(ml, dtype=bool))
+                vals.append(v)
+                roots.append(offset)
+                depth = max(depth, int(t.max_depth))
+                offset += n
+                n_trees += 1
+
+        arrays = {
+            "feature": np.concatenate(feats),
+            "threshold": np.concatenate(thrs),
+            "left": np.concatenate(lefts),
+            "right": np.concatenate(rights),
+            "missing_left": np.concatenate(mls),
+            "value": np.concatenate(vals),
+            "roots": np.asarray(roots, dtype=np.int32),
+            "depth": np.asarray(depth),
+        }
+        return cls(arrays, groups, int(model.n_features_in_), n_outputs)
+
+    # ----------------- Persistence -----------------
+
+    _ARRAYS = ("feature", "threshold", "left", "right", "missing_left", "value", "roots")
+
+    def save(self, path: str, source: Optional[str] = None) -> None:
+        """
+        Write one .npy per array plus compiled.json into directory `path`.
+        `source` (the joblib model) is fingerprinted so stale caches are detected.
+        """
+        tmp = path + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for name in self._ARRAYS:
+            np.save(os.path.join(tmp, name + ".npy"), np.ascontiguousarray(getattr(self, name)))
+        info = {
+            "groups": [[t0, t1, list(cols)] for t0, t1, cols in self.groups],
+            "depth": self.depth,
+            "n_features": self.n_features_in_,
+            "n_outputs": self.n_outputs,
+            "source": _fingerprint(source) if source else None,
+        }
+        with open(os.path.join(tmp, "compiled.json"), "w", encoding="utf-8") as f:
+            json.dump(info, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str, mmap_mode: Optional[str] = "r") -> "CompiledForest":
+        """Load a saved forest; with mmap_mode='r' processes share the pages."""
+        with open(os.path.join(path, "compiled.json"), "r", encoding="utf-8") as f:
+            info = json.load(f)
+        arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+                  for name in cls._ARRAYS}
+        arrays["depth"] = np.asarray(info["depth"])
+        groups = [(int(t0), int(t1), list(cols)) for t0, t1, cols in info["groups"]]
+        return cls(arrays, groups, int(info["n_features"]), int(info["n_outputs"]))
+
+    @staticmethod
+    def is_fresh(path: str, source: str) -> bool:
+        """True if `path` holds a forest compiled from the current `source` file."""
+        try:
+            with open(os.path.join(path, "compiled.json"), "r", encoding="utf-8") as f:
+                return json.load(f).get("source") == _fingerprint(source)
+        except (OSError, ValueError):
+            return False
+
+    # ----------------- Inference -----------------
+
+    def apply(self, X: np.ndarray) -> np.ndarray:
+        """Leaf (global node) index for every (row, tree)."""
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        n, n_trees = X.shape[0], len(self.roots)
+        flat = X.ravel()
+        node = np.tile(self.roots, n)                                   # (row, tree) pairs, row-major
+        base = np.repeat(np.arange(n, dtype=np.int64) * X.shape[1], n_trees)
+        act = np.arange(n * n_trees)
+        for _ in range(self.depth):
+            nd = node[act]
+            x = flat[base[act] + self.feature[nd]]
+            go_left = (x <= self.threshold[nd]) | (np.isnan(x) & self.missing_left[nd])
+            nd = np.where(go_left, self.left[nd], self.right[nd])
+            node[act] = nd
+            # finished pairs only self-loop; dropping them costs a copy, so wait until a quarter are done
+            done = self.is_leaf[nd]
+            if 4 * int(done.sum()) >= len(act):
+                act = act[~done]
+                if not len(act):
+                    break
+        return node.reshape(n, n_trees)
+
+    def predict(self, X: np.ndarray, chunk_rows: int = 0) -> np.ndarray:
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        if X.shape[1] != self.n_features_in_:
+            raise ValueError(f"X has {X.shape[1]} features, forest expects {self.n_features_in_}.")
+        # bound the (rows x trees) working set to ~4M nodes per step
+        step = chunk_rows or max(1, 4_000_000 // len(self.roots))
+        out = np.empty((X.shape[0], self.n_outputs), dtype=np.float64)
+        for s in range(0, X.shape[0], step):
+            leaf_vals = self.value[self.apply(X[s:s + step])]        # (rows, trees, width)
+            for t0, t1, cols in self.groups:
+                # sequential cumsum == sklearn's in-order accumulation; +0.0 folds -0.0
+                acc = np.cumsum(leaf_vals[:, t0:t1, :len(cols)], axis=1)[:, -1, :] + 0.0
+                out[s:s + step, cols] = acc / (t1 - t0)
+        return out
+
+
+def _fingerprint(path: str) -> Dict[str, int]:
+    st = os.stat(path)
+    return {"size": int(st.st_size), "mtime_ns": int(st.st_mtime_ns)}
+
+
+def compiled_cache_path(model_path: str, meta_path: str) -> str:
+    """Where the compiled form of `model_path` lives: next to bc_meta.json."""
+    stem = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(os.path.dirname(meta_path), stem + ".compiled")
+
+
+def write_compiled_cache(model, model_path: str, meta_path: str,
+                         X_check: Optional[np.ndarray] = None) -> Optional[str]:
+    """
+    Compile `model` and save it next to the meta file; None for non-tree models,
+    or when predictions on X_check (if given) differ from model.predict.
+    """
+    try:
+        compiled = CompiledForest.from_model(model)
+    except TypeError:
+        return None
+    if X_check is not None and len(X_check):
+        res = check_parity(model, X_check, compiled)
+        if not res["identical"]:
+            print(f"[warn] Compiled forest differs from model.predict ({res}); not caching it")
+            return None
+    path = compiled_cache_path(model_path, meta_path)
+    compiled.save(path, source=model_path)
+    return path
+
+
+# ----------------- Threshold cells -----------------
+
+def feature_thresholds(model) -> List[np.ndarray]:
+    """Sorted unique split thresholds per input feature, over every tree of the model."""
+    per_feat: List[list] = [[] for _ in range(int(model.n_features_in_))]
+    for trees, _ in _forests(model):
+        for est in trees:
+            t = est.tree_
+            split = t.children_left != -1
+            for f, thr in zip(t.feature[split], t.threshold[split]):
+                per_feat[int(f)].append(thr)
+    return [np.unique(np.asarray(v, dtype=np.float64)) for v in per_feat]
+
+
+def threshold_cells(X: np.ndarray, thresholds: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Group rows of X that no split in the forest can tell apart.
+
+    Two rows with the same number of thresholds strictly below each (float32)
+    feature value take the same branch at every node, so they land in the same
+    leaves and get identical predictions. Returns (representative row per cell,
+    cell index per row): ``Y_full = predict(X[rep])[inverse]``.
+    """
+    X32 = np.asarray(X, dtype=np.float32).astype(np.float64)
+    key = np.zeros(X32.shape[0], dtype=np.int64)
+    radix = 1
+    for j, thr in enumerate(thresholds):
+        if len(thr) == 0:
+            continue
+        _, code = np.unique(np.searchsorted(thr, X32[:, j], side="left"), return_inverse=True)
+        n_codes = int(code.max()) + 1 if len(code) else 1
+        if radix * n_codes >= 2 ** 62:
+            # too many distinct cells to pack; fold what we have and restart the radix
+            _, key = np.unique(key, return_inverse=True)
+            radix = int(key.max()) + 1
+        key = key + code.astype(np.int64) * radix
+        radix *= n_codes
+    _, rep, inverse = np.unique(key, return_index=True, return_inverse=True)
+    return rep, inverse.reshape(-1)
+
+
+# ----------------- Parity -----------------
+
+def check_parity(model, X: np.ndarray, compiled: Optional[CompiledForest] = None,
+                 chunk_rows: int = 0) -> Dict[str, Any]:
+    """Compare CompiledForest against model.predict on X."""
+    ref = np.asarray(model.predict(X), dtype=np.float64).reshape(X.shape[0], -1)
+    got = (compiled or CompiledForest.from_model(model)).predict(X, chunk_rows)
+    return {
+        "rows": int(X.shape[0]),
+        "identical": bool(np.array_equal(ref, got)),
+        "max_abs_diff": float(np.max(np.abs(ref - got))) if X.shape[0] else 0.0,
+    }
+
+
+def synthetic_parity(seed: int = 0, n: int = 2000) -> List[Dict[str, Any]]:
+    """
+    Parity of every model shape _forests accepts (native multi-output forest,
+    MultiOutputRegressor of forests, single tree), fitted and queried on synthetic
+    data with NaNs, so missing-value routing is exercised; needs no trained model.
+    """
+    from sklearn.ensemble import RandomForestRegressor
+    from sklearn.multioutput import MultiOutputRegressor
+    from sklearn.tree import DecisionTreeRegressor
+
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n, 6))
+    Y = np.column_stack([X[:, 0] + X[:, 1] ** 2, np.sin(X[:, 2]) * X[:, 3], (X[:, 4] > 0) * 2.0])
+    X[rng.random(X.shape) < 0.1] = np.nan
+    Xq = rng.normal(size=(n, 6))
+    Xq[rng.random(Xq.shape) < 0.2] = np.nan
+    Xq[:10] = np.nan                                    # all-missing rows
+    models = {
+        "forest": RandomForestRegressor(n_estimators=20, random_state=seed, n_jobs=1),
+        "multi_output": MultiOutputRegressor(RandomForestRegressor(n_estimators=10, random_state=seed, n_jobs=1)),
+        "tree": DecisionTreeRegressor(random_state=seed),
+    }
+    # small chunks so row blocks are stitched together too
+    return [{"model": name, **check_parity(m.fit(X, Y), Xq, chunk_rows=n // 3 + 1)} for name, m in models.items()]
+
+
+def main():
+    ap = argparse.ArgumentParser("Check CompiledForest parity against sklearn predict.")
+    ap.add_argument("--config", "-c", default="config.yaml")
+    ap.add_argument("--n", type=int, default=20_000, help="Random grid states to compare.")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--synthetic", action="store_true",
+                    help="Only the synthetic checks (forest / MultiOutputRegressor / tree, NaN inputs).")
+    args = ap.parse_args()
+
+    synthetic = synthetic_parity(args.seed)
+    for res in synthetic:
+        print(res)
+    if args.synthetic:
+        if not all(r["identical"] for r in synthetic):
+            raise SystemExit(1)
+        return
+
+    from joblib import load
+    import yaml
+    from export_policy_table import make_grid, synth_features_df
+
+    with open(args.config, "r", encoding="utf-8") as f:
+        cfg = yaml.safe_load(f)
+    model = load(cfg["bc_model_path"])
+    with open(cfg["meta_file"], "r", encoding="utf-8") as f:
+        meta = json.load(f)
+
+    rng = np.random.default_rng(args.seed)
+    grid = make_grid()
+    grid = grid.iloc[rng.choice(len(grid), size=min(args.n, len(grid)), replace=False)].reset_index(drop=True)
+    feats = synth_features_df(grid, meta)
+    # jitter continuous columns off the grid so thresholds get exercised both ways
+    for c in ("north_mm", "south_mm", "defN_mm", "defS_mm", "canal_mm", "pool_ratio"):
+        if c in feats:
+            feats[c] += rng.normal(0.0, 0.5, size=len(feats))
+    X = feats.to_numpy(dtype=float)
+
+    res = check_parity(model, X)
+    print(res)
+    if not res["identical"] or not all(r["identical"] for r in synthetic):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,41 @@
-import glob, pandas as pd
+import argparse, glob
 
-# === Step 1. Collect all rule + agent CSVs ===
-rule_files = sorted(glob.glob("data/rule/rule_ep*.csv"))
-agent_files = sorted(glob.glob("data/agent/agent_ep*.csv"))
-
-def load_and_tag(files, label):
-    dfs = []
-    for f in files:
-        df = pd.read_csv(f)
-        df["source"] = label  # tag so we know if rule or agent
-        dfs.append(df)
-    return pd.concat(dfs, ignore_index=True)
-
-rule_df = load_and_tag(rule_files, "rule")
-agent_df = load_and_tag(agent_files, "agent")
-
-# === Step 2. Merge together ===
-data = pd.concat([rule_df, agent_df], ignore_index=True)
+from episode_store import load_store, store_summary, update_store
 
-# === Step 3. Quick sanity checks ===
-print("Episodes loaded:", len(rule_files), "rule +", len(agent_files), "agent")
-print("Total rows:", len(data))
-
-if "control_mode" in data.columns:
-    print("Control modes:", data["control_mode"].value_counts())
-
-print("Stage range:", data["stage"].min(), "to", data["stage"].max())
-print("Any negative values?",
-      (data[["north_mm","south_mm","pool_mm","canal_mm","lake_mm"]] < 0).any().any())
-
-# === Step 4. Save merged dataset ===
-data.to_csv("data/merged_dataset.csv", index=False)
-print("Saved merged dataset -> data/merged_dataset.csv")
+# === Step 1. Collect all rule + agent CSVs ===
+SOURCES = {
+    "rule": "data/rule/rule_ep*.csv",
+    "agent": "data/agent/agent_ep*.csv",
+}
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--store", default="data/episodes",
+                    help="Columnar episode store (manifest.json + seg_*.npz).")
+    ap.add_argument("--csv", default=None,
+                    help="Also write the merged dataset as one CSV (e.g. data/merged_dataset.csv).")
+    args = ap.parse_args()
+
+    files = {label: sorted(glob.glob(pat)) for label, pat in SOURCES.items()}
+
+    # === Step 2. Ingest new/changed episodes only ===
+    stats = update_store(args.store, files)
+    print("Episodes found:", len(files["rule"]), "rule +", len(files["agent"]), "agent")
+    print("Store update:", stats)
+
+    # === Step 3. Quick sanity checks (per-episode stats in the manifest, no segment reads) ===
+    summary = store_summary(args.store)
+    print("Total rows:", summary["rows"])
+    if summary["control_modes"]:
+        print("Control modes:", summary["control_modes"])
+    print("Stage range:", summary["stage_min"], "to", summary["stage_max"])
+    print("Any negative values?", summary["negative"])
+
+    # === Step 4. Optional flat CSV (legacy consumers) ===
+    print(f"Saved episode store -> {args.store}")
+    if args.csv:
+        load_store(args.store).drop(columns=["__ep__"]).to_csv(args.csv, index=False)
+        print(f"Saved merged dataset -> {args.csv}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,606 @@
+import argparse
+import glob
+import json
+import os
+import time
+from dataclasses import dataclass, field, fields, asdict
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+import yaml
+
+# NumPy port of "paddy-opti simu v7.nlogo": every array holds one value per episode,
+# so thousands of episodes advance together. Fields are modelled at their mean depth
+# (every patch of a field sees the same operations, as in the logs where north == south
+# under the rule controller).
+
+# Rollout CSV header written by NetLogo's log-step (data/rule/*.csv)
+LOG_COLUMNS = [
+    "tick", "stage", "month", "north_mm", "south_mm", "pool_mm", "canal_mm", "lake_mm",
+    "poolN_mgL", "poolP_mgL", "canalN_mgL", "canalP_mgL", "lakeN_mgL", "lakeP_mgL",
+    "target_mm", "defN_mm", "defS_mm", "delta_lake_L", "delta_N_to_lake_mg", "delta_P_to_lake_mg",
+    "irrigateN_mm", "irrigateS_mm", "drainN_mm", "drainS_mm", "pool_ratio", "control_mode",
+    "rain_today_mm", "actual_loss_mm", "growth_avg_pct", "growthN_pct", "growthS_pct",
+]
+
+DAYS_IN_MONTH = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+
+# ----------------- Parameters -----------------
+
+@dataclass
+class SimParams:
+    """Defaults are the values NetLogo's `setup` and interface use."""
+    stage_durations: List[int] = field(default_factory=lambda: [7, 10, 21, 14, 24, 35, 10, 30])
+    target_by_stage: List[float] = field(default_factory=lambda: [15, 35, 25, 0, 25, 25, 25, 0])
+    optimal_ranges: List[List[float]] = field(default_factory=lambda: [
+        [10, 20], [30, 40], [20, 30], [0, 10], [20, 30], [20, 30], [20, 30], [0, 10]])
+    drain_stages: List[int] = field(default_factory=lambda: [3, 7])   # 0-based crop-stage
+    flood_stages: List[int] = field(default_factory=lambda: [1, 2, 5])
+    stage_loss_multipliers: List[float] = field(default_factory=lambda: [0.5, 0.8, 1.0, 1.2, 1.0, 1.1, 1.3, 1.0])
+    dry_months: List[int] = field(default_factory=lambda: [1, 2, 3, 12])
+    dry_factor: float = 1.3
+    base_loss: float = 2.9
+    monthly_rainfall_mm: List[float] = field(default_factory=lambda: [40, 40, 40, 60, 120, 140, 130, 90, 80, 60, 50, 40])
+    rain_chance: float = 0.6
+    rain_std: float = 1.0
+    start_month: int = 5
+    # layout: litres per mm per patch, patch counts of setup-layout
+    patch_area: float = 169.0
+    field_patches: int = 105
+    pool_patches: int = 21
+    canal_patches: int = 75
+    lake_patches: int = 153
+    # storages (L)
+    lake_init: float = 1e7
+    lake_capacity: float = 1e8
+    pool_init: float = 1e5
+    pool_capacity: float = 2e5
+    canal_init: float = 1e5
+    canal_capacity: float = 2e5
+    # controls
+    irrigation_rate: float = 5.0   # rule top-up per tick
+    max_drain: float = 3.0
+    irrigate_max: float = 5.0
+    drain_max: float = 3.0
+    floor_drain: float = 0.5       # agent: minimum predicted drain honoured in drain stages
+    deadband_mm: float = 1.0       # agent: no irrigation below this deficit
+    pool_buffer: float = 1.10
+    # water quality
+    N_kgHa_by_stage: List[float] = field(default_factory=lambda: [40, 0, 30, 0, 20, 20, 0, 0])
+    P_kgHa_by_stage: List[float] = field(default_factory=lambda: [20, 0, 0, 0, 0, 0, 0, 0])
+    soil_retention_fraction: float = 0.0
+    decay_rate_N: float = 0.0
+    decay_rate_P: float = 0.0
+    plant_uptake_N_mg_per_day: float = 0.0
+    plant_uptake_P_mg_per_day: float = 0.0
+
+    @classmethod
+    def from_config(cls, cfg: Dict[str, Any]) -> "SimParams":
+        """Shared keys from the top level of config.yaml, overridden by its `sim` block."""
+        names = {f.name for f in fields(cls)}
+        kw = {k: cfg[k] for k in ("stage_durations", "target_by_stage", "drain_stages", "flood_stages")
+              if k in cfg}
+        kw.update({k: v for k, v in (cfg.get("sim") or {}).items() if k in names})
+        return cls(**kw)
+
+    @property
+    def n_ticks(self) -> int:
+        return int(sum(self.stage_durations))
+
+
+def _div(num: np.ndarray, den: np.ndarray) -> np.ndarray:
+    """NetLogo safe-div: 0 where den == 0 (broadcasts den over trailing N/P axis)."""
+    den = np.asarray(den, dtype=float)
+    if np.ndim(num) > np.ndim(den):
+        den = den[..., None]
+    out = np.zeros(np.broadcast(num, den).shape)
+    np.divide(num, den, out=out, where=den != 0)
+    return out
+
+
+# ----------------- Simulator -----------------
+
+class PaddySim:
+    """
+    n parallel episodes. Water volumes are litres, field depths mm; every nutrient
+    mass is an (n, 2) array of [N, P] in mg. step() runs one NetLogo `go`.
+    controller: agent mode's policy, obs columns -> raw (n, 4) actions (policy_controller).
+    """
+
+    def __init__(self, params: SimParams, n: int, mode: str = "rule", seed: Optional[int] = None,
+                 controller: Optional[Callable[[Dict[str, np.ndarray]], np.ndarray]] = None):
+        if mode not in ("rule", "agent"):
+            raise ValueError(f"Unknown mode {mode!r} (expected 'rule' or 'agent')")
+        self.p = params
+        self.n = int(n)
+        self.mode = mode
+        self.controller = controller
+        self.rng = np.random.default_rng(seed)
+        p = params
+        self.field_area = p.patch_area * p.field_patches          # L per mm of field depth
+        self._dur = np.asarray(p.stage_durations)
+        self._target = np.asarray(p.target_by_stage, dtype=float)
+        self._opt = np.asarray(p.optimal_ranges, dtype=float)
+        self._loss_mult = np.asarray(p.stage_loss_multipliers, dtype=float)
+        self._daily_rain = np.asarray(p.monthly_rainfall_mm, dtype=float) / DAYS_IN_MONTH
+        self._dose = np.stack([p.N_kgHa_by_stage, p.P_kgHa_by_stage], axis=1).astype(float) \
+            * self.field_area * 100.0                              # kg/ha -> mg per field
+        self.reset()
+
+    def reset(self) -> None:
+        n, p = self.n, self.p
+        z = lambda: np.zeros(n)
+        self.tick = 0
+        self.stage = np.zeros(n, dtype=int)        # 0-based crop-stage
+        self.stage_start = np.zeros(n, dtype=int)
+        self.month = np.full(n, int(p.start_month))
+        self.month_start = np.zeros(n, dtype=int)
+        self.north, self.south = z(), z()
+        self.pool = np.full(n, float(p.pool_init))
+        self.canal = np.full(n, float(p.canal_init))
+        self.lake = np.full(n, float(p.lake_init))
+        self.lake_withdrawn = z()
+        self.m_lake, self.m_pool, self.m_canal = np.zeros((n, 2)), np.zeros((n, 2)), np.zeros((n, 2))
+        self.m_north, self.m_south = np.zeros((n, 2)), np.zeros((n, 2))
+        self.cum_to_lake = np.zeros((n, 2))
+        self.growthN, self.growthS = z(), z()
+        self.rain, self.loss = z(), z()
+        self.last = np.zeros((n, 4))               # applied irrigateN, irrigateS, drainN, drainS
+        self._prev_withdrawn = z()
+        self._prev_cum = np.zeros((n, 2))
+        self._fertilise()
+
+    # --- NetLogo procedures ---
+
+    def _fertilise(self, mask: Optional[np.ndarray] = None) -> None:
+        add = self._dose[self.stage]
+        if mask is not None:
+            add = add * mask[:, None]
+        self.m_north += add
+        self.m_south += add
+
+    def _move(self, src_m: np.ndarray, dst_m: np.ndarray, litres: np.ndarray, conc: np.ndarray) -> None:
+        moved = litres[:, None] * conc
+        np.maximum(src_m - moved, 0.0, out=src_m)
+        dst_m += moved
+
+    def _canal_overflow(self) -> None:
+        p = self.p
+        over = np.maximum(self.canal - p.canal_capacity, 0.0)
+        to_lake = np.minimum(over, np.maximum(p.lake_capacity - self.lake, 0.0))
+        conc = _div(self.m_canal, self.canal)
+        self.canal -= to_lake
+        self.lake += to_lake
+        moved = to_lake[:, None] * conc
+        self.m_canal = np.maximum(self.m_canal - moved, 0.0)
+        self.m_lake += moved
+        self.cum_to_lake += moved
+
+    def _refill_pool(self, target: np.ndarray) -> None:
+        """refill-mixing-pool(-to-ratio): canal first, lake for the remainder."""
+        need = np.maximum(target - self.pool, 0.0)
+        take_c = np.minimum(need, self.canal)
+        conc = _div(self.m_canal, self.canal)
+        self.pool += take_c
+        self.canal -= take_c
+        self._move(self.m_canal, self.m_pool, take_c, conc)
+        take_l = np.minimum(need - take_c, self.lake)
+        conc = _div(self.m_lake, self.lake)
+        self.pool += take_l
+        self.lake -= take_l
+        self.lake_withdrawn += take_l
+        self._move(self.m_lake, self.m_pool, take_l, conc)
+
+    def _drain(self, mm_n: np.ndarray, mm_s: np.ndarray) -> None:
+        """Fields -> canal at pre-drain concentrations, then canal overflow."""
+        keep = 1.0 - self.p.soil_retention_fraction
+        l_n, l_s = mm_n * self.field_area, mm_s * self.field_area
+        c_n = _div(self.m_north, self.north * self.field_area)
+        c_s = _div(self.m_south, self.south * self.field_area)
+        self.north = np.maximum(self.north - mm_n, 0.0)
+        self.south = np.maximum(self.south - mm_s, 0.0)
+        out_n, out_s = l_n[:, None] * c_n * keep, l_s[:, None] * c_s * keep
+        self.m_north = np.maximum(self.m_north - out_n, 0.0)
+        self.m_south = np.maximum(self.m_south - out_s, 0.0)
+        self.m_canal += out_n + out_s
+        self.canal += l_n + l_s
+        self._canal_overflow()
+        self.last[:, 2], self.last[:, 3] = mm_n, mm_s
+
+    def _irrigate(self, mm_n: np.ndarray, mm_s: np.ndarray) -> None:
+        """Pool -> fields at the pre-pump pool concentration."""
+        l_n, l_s = mm_n * self.field_area, mm_s * self.field_area
+        conc = _div(self.m_pool, self.pool)
+        self.north += mm_n
+        self.south += mm_s
+        self.pool -= l_n + l_s
+        self.m_pool = np.maximum(self.m_pool - (l_n + l_s)[:, None] * conc, 0.0)
+        self.m_north += l_n[:, None] * conc
+        self.m_south += l_s[:, None] * conc
+        self.last[:, 0], self.last[:, 1] = mm_n, mm_s
+
+    def _rule_control(self) -> None:
+        p = self.p
+        target = self._target[self.stage]
+        # field-drainage: excess above target, at most max_drain
+        self._drain(np.minimum(np.maximum(self.north - target, 0.0), p.max_drain),
+                    np.minimum(np.maximum(self.south - target, 0.0), p.max_drain))
+        # auto-irrigation: top the pool up, then every patch below target takes
+        # min(deficit, rate) while the pool can cover it
+        self._refill_pool(np.full(self.n, p.pool_capacity))
+        need_n = np.where(self.north < target, np.minimum(target - self.north, p.irrigation_rate), 0.0)
+        need_s = np.where(self.south < target, np.minimum(target - self.south, p.irrigation_rate), 0.0)
+        total = (need_n + need_s) * self.field_area
+        # NetLogo serves patches one by one; when the pool runs short the mean-field
+        # equivalent is the fraction of demand it can cover
+        frac = np.minimum(1.0, _div(self.pool, total))
+        frac[total == 0] = 1.0
+        self._irrigate(need_n * frac, need_s * frac)
+        self._refill_pool(np.full(self.n, p.pool_capacity))
+
+    def _agent_step(self, req: np.ndarray, pool_ratio: np.ndarray) -> None:
+        p = self.p
+        req = np.clip(req, 0.0, [p.irrigate_max, p.irrigate_max, p.drain_max, p.drain_max])
+        pool_ratio = np.clip(pool_ratio, 0.0, 1.0)
+        req_l = (req[:, 0] + req[:, 1]) * self.field_area
+        # canal-only pre-top-up for today's demand
+        short = np.where((req_l > self.pool) & (self.canal > 0), req_l - self.pool, 0.0)
+        take = np.minimum(short, self.canal)
+        conc = _div(self.m_canal, self.canal)
+        self.pool += take
+        self.canal -= take
+        self._move(self.m_canal, self.m_pool, take, conc)
+        scale = np.where(req_l > 0, np.minimum(1.0, _div(self.pool, req_l)), 1.0)
+        self._irrigate(req[:, 0] * scale, req[:, 1] * scale)
+        self._drain(np.minimum(req[:, 2], self.north), np.minimum(req[:, 3], self.south))
+        self._refill_pool(pool_ratio * p.pool_capacity)
+
+    def loss_today(self) -> np.ndarray:
+        """natural-water-loss for the current stage/month."""
+        p = self.p
+        dry = np.where(np.isin(self.month, p.dry_months), p.dry_factor, 1.0)
+        return p.base_loss * self._loss_mult[self.stage] * dry
+
+    def begin(self, rain: Optional[np.ndarray] = None) -> None:
+        """First half of `go`: advance-month and apply-rainfall (rain: forcing in mm)."""
+        t = self.tick
+        roll = (t - self.month_start) >= DAYS_IN_MONTH[self.month - 1]
+        self.month = np.where(roll, self.month % 12 + 1, self.month)
+        self.month_start = np.where(roll, t, self.month_start)
+        if rain is None:
+            wet = self.rng.random(self.n) < self.p.rain_chance
+            amount = np.maximum(self.rng.normal(self._daily_rain[self.month - 1], self.p.rain_std), 0.0)
+            rain = np.where(wet, amount, 0.0)
+        self.rain = np.asarray(rain, dtype=float) * np.ones(self.n)
+        self.north = self.north + self.rain
+        self.south = self.south + self.rain
+        self.last[:] = 0.0
+
+    def finish(self, loss: Optional[np.ndarray] = None) -> Dict[str, np.ndarray]:
+        """Second half of `go` after the controls: loss, quality, stage, growth, log row, tick."""
+        p = self.p
+        self.loss = self.loss_today() if loss is None else np.asarray(loss, dtype=float) * np.ones(self.n)
+        self.north = np.maximum(self.north - self.loss, 0.0)
+        self.south = np.maximum(self.south - self.loss, 0.0)
+
+        # quality-processes (all rates 0 in the NetLogo defaults)
+        decay = np.array([p.decay_rate_N, p.decay_rate_P])
+        uptake = np.array([p.plant_uptake_N_mg_per_day, p.plant_uptake_P_mg_per_day])
+        if decay.any():
+            for m in (self.m_lake, self.m_pool, self.m_canal, self.m_north, self.m_south):
+                m *= 1.0 - decay
+        if uptake.any():
+            self.m_north = np.maximum(self.m_north - uptake, 0.0)
+            self.m_south = np.maximum(self.m_south - uptake, 0.0)
+
+        # update-crop-stage (the last stage restarts its clock but never advances)
+        adv = (self.tick - self.stage_start) >= self._dur[self.stage]
+        self.stage = np.where(adv, np.minimum(self.stage + 1, len(self._dur) - 1), self.stage)
+        self.stage_start = np.where(adv, self.tick, self.stage_start)
+        if adv.any():
+            self._fertilise(adv)
+
+        # update-crop-growth against the (new) stage's optimal range
+        lo, hi = self._opt[self.stage, 0], self._opt[self.stage, 1]
+        for name, depth in (("growthN", self.north), ("growthS", self.south)):
+            g = getattr(self, name)
+            ok = (depth >= lo) & (depth <= hi)
+            setattr(self, name, np.where(ok, np.minimum(g + 0.5, 100.0), np.maximum(g - 0.2, 0.0)))
+
+        row = self.log_row()
+        self._prev_withdrawn = self.lake_withdrawn.copy()
+        self._prev_cum = self.cum_to_lake.copy()
+        self.tick += 1
+        return row
+
+    def step(self, requests: Optional[np.ndarray] = None, pool_ratio: Optional[np.ndarray] = None,
+             rain: Optional[np.ndarray] = None, loss: Optional[np.ndarray] = None) -> Dict[str, np.ndarray]:
+        """
+        One tick for every episode. Rule mode ignores `requests`. Agent mode asks the
+        controller (through agent_requests) unless given the (n, 4) irrigateN/irrigateS/
+        drainN/drainS requests and pool fill ratio agent-step receives directly.
+        rain/loss: forcing in mm instead of the stochastic/modelled values.
+        Returns the logged row as columns.
+        """
+        self.begin(rain)
+        if self.mode == "rule":
+            self._rule_control()
+        else:
+            if requests is None:
+                if self.controller is None:
+                    raise ValueError("agent mode needs a controller or explicit requests")
+                obs = self.observe()
+                requests, pool_ratio = agent_requests(self, obs, self.controller(obs))
+            self._agent_step(np.asarray(requests, dtype=float).reshape(self.n, 4),
+                             np.ones(self.n) if pool_ratio is None else np.asarray(pool_ratio, dtype=float))
+        return self.finish(loss)
+
+    # --- observations / logging ---
+
+    def observe(self) -> Dict[str, np.ndarray]:
+        """
+        Decision-time state in log/feature conventions (stage 1..8), after today's rain:
+        what agent-policy-decide sees, plus the BC features derived from it.
+        """
+        p = self.p
+        target = self._target[self.stage]
+        stage = self.stage + 1
+        return {
+            "stage": stage,
+            "norm_day": (self.tick - self.stage_start) / np.maximum(self._dur[self.stage], 1),
+            "month": self.month,
+            "north_mm": self.north,
+            "south_mm": self.south,
+            "target_mm": target,
+            "defN_mm": np.maximum(target - self.north, 0.0),
+            "defS_mm": np.maximum(target - self.south, 0.0),
+            "canal_mm": self.canal / (p.canal_patches * p.patch_area),
+            "pool_ratio": _div(self.pool, p.pool_capacity),
+            # same convention as train_bc.add_stage_flags (logged stage vs config lists)
+            "is_drain_stage": np.isin(stage, p.drain_stages).astype(float),
+            "is_flood_stage": np.isin(stage, p.flood_stages).astype(float),
+            "rain_mm": self.rain,
+            "loss_mm": self.loss_today(),
+        }
+
+    def log_row(self) -> Dict[str, np.ndarray]:
+        p = self.p
+        tgt = self._target[self.stage]
+        c_pool = _div(self.m_pool, self.pool)
+        c_canal = _div(self.m_canal, self.canal)
+        c_lake = _div(self.m_lake, self.lake)
+        d_lake = self.cum_to_lake - self._prev_cum
+        return {
+            "tick": np.full(self.n, self.tick),
+            "stage": self.stage + 1,
+            "month": self.month.copy(),
+            "north_mm": self.north.copy(),
+            "south_mm": self.south.copy(),
+            "pool_mm": self.pool / (p.pool_patches * p.patch_area),
+            "canal_mm": self.canal / (p.canal_patches * p.patch_area),
+            "lake_mm": self.lake / (p.lake_patches * p.patch_area),
+            "poolN_mgL": c_pool[:, 0], "poolP_mgL": c_pool[:, 1],
+            "canalN_mgL": c_canal[:, 0], "canalP_mgL": c_canal[:, 1],
+            "lakeN_mgL": c_lake[:, 0], "lakeP_mgL": c_lake[:, 1],
+            "target_mm": tgt,
+            "defN_mm": np.maximum(tgt - self.north, 0.0),
+            "defS_mm": np.maximum(tgt - self.south, 0.0),
+            "delta_lake_L": self.lake_withdrawn - self._prev_withdrawn,
+            "delta_N_to_lake_mg": d_lake[:, 0],
+            "delta_P_to_lake_mg": d_lake[:, 1],
+            "irrigateN_mm": self.last[:, 0].copy(), "irrigateS_mm": self.last[:, 1].copy(),
+            "drainN_mm": self.last[:, 2].copy(), "drainS_mm": self.last[:, 3].copy(),
+            "pool_ratio": _div(self.pool, p.pool_capacity),
+            "rain_today_mm": self.rain.copy(),
+            "actual_loss_mm": self.loss.copy(),
+            "growth_avg_pct": (self.growthN + self.growthS) / 2.0,
+            "growthN_pct": self.growthN.copy(),
+            "growthS_pct": self.growthS.copy(),
+        }
+
+
+# ----------------- Agent decisions -----------------
+
+def agent_requests(sim: PaddySim, obs: Dict[str, np.ndarray], raw: np.ndarray):
+    """
+    agent-policy-decide: turn raw policy outputs (n, 4: irrigateN, irrigateS, drainN,
+    drainS) into agent-step requests + pool fill ratio, exactly as the NetLogo model
+    post-processes a policy-table row.
+    """
+    p = sim.p
+    raw = np.asarray(raw, dtype=float)
+    defN, defS = obs["defN_mm"], obs["defS_mm"]
+    excN = np.maximum(obs["north_mm"] - obs["target_mm"], 0.0)
+    excS = np.maximum(obs["south_mm"] - obs["target_mm"], 0.0)
+    iN = np.where(defN < p.deadband_mm, 0.0, np.minimum(raw[:, 0], defN))
+    iS = np.where(defS < p.deadband_mm, 0.0, np.minimum(raw[:, 1], defS))
+    in_drain = np.isin(sim.stage, p.drain_stages)
+
+    def drain(d_raw, deficit, excess):
+        pred = np.minimum(p.max_drain, d_raw)
+        fallback = np.minimum(p.max_drain, excess)
+        return np.where(deficit > 0, 0.0,
+                        np.where(in_drain & (pred >= p.floor_drain), pred, fallback))
+
+    dN, dS = drain(raw[:, 2], defN, excN), drain(raw[:, 3], defS, excS)
+    need_l = (iN + iS) * sim.field_area
+    want = np.maximum(sim.pool, need_l * p.pool_buffer)
+    ratio = np.minimum(1.0, _div(want, p.pool_capacity))
+    return np.stack([iN, iS, dN, dS], axis=1), ratio
+
+
+def policy_controller(policy) -> Callable[[Dict[str, np.ndarray]], np.ndarray]:
+    """Raw (n, 4) actions from anything with act_batch + actions (BCPolicy, PolicyTable)."""
+    order = ["irrigateN_mm", "irrigateS_mm", "drainN_mm", "drainS_mm"]
+    cols = [list(policy.actions).index(a) for a in order]
+    return lambda obs: np.asarray(policy.act_batch(obs), dtype=float)[:, cols]
+
+
+# ----------------- Rollouts -----------------
+
+def rollout(params: SimParams, n: int, mode: str = "rule", seed: Optional[int] = None,
+            controller: Optional[Callable] = None) -> Dict[str, np.ndarray]:
+    """Run n full episodes; returns log columns as (n_ticks, n) arrays."""
+    sim = PaddySim(params, n, mode=mode, seed=seed, controller=controller)
+    rows = [sim.step() for _ in range(params.n_ticks)]
+    return {k: np.stack([r[k] for r in rows]) for k in rows[0]}
+
+
+def episode_frames(cols: Dict[str, np.ndarray], mode: str) -> List[pd.DataFrame]:
+    """One DataFrame per episode in LOG_COLUMNS order."""
+    n = next(iter(cols.values())).shape[1]
+    out = []
+    for e in range(n):
+        df = pd.DataFrame({k: v[:, e] for k, v in cols.items()})
+        df["control_mode"] = mode
+        out.append(df[LOG_COLUMNS])
+    return out
+
+
+def write_episodes(cols: Dict[str, np.ndarray], mode: str, out_dir: str, prefix: str, start: int = 0) -> List[str]:
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for i, df in enumerate(episode_frames(cols, mode), start=start):
+        path = os.path.join(out_dir, f"{prefix}{i}.csv")
+        df.to_csv(path, index=False)
+        paths.append(path)
+    return paths
+
+
+# ----------------- Calibration -----------------
+
+def replay(params: SimParams, df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Re-run one logged episode with its own rain/loss forcing (and, for agent logs,
+    its applied actions and pool ratio as requests). Differences against the log
+    measure the simulator, not the weather.
+    """
+    mode = str(df["control_mode"].iloc[0])
+    sim = PaddySim(params, 1, mode=mode)
+    rows = []
+    for _, r in df.iterrows():
+        req = r[["irrigateN_mm", "irrigateS_mm", "drainN_mm", "drainS_mm"]].to_numpy(dtype=float)[None]
+        rows.append(sim.step(requests=req, pool_ratio=np.array([r["pool_ratio"]]),
+                             rain=np.array([r["rain_today_mm"]]), loss=np.array([r["actual_loss_mm"]])))
+    out = pd.DataFrame({k: np.concatenate([row[k] for row in rows]) for k in rows[0]})
+    out["control_mode"] = mode
+    return out[LOG_COLUMNS]
+
+
+def fit_forcing(frames: List[pd.DataFrame], params: SimParams) -> Dict[str, Any]:
+    """
+    Rain/loss parameters from logged forcing: base_loss from actual_loss_mm (on ticks
+    whose stage did not change, so the multiplier is known), rain_chance/rain_std/
+    monthly totals from rain_today_mm. Months absent from the logs keep their defaults.
+    """
+    df = pd.concat(frames, ignore_index=True)
+    stage0 = df["stage"].to_numpy(dtype=int) - 1
+    same = np.r_[True, stage0[1:] == stage0[:-1]] & (df["tick"].to_numpy() > 0)
+    dry = np.where(df["month"].isin(params.dry_months), params.dry_factor, 1.0)
+    ratio = df["actual_loss_mm"].to_numpy() / (np.asarray(params.stage_loss_multipliers)[stage0] * dry)
+    base_loss = float(np.median(ratio[same])) if same.any() else params.base_loss
+
+    rain = df["rain_today_mm"].to_numpy(dtype=float)
+    month = df["month"].to_numpy(dtype=int)
+    wet = rain > 0
+    monthly = list(params.monthly_rainfall_mm)
+    for m in np.unique(month):
+        sel = wet & (month == m)
+        if sel.sum() >= 20:
+            monthly[m - 1] = round(float(rain[sel].mean() * DAYS_IN_MONTH[m - 1]), 2)
+    mean = (np.asarray(monthly) / DAYS_IN_MONTH)[month - 1]
+    std = float(np.sqrt(np.mean((rain[wet] - mean[wet]) ** 2))) if wet.any() else params.rain_std
+    return {"base_loss": round(base_loss, 4), "rain_chance": round(float(wet.mean()), 4),
+            "rain_std": round(std, 4), "monthly_rainfall_mm": monthly}
+
+
+def calibrate(paths: List[str], params: SimParams, max_replay: int = 20) -> Dict[str, Any]:
+    from episode_store import iter_frames
+    from evaluate import frame_kpis
+    frames = [df for _, df in iter_frames(paths) if len(df)]
+    if not frames:
+        raise ValueError("No logged episodes to calibrate against.")
+    fitted = fit_forcing(frames, params)
+    tuned = SimParams(**{**asdict(params), **fitted})
+
+    # replayed dynamics vs the logs (max |error| per column)
+    numeric = [c for c in LOG_COLUMNS if c != "control_mode"]
+    err = pd.Series(0.0, index=numeric)
+    for df in frames[:max_replay]:
+        sim_df = replay(tuned, df)
+        err = np.maximum(err, (sim_df[numeric] - df[numeric].reset_index(drop=True)).abs().max())
+
+    # free-running rule episodes vs the logged ones (evaluate.py KPIs)
+    logged = frame_kpis(frames).drop(columns=["episode", "n_ticks"])
+    cols = rollout(tuned, max(200, len(frames)), mode="rule", seed=0)
+    simulated = frame_kpis(episode_frames(cols, "rule")).drop(columns=["episode", "n_ticks"])
+    kpis = pd.DataFrame({"logged_mean": logged.mean(), "sim_mean": simulated.mean(),
+                         "logged_std": logged.std(), "sim_std": simulated.std()}).round(3)
+    return {"params": fitted, "episodes": len(frames), "replay_max_abs_err": err.round(6).to_dict(),
+            "kpis": kpis.to_dict(orient="index")}
+
+
+# ----------------- CLI -----------------
+
+def read_config(path: str) -> Dict[str, Any]:
+    with open(path, "r", encoding="utf-8") as f:
+        return yaml.safe_load(f)
+
+
+def main():
+    ap = argparse.ArgumentParser("Vectorized NetLogo stand-in: roll out or calibrate the paddy simulator.")
+    ap.add_argument("--config", "-c", default="config.yaml")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    r = sub.add_parser("run", help="Simulate episodes and write rollout CSVs.")
+    r.add_argument("--episodes", "-n", type=int, default=100)
+    r.add_argument("--mode", choices=["rule", "agent"], default="rule")
+    r.add_argument("--seed", type=int, default=0)
+    r.add_argument("--out", default="data/sim")
+    r.add_argument("--prefix", default=None, help="File prefix (default <mode>_ep).")
+    r.add_argument("--table", default=None,
+                   help="Agent mode: binary policy table instead of BCPolicy (like NetLogo's table lookup).")
+    r.add_argument("--engine", choices=["sklearn", "compiled"], default="sklearn")
+
+    c = sub.add_parser("calibrate", help="Fit rain/loss forcing and check replayed dynamics against logs.")
+    c.add_argument("--glob", default="data/rule/rule_ep*.csv", help="Logged episodes (CSV glob or episode store).")
+    c.add_argument("--max_replay", type=int, default=20)
+    c.add_argument("--out", default=None, help="Write the report as JSON.")
+    args = ap.parse_args()
+
+    cfg = read_config(args.config)
+    params = SimParams.from_config(cfg)
+
+    if args.cmd == "run":
+        controller = None
+        if args.mode == "agent":
+            from policy import BCPolicy, PolicyTable
+            pol = PolicyTable(args.table) if args.table else \
+                BCPolicy(cfg["bc_model_path"], cfg["meta_file"], engine=args.engine)
+            controller = policy_controller(pol)
+        t0 = time.perf_counter()
+        cols = rollout(params, args.episodes, mode=args.mode, seed=args.seed, controller=controller)
+        sim_s = time.perf_counter() - t0
+        paths = write_episodes(cols, args.mode, args.out, args.prefix or f"{args.mode}_ep")
+        print(f"[ok] Simulated {args.episodes:,} x {params.n_ticks} ticks in {sim_s:.2f}s "
+              f"-> {len(paths):,} CSVs in {args.out}")
+        return
+
+    paths = sorted(glob.glob(args.glob)) or [args.glob]
+    rep = calibrate(paths, params, max_replay=args.max_replay)
+    print(f"=== Calibration vs {rep['episodes']} logged episodes ===")
+    print("Fitted forcing (paste under `sim:` in config.yaml):")
+    print(yaml.safe_dump(rep["params"], default_flow_style=None, sort_keys=False).rstrip())
+    worst = sorted(rep["replay_max_abs_err"].items(), key=lambda kv: -kv[1])[:6]
+    print("Replay max |err| (worst columns):", {k: v for k, v in worst})
+    print(pd.DataFrame(rep["kpis"]).T.to_string())
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(rep, f, indent=2)
+        print(f"Saved report -> {args.out}")
+
+
+if __name__ == "__main__":
+    main()
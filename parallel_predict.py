@@ -0,0 +1,80 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+from joblib import load
+
+from forest_engine import feature_thresholds, threshold_cells
+
+# ----------------- Worker side -----------------
+
+_MODEL = None
+
+
+def _init_worker(model_path: str) -> None:
+    # Each worker loads the model exactly once; mmap_mode shares the numpy
+    # buffers of an uncompressed joblib dump through the page cache.
+    global _MODEL
+    _MODEL = load(model_path, mmap_mode="r")
+
+
+def _predict(X: np.ndarray) -> np.ndarray:
+    return _MODEL.predict(X)
+
+
+# ----------------- Pool -----------------
+
+class PredictPool:
+    """
+    model.predict over a process pool, results reassembled in row order.
+    With workers <= 1 it predicts in-process, batch by batch.
+    With compress=True only one row per forest threshold cell is predicted
+    and the result is expanded back (exactly equal to predicting every row).
+    """
+
+    def __init__(self, model, model_path: str, workers: int = 1, compress: bool = False):
+        self.model = model
+        self.workers = max(1, int(workers))
+        self.n_rows = 0         # rows requested
+        self.n_predicted = 0    # rows actually sent through the model
+        self.thresholds = None
+        if compress:
+            try:
+                self.thresholds = feature_thresholds(model)
+            except TypeError as e:
+                print(f"[warn] {e} Predicting every grid row.")
+        self._ex: Optional[ProcessPoolExecutor] = None
+        if self.workers > 1:
+            self._ex = ProcessPoolExecutor(max_workers=self.workers,
+                                           initializer=_init_worker,
+                                           initargs=(str(model_path),))
+
+    def predict(self, X: np.ndarray, batch_size: int) -> np.ndarray:
+        self.n_rows += X.shape[0]
+        if self.thresholds is None:
+            return self._predict_rows(X, batch_size)
+        rep, inverse = threshold_cells(X, self.thresholds)
+        return self._predict_rows(X[rep], batch_size)[inverse]
+
+    def _predict_rows(self, X: np.ndarray, batch_size: int) -> np.ndarray:
+        n = X.shape[0]
+        self.n_predicted += n
+        b = max(1, int(batch_size))
+        if self._ex is None:
+            parts = [self.model.predict(X[s:s + b]) for s in range(0, n, b)]
+        else:
+            # at least two slices per worker so a slow slice does not idle the rest
+            b = max(1, min(b, -(-n // (2 * self.workers))))
+            parts = list(self._ex.map(_predict, (X[s:s + b] for s in range(0, n, b))))
+        return np.concatenate(parts, axis=0)
+
+    def close(self) -> None:
+        if self._ex is not None:
+            self._ex.shutdown()
+            self._ex = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,27 +1,856 @@
-
 import json
-from typing import Dict, Any
+import os
+import re
+import struct
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Sequence, Union
 import numpy as np
-from joblib import load
+
+# The compiled engine walks (row, tree) pairs in NumPy: fastest per call, but sklearn's
+# Cython loop overtakes it from a few hundred rows (see benchmarks), so bigger batches go there.
+COMPILED_MAX_ROWS = 256
+
+# ----------------- Observation cache -----------------
+
+# Bin widths per feature for cache keys; features not listed are matched exactly.
+# Deficits/canal/pool/norm_day steps divide the export grid, so table cells map to keys.
+DEFAULT_CACHE_RESOLUTION = {
+    "norm_day": 0.05,
+    "north_mm": 1.0,
+    "south_mm": 1.0,
+    "defN_mm": 1.0,
+    "defS_mm": 1.0,
+    "canal_mm": 1.0,
+    "pool_ratio": 0.05,
+    "rain_mm": 0.5,
+    "loss_mm": 0.5,
+}
+
+class ObsCache:
+    """Bounded LRU map from quantized-observation keys to action rows."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = max(1, int(maxsize))
+        self._d: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._d)
+
+    def get(self, key: bytes) -> Optional[np.ndarray]:
+        y = self._d.get(key)
+        if y is None:
+            self.misses += 1
+            return None
+        self._d.move_to_end(key)
+        self.hits += 1
+        return y
+
+    def put(self, key: bytes, y: np.ndarray) -> None:
+        self._d[key] = y
+        self._d.move_to_end(key)
+        while len(self._d) > self.maxsize:
+            self._d.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._d.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> Dict[str, Any]:
+        n = self.hits + self.misses
+        return {"size": len(self._d), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "hit_rate": round(self.hits / n, 4) if n else 0.0}
+
 
 class BCPolicy:
-    def __init__(self, model_path: str, meta_path: str):
-        self.model = load(model_path)
+    def __init__(self, model_path: str, meta_path: str, engine: str = "sklearn", lazy: bool = False,
+                 cache_size: int = 0, cache_resolution: Optional[Dict[str, float]] = None):
+        """
+        engine: "sklearn" calls model.predict; "compiled" evaluates the same trees
+        through forest_engine.CompiledForest (bit-identical, far less per-call overhead),
+        starting from the pre-compiled cache next to the meta file when it is fresh.
+        Compiled batches of COMPILED_MAX_ROWS rows or more still go to model.predict.
+        lazy: defer loading the model until the first decision.
+        cache_size: > 0 keeps an LRU cache of that many observations. Observations are
+        snapped to `cache_resolution` (feature -> bin width, default
+        DEFAULT_CACHE_RESOLUTION) and the model is evaluated at the snapped point, so
+        answers do not depend on what was cached first.
+        """
+        if engine not in ("sklearn", "compiled"):
+            raise ValueError(f"Unknown engine: {engine!r} (expected 'sklearn' or 'compiled')")
+        self.model_path = model_path
+        self.meta_path = meta_path
+        self.engine = engine
         with open(meta_path, "r", encoding="utf-8") as f:
             self.meta = json.load(f)
         self.features = self.meta["features"]
         self.actions = self.meta["actions"]
         self.lim = self.meta.get("limits", {"irrigate_max": 5.0, "drain_max": 3.0})
+        # per-action upper clip (irrigate_* vs everything else = drain)
+        self._hi = np.array([float(self.lim.get("irrigate_max", 5.0)) if "irrigate" in a
+                             else float(self.lim.get("drain_max", 3.0)) for a in self.actions])
+        res = DEFAULT_CACHE_RESOLUTION if cache_resolution is None else cache_resolution
+        self._res = np.array([float(res.get(k, 0.0)) for k in self.features])
+        self.cache = ObsCache(cache_size) if cache_size and cache_size > 0 else None
+        self._model = None
+        self._predict_fn = None
+        if not lazy:
+            self._predict_fn = self._load()
+
+    @property
+    def model(self):
+        """The sklearn model (memory-mapped joblib load on first access)."""
+        if self._model is None:
+            from joblib import load
+            # uncompressed dumps map their arrays instead of copying them
+            self._model = load(self.model_path, mmap_mode="r")
+        return self._model
+
+    def _load(self):
+        if self.engine == "sklearn":
+            return self.model.predict
+        from forest_engine import CompiledForest, compiled_cache_path
+        cache = compiled_cache_path(self.model_path, self.meta_path)
+        if CompiledForest.is_fresh(cache, self.model_path):
+            compiled = CompiledForest.load(cache, mmap_mode="r")
+        else:
+            compiled = CompiledForest.from_model(self.model)
+            try:
+                compiled.save(cache, source=self.model_path)
+            except OSError:
+                pass  # read-only model dir: keep the in-memory compile
+        # the sklearn model is only loaded once a large batch asks for it
+        return lambda X: compiled.predict(X) if len(X) < COMPILED_MAX_ROWS else self.model.predict(X)
+
+    def _predict(self, X: np.ndarray) -> np.ndarray:
+        if self._predict_fn is None:
+            self._predict_fn = self._load()
+        return self._predict_fn(X)
+
+    def feature_matrix(self, obs) -> np.ndarray:
+        """
+        (n, len(features)) float matrix from a 2-D array already in `features` order,
+        a dict of columns / DataFrame (missing features -> 0.0, scalars broadcast),
+        or a list of observation dicts.
+        """
+        if isinstance(obs, np.ndarray):
+            X = np.atleast_2d(np.asarray(obs, dtype=float))
+            if X.ndim != 2 or X.shape[1] != len(self.features):
+                raise ValueError(f"Expected an (n, {len(self.features)}) array in features order, got {obs.shape}")
+            return X
+        if isinstance(obs, (list, tuple)):
+            return np.array([[o.get(k, 0.0) for k in self.features] for o in obs], dtype=float)
+        if hasattr(obs, "columns"):  # DataFrame
+            n = len(obs)
+        else:
+            n = max((np.size(v) for v in obs.values()), default=1)
+        X = np.zeros((n, len(self.features)), dtype=float)
+        for j, k in enumerate(self.features):
+            if k in obs:
+                X[:, j] = np.asarray(obs[k], dtype=float)
+        return X
+
+    def _act_model(self, X: np.ndarray) -> np.ndarray:
+        Y = np.asarray(self._predict(X), dtype=float).reshape(len(X), -1)
+        return np.clip(Y, 0.0, self._hi)
+
+    def quantize(self, X: np.ndarray):
+        """(snapped matrix, one cache key per row) under the cache resolution."""
+        Q = np.array(X, dtype=float, copy=True)
+        m = self._res > 0
+        Q[:, m] = np.round(Q[:, m] / self._res[m]) * self._res[m]
+        Q += 0.0  # -0.0 -> 0.0 so both hash alike
+        return Q, [row.tobytes() for row in Q]
+
+    def act_rows(self, X: np.ndarray) -> np.ndarray:
+        """Clipped actions (n, len(actions)) for a feature matrix in `features` order."""
+        if self.cache is None:
+            return self._act_model(X)
+        Q, keys = self.quantize(X)
+        Y = np.empty((len(keys), len(self.actions)))
+        missed: Dict[bytes, List[int]] = {}
+        for i, k in enumerate(keys):
+            if k in missed:  # repeat of a row already being predicted in this batch
+                missed[k].append(i)
+                self.cache.hits += 1
+                continue
+            y = self.cache.get(k)
+            if y is None:
+                missed.setdefault(k, []).append(i)
+            else:
+                Y[i] = y
+        if missed:
+            # one predict for the distinct missing keys of the whole batch
+            Ym = self._act_model(Q[[rows[0] for rows in missed.values()]])
+            for (k, rows), y in zip(missed.items(), Ym):
+                Y[rows] = y
+                self.cache.put(k, y)
+        return Y
+
+    def warm_cache(self, table: Union[str, "PolicyTable"], select: Optional[Dict[str, Sequence[float]]] = None,
+                   defaults: Optional[Dict[str, float]] = None) -> int:
+        """
+        Pre-fill the cache with cells of an exported binary policy table (path or
+        PolicyTable), at most cache_size of them. `select` restricts axis values in
+        observation units (e.g. {"month": [6, 7]}); `defaults` fills grid columns the
+        table has no axis for (export_policy_table uses norm_day = 0.5).
+        Returns the number of cells inserted.
+        """
+        if self.cache is None:
+            raise ValueError("warm_cache needs a BCPolicy built with cache_size > 0")
+        import pandas as pd
+        from export_policy_table import synth_features_df
+        if isinstance(table, str):
+            table = PolicyTable(table)
+        missing = set(self.actions) - set(table.actions)
+        if missing:
+            raise ValueError(f"Policy table lacks actions {sorted(missing)}")
+        sel = []
+        for name, e in zip(table.axes, table.edges):
+            if select and name in select:
+                want = np.asarray(select[name], dtype=float) - float(table.obs_offsets.get(name, 0.0))
+                sel.append(np.flatnonzero(np.isin(e, want)))
+            else:
+                sel.append(np.arange(len(e)))
+        n = min(int(np.prod([len(s) for s in sel])), self.cache.maxsize)
+        pos = np.unravel_index(np.arange(n), [len(s) for s in sel])
+        idx = tuple(s[p] for s, p in zip(sel, pos))
+        # grid in table conventions (stage 0..7), as synth_features_df expects
+        grid = pd.DataFrame({name: e[i] for name, e, i in zip(table.axes, table.edges, idx)})
+        for k, v in {"norm_day": 0.5, **(defaults or {})}.items():
+            if k not in grid.columns:
+                grid[k] = v
+        X = synth_features_df(grid, self.meta).to_numpy(dtype=float)
+        cols = [table.actions.index(a) for a in self.actions]
+        Y = np.clip(np.asarray(table.values[idx], dtype=float)[:, cols], 0.0, self._hi)
+        _, keys = self.quantize(X)
+        for k, y in zip(keys, Y):
+            self.cache.put(k, y)
+        return n
+
+    def act_batch(self, obs) -> np.ndarray:
+        """
+        Actions (n, len(actions)) for many fields/days in one predict; `obs` is anything
+        feature_matrix accepts. Column j is self.actions[j].
+        """
+        return self.act_rows(self.feature_matrix(obs))
 
     def act(self, obs: Dict[str, float]) -> Dict[str, float]:
         X = np.array([[obs.get(k, 0.0) for k in self.features]], dtype=float)
-        y = self.model.predict(X)[0]
-        out = {}
-        for j, a in enumerate(self.actions):
-            v = float(y[j])
-            if "irrigate" in a:
-                v = max(0.0, min(v, float(self.lim.get("irrigate_max", 5.0))))
+        y = self.act_rows(X)[0]
+        return {a: float(y[j]) for j, a in enumerate(self.actions)}
+
+
+# ----------------- Binary policy table -----------------
+#
+# Layout: 8-byte magic, uint32 version, uint32 header length, UTF-8 JSON header,
+# zero padding to a 64-byte boundary, then a C-ordered little-endian float32
+# array of shape [len(axis) for axis in header["axes"]] + [len(actions)].
+
+TABLE_MAGIC = b"PADDYTBL"
+TABLE_VERSION = 1
+_PREFIX = struct.Struct("<8sII")
+
+def save_policy_table_bin(path: str, axes: Dict[str, Sequence[float]], actions: List[str],
+                          values: np.ndarray, obs_offsets: Dict[str, float] = None) -> None:
+    """
+    Write a dense action table. `axes` is ordered (name -> sorted bin values) and
+    `values` has shape [len(v) for v in axes.values()] + [len(actions)].
+    obs_offsets: observation value = table value + offset (e.g. {"stage": 1}).
+    """
+    shape = [len(v) for v in axes.values()] + [len(actions)]
+    values = np.ascontiguousarray(values, dtype="<f4").reshape(shape)
+    header = json.dumps({
+        "axes": [{"name": k, "values": [float(x) for x in v]} for k, v in axes.items()],
+        "actions": list(actions),
+        "dtype": "<f4",
+        "shape": shape,
+        "obs_offsets": dict(obs_offsets or {}),
+    }).encode("utf-8")
+    head = _PREFIX.size + len(header)
+    pad = (-head) % 64
+    with open(path, "wb") as f:
+        f.write(_PREFIX.pack(TABLE_MAGIC, TABLE_VERSION, len(header)))
+        f.write(header)
+        f.write(b"\0" * pad)
+        f.write(values.tobytes(order="C"))
+
+class PolicyTable:
+    """
+    Memory-mapped dense policy table (see save_policy_table_bin).
+
+    Observations use the same keys/conventions as BCPolicy.act (e.g. stage 1..8);
+    each axis value snaps to its nearest bin, so a lookup is a handful of
+    searchsorted calls plus one array index. The mapping is read-only and shared
+    between processes through the page cache.
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            magic, version, n = _PREFIX.unpack(f.read(_PREFIX.size))
+            if magic != TABLE_MAGIC:
+                raise ValueError(f"{path} is not a binary policy table")
+            if version != TABLE_VERSION:
+                raise ValueError(f"Unsupported policy table version {version} in {path}")
+            header = json.loads(f.read(n).decode("utf-8"))
+        offset = _PREFIX.size + n + ((-(_PREFIX.size + n)) % 64)
+        self.header = header
+        self.axes = [a["name"] for a in header["axes"]]
+        self.edges = [np.asarray(a["values"], dtype=float) for a in header["axes"]]
+        self.actions = header["actions"]
+        self.obs_offsets = header.get("obs_offsets", {})
+        self.values = np.memmap(path, dtype=header["dtype"], mode="r",
+                                offset=offset, shape=tuple(header["shape"]))
+
+    def _index(self, cols: Dict[str, np.ndarray]) -> tuple:
+        idx = []
+        for name, e in zip(self.axes, self.edges):
+            x = np.asarray(cols[name], dtype=float) - float(self.obs_offsets.get(name, 0.0))
+            if len(e) == 1:
+                idx.append(np.zeros(x.shape, dtype=np.intp))
+                continue
+            i = np.clip(np.searchsorted(e, x), 1, len(e) - 1)
+            idx.append(np.where(x - e[i - 1] <= e[i] - x, i - 1, i))
+        return tuple(idx)
+
+    def act_batch(self, obs: Union[Dict[str, Sequence[float]], List[Dict[str, float]]]) -> np.ndarray:
+        """Actions (n, len(actions)) for a dict of columns or a list of observation dicts."""
+        if isinstance(obs, dict):
+            n = max((len(np.atleast_1d(v)) for v in obs.values()), default=1)
+            cols = {k: np.broadcast_to(np.atleast_1d(obs.get(k, 0.0)), (n,)) for k in self.axes}
+        else:
+            cols = {k: np.array([o.get(k, 0.0) for o in obs], dtype=float) for k in self.axes}
+        return np.asarray(self.values[self._index(cols)], dtype=float)
+
+    def act(self, obs: Dict[str, float]) -> Dict[str, float]:
+        y = self.values[self._index({k: obs.get(k, 0.0) for k in self.axes})]
+        return {a: float(y[j]) for j, a in enumerate(self.actions)}
+
+
+# ----------------- Sharded CSV table (NetLogo) -----------------
+#
+# <dir>/index.csv   one record per line, tag first (read with NetLogo's csv:from-file):
+#                     format,1 / per,stage|stage_month / decimals,d / actions,<names...>
+#                     columns,<bin-index columns of a shard row, before the actions>
+#                     axis,<name>,<bin values...>   (stage, month, then the lookup axes)
+#                     shard,<stage>,<month or -1>,<file>,<rows>
+# <dir>/<file>      rows sorted by bin index and dense, so row = mixed-radix bin index;
+#                   each row is those indices followed by round(action * 10**d) integers.
+
+SHARD_INDEX = "index.csv"
+SHARD_FORMAT = 1
+_SHARD_NAME = re.compile(r"stage\d+(_m\d\d)?\.csv")
+
+class PolicyShardWriter:
+    """
+    save_policy_shards one shard at a time: add() the values of each stage (or
+    (stage, month)) in axis order, then close() writes index.csv and removes
+    shards of an earlier export that are no longer listed. Only the shard being
+    written is held in memory.
+    """
+
+    def __init__(self, out_dir: str, axes: Dict[str, Sequence[float]], actions: List[str],
+                 per: str = "stage", decimals: int = 2):
+        if per not in ("stage", "stage_month"):
+            raise ValueError(f"Unknown shard layout: {per!r} (expected 'stage' or 'stage_month')")
+        names = list(axes)
+        if names[:2] != ["stage", "month"]:
+            raise ValueError(f"Sharded tables need stage and month as the first axes, got {names[:2]}")
+        self.out_dir, self.axes, self.actions = out_dir, axes, list(actions)
+        self.per, self.decimals = per, int(decimals)
+        shape = [len(v) for v in axes.values()]
+        lead = 1 if per == "stage" else 2
+        self.cols = names[lead:]
+        self.inner = np.stack(np.unravel_index(np.arange(int(np.prod(shape[lead:]))), shape[lead:]), axis=1)
+        self.lead = list(np.ndindex(*shape[:lead]))
+        self.shards: List[str] = []
+        self.records: List[str] = []
+        os.makedirs(out_dir, exist_ok=True)
+
+    def add(self, values: np.ndarray) -> str:
+        """Write the next shard from its dense values (rows in bin order, one column per action)."""
+        import pandas as pd
+        key = self.lead[len(self.shards)]
+        stage = self.axes["stage"][key[0]]
+        month = self.axes["month"][key[1]] if self.per == "stage_month" else -1
+        fname = f"stage{int(stage)}.csv" if self.per == "stage" else f"stage{int(stage)}_m{int(month):02d}.csv"
+        codes = np.round(np.asarray(values) * 10 ** self.decimals).astype(np.int64)
+        rows = np.concatenate([self.inner, codes.reshape(len(self.inner), len(self.actions))], axis=1)
+        path = os.path.join(self.out_dir, fname)
+        pd.DataFrame(rows).to_csv(path + ".tmp", header=False, index=False)
+        os.replace(path + ".tmp", path)
+        self.shards.append(path)
+        self.records.append(f"shard,{int(stage)},{int(month)},{fname},{len(rows)}")
+        return path
+
+    def close(self) -> List[str]:
+        """Write index.csv once every shard is in; returns the shard paths."""
+        if len(self.shards) != len(self.lead):
+            raise ValueError(f"{len(self.shards)} of {len(self.lead)} shards written")
+        fmt = lambda v: "%d" % v if float(v).is_integer() else repr(float(v))
+        lines = [f"format,{SHARD_FORMAT}", f"per,{self.per}", f"decimals,{self.decimals}",
+                 "actions," + ",".join(self.actions), "columns," + ",".join(self.cols)]
+        lines += ["axis," + ",".join([k] + [fmt(v) for v in vals]) for k, vals in self.axes.items()]
+        index = os.path.join(self.out_dir, SHARD_INDEX)
+        with open(index + ".tmp", "w", encoding="utf-8") as f:
+            f.write("\n".join(lines + self.records) + "\n")
+        os.replace(index + ".tmp", index)
+        keep = {os.path.basename(p) for p in self.shards}
+        for name in os.listdir(self.out_dir):
+            if _SHARD_NAME.fullmatch(name) and name not in keep:
+                os.remove(os.path.join(self.out_dir, name))
+        return self.shards
+
+def save_policy_shards(out_dir: str, axes: Dict[str, Sequence[float]], actions: List[str], values: np.ndarray,
+                       per: str = "stage", decimals: int = 2) -> List[str]:
+    """
+    Write a dense table (axes as for save_policy_table_bin, starting with stage and
+    month) as one CSV per stage or per (stage, month) plus index.csv; returns the
+    shard paths. Shards of an earlier export that are no longer listed are removed.
+    """
+    writer = PolicyShardWriter(out_dir, axes, actions, per, decimals)
+    for block in np.asarray(values).reshape(len(writer.lead), -1, len(actions)):
+        writer.add(block)
+    return writer.close()
+
+def read_shard_index(out_dir: str) -> Dict[str, Any]:
+    """index.csv as {format, per, decimals, actions, columns, axes: {name: values}, shards: [(stage, month, file, rows)]}."""
+    idx: Dict[str, Any] = {"axes": OrderedDict(), "shards": []}
+    with open(os.path.join(out_dir, SHARD_INDEX), "r", encoding="utf-8") as f:
+        for line in f:
+            tag, *rest = line.rstrip("\n").split(",")
+            if tag == "axis":
+                idx["axes"][rest[0]] = [float(v) for v in rest[1:]]
+            elif tag == "shard":
+                idx["shards"].append((float(rest[0]), float(rest[1]), rest[2], int(rest[3])))
+            elif tag in ("actions", "columns"):
+                idx[tag] = rest
+            elif tag:
+                idx[tag] = rest[0] if tag == "per" else int(rest[0])
+    return idx
+
+def read_policy_shard(out_dir: str, index: Dict[str, Any], stage: float, month: float = -1) -> np.ndarray:
+    """Decoded actions of one shard, shaped [len(axis) for axis in index["columns"]] + [len(actions)]."""
+    for st, mo, fname, _ in index["shards"]:
+        if st == stage and (index["per"] == "stage" or mo == month):
+            rows = np.loadtxt(os.path.join(out_dir, fname), delimiter=",", dtype=np.int64, ndmin=2)
+            shape = [len(index["axes"][c]) for c in index["columns"]] + [len(index["actions"])]
+            return (rows[:, len(index["columns"]):] / 10 ** index["decimals"]).reshape(shape)
+    raise KeyError(f"No shard for stage {stage}, month {month} in {out_dir}")
+
+
+# ----------------- Adaptive (variable-resolution) table -----------------
+
+def corner_bits(d: int) -> np.ndarray:
+    """(2**d, d) bool: corner c of a d-dimensional cell sits at the upper edge of axis k iff bit k of c is set."""
+    return ((np.arange(2 ** d)[:, None] >> np.arange(d)) & 1).astype(bool)
+
+def _obs_columns(obs, names: List[str]) -> Dict[str, np.ndarray]:
+    if isinstance(obs, dict):
+        n = max((len(np.atleast_1d(v)) for v in obs.values()), default=1)
+        return {k: np.broadcast_to(np.atleast_1d(obs.get(k, 0.0)).astype(float), (n,)) for k in names}
+    return {k: np.array([o.get(k, 0.0) for o in obs], dtype=float) for k in names}
+
+def save_adaptive_table(path: str, tree: Dict[str, np.ndarray], actions: List[str], axes: List[str],
+                        stages: Sequence[float], months: Sequence[float], obs_offsets: Dict[str, float] = None) -> None:
+    """
+    Write a refined table (see export_policy_table.adaptive_refine) as .npz: per
+    (stage, month) a kd-tree over `axes` whose roots sit on a coarse grid, and per
+    leaf its box and action values.
+    """
+    np.savez(path, actions=np.asarray(actions), axes=np.asarray(axes),
+             stages=np.asarray(stages, dtype=float), months=np.asarray(months, dtype=float),
+             obs_offsets=np.asarray(json.dumps(dict(obs_offsets or {}))),
+             **{k: np.asarray(v) for k, v in tree.items()})
+
+class AdaptivePolicyTable:
+    """
+    Variable-resolution policy table written by `export_policy_table.py --adaptive`.
+    Stage and month snap to their nearest bin like PolicyTable; the continuous axes
+    descend the kd-tree to a leaf cell, which answers with its value.
+    """
+
+    def __init__(self, path: str):
+        with np.load(path) as z:
+            self._load({k: z[k] for k in z.files})
+
+    @classmethod
+    def from_tree(cls, tree: Dict[str, np.ndarray], actions: List[str], axes: List[str],
+                  stages: Sequence[float], months: Sequence[float]) -> "AdaptivePolicyTable":
+        """In-memory table over adaptive_refine's arrays (no file round trip)."""
+        self = cls.__new__(cls)
+        self._load({**tree, "actions": np.asarray(actions), "axes": np.asarray(axes),
+                    "stages": np.asarray(stages, dtype=float), "months": np.asarray(months, dtype=float),
+                    "obs_offsets": np.asarray("{}")})
+        return self
+
+    def _load(self, d: Dict[str, np.ndarray]) -> None:
+        d = dict(d)
+        self.actions = [str(a) for a in d.pop("actions")]
+        self.axes = [str(a) for a in d.pop("axes")]
+        self.stages, self.months = d.pop("stages"), d.pop("months")
+        self.obs_offsets = json.loads(str(d.pop("obs_offsets")))
+        self.coarse = [d.pop(f"coarse_{k}") for k in range(len(self.axes))]
+        self.max_depth = int(d.pop("max_depth"))
+        self.__dict__.update(d)     # roots, node_*, leaf_lo, leaf_hi, leaf_values
+
+    @staticmethod
+    def _nearest(bins: np.ndarray, x: np.ndarray) -> np.ndarray:
+        if len(bins) == 1:
+            return np.zeros(x.shape, dtype=np.intp)
+        i = np.clip(np.searchsorted(bins, x), 1, len(bins) - 1)
+        return np.where(x - bins[i - 1] <= bins[i] - x, i - 1, i)
+
+    def leaf_index(self, stage: np.ndarray, month: np.ndarray, X: np.ndarray) -> np.ndarray:
+        """Leaf row (into leaf_lo / leaf_hi / leaf_values) for table-convention stage/month and X."""
+        n = len(X)
+        si = self._nearest(self.stages, np.asarray(stage, dtype=float))
+        mi = self._nearest(self.months, np.asarray(month, dtype=float))
+        X = np.column_stack([np.clip(X[:, k], e[0], e[-1]) for k, e in enumerate(self.coarse)])
+        ci = [np.clip(np.searchsorted(e, X[:, k], side="right") - 1, 0, len(e) - 2)
+              for k, e in enumerate(self.coarse)]
+        node = self.roots[(si, mi, *ci)]
+        rows = np.arange(n)
+        for _ in range(self.max_depth):
+            ax = self.node_axis[node]
+            inner = ax >= 0
+            if not inner.any():
+                break
+            right = X[rows, np.maximum(ax, 0)] >= self.node_split[node]
+            node = np.where(inner, np.where(right, self.node_right[node], self.node_left[node]), node)
+        return self.node_leaf[node]
+
+    def act_rows(self, stage: np.ndarray, month: np.ndarray, X: np.ndarray) -> np.ndarray:
+        """Actions (n, len(actions)) for table-convention stage/month and X (n, len(axes))."""
+        return self.leaf_values[self.leaf_index(stage, month, X)].astype(float)
+
+    def act_batch(self, obs: Union[Dict[str, Sequence[float]], List[Dict[str, float]]]) -> np.ndarray:
+        cols = _obs_columns(obs, ["stage", "month"] + self.axes)
+        off = lambda k: float(self.obs_offsets.get(k, 0.0))
+        return self.act_rows(cols["stage"] - off("stage"), cols["month"] - off("month"),
+                             np.column_stack([cols[k] - off(k) for k in self.axes]))
+
+    def act(self, obs: Dict[str, float]) -> Dict[str, float]:
+        y = self.act_batch([obs])[0]
+        return {a: float(y[j]) for j, a in enumerate(self.actions)}
+
+
+# ----------------- Interpolating table -----------------
+
+INTERP_AXES = ["defN_mm", "defS_mm", "canal_mm", "pool_ratio"]
+
+def multilinear_weights(t: np.ndarray) -> np.ndarray:
+    """Corner weights (n, 2**d) for fractional positions t (n, d) in [0, 1] inside a cell (corner order: corner_bits)."""
+    w = np.ones((len(t), 1))
+    for k in range(t.shape[1]):
+        tk = t[:, k:k + 1]
+        w = np.concatenate([w * (1.0 - tk), w * tk], axis=1)
+    return w
+
+class InterpPolicy(PolicyTable):
+    """
+    Dense policy table (save_policy_table_bin) loaded into memory and answered by
+    multilinear interpolation over `interp_axes` (default INTERP_AXES) between the
+    2**len(interp_axes) surrounding bins; the other axes (stage, month) snap to
+    their nearest bin as in PolicyTable. Out-of-range values clamp to the edge
+    bins and actions clip to [0, limits] like BCPolicy. Needs only NumPy.
+    """
+
+    def __init__(self, path: str, limits: Optional[Dict[str, float]] = None,
+                 interp_axes: Sequence[str] = INTERP_AXES):
+        super().__init__(path)
+        missing = set(interp_axes) - set(self.axes)
+        if missing:
+            raise ValueError(f"Policy table lacks axes {sorted(missing)}")
+        if any(len(self.edges[self.axes.index(a)]) < 2 for a in interp_axes):
+            raise ValueError("Interpolated axes need at least two bins")
+        # off the mapping into RAM, flattened to (cells, actions) so a lookup is one gather
+        self.values = np.array(self.values, dtype=np.float32)
+        self.flat = self.values.reshape(-1, len(self.actions))
+        strides = np.cumprod([1] + [len(e) for e in self.edges[:0:-1]])[::-1]
+        self.interp = [self.axes.index(a) for a in interp_axes]
+        self.snap = [j for j in range(len(self.axes)) if j not in self.interp]
+        self._stride = strides
+        self._corner = corner_bits(len(self.interp)).astype(np.intp) @ strides[self.interp]
+        self._off = [float(self.obs_offsets.get(a, 0.0)) for a in self.axes]
+        self._lists = [e.tolist() for e in self.edges]
+        lim = limits or {"irrigate_max": 5.0, "drain_max": 3.0}
+        self._hi = np.array([float(lim.get("irrigate_max", 5.0)) if "irrigate" in a
+                             else float(lim.get("drain_max", 3.0)) for a in self.actions])
+
+    def act_cols(self, cols: Dict[str, np.ndarray]) -> np.ndarray:
+        """Actions (n, len(actions)) for observation columns (same conventions as act)."""
+        base, t = 0, []
+        for j in self.snap:
+            x = np.asarray(cols[self.axes[j]], dtype=float) - self._off[j]
+            base = base + AdaptivePolicyTable._nearest(self.edges[j], x) * self._stride[j]
+        for j in self.interp:
+            e = self.edges[j]
+            x = np.clip(np.asarray(cols[self.axes[j]], dtype=float) - self._off[j], e[0], e[-1])
+            i = np.minimum(np.searchsorted(e, x, side="right") - 1, len(e) - 2)
+            t.append((x - e[i]) / (e[i + 1] - e[i]))
+            base = base + i * self._stride[j]
+        corners = self.flat[np.asarray(base)[:, None] + self._corner]      # (n, 2**d, A)
+        Y = np.einsum("nc,nca->na", multilinear_weights(np.column_stack(t)), corners)
+        return np.clip(Y, 0.0, self._hi)
+
+    def act_batch(self, obs: Union[Dict[str, Sequence[float]], List[Dict[str, float]]]) -> np.ndarray:
+        """Actions (n, len(actions)) for a dict of columns or a list of observation dicts."""
+        return self.act_cols(_obs_columns(obs, self.axes))
+
+    def act(self, obs: Dict[str, float]) -> Dict[str, float]:
+        # scalar path: bisect on lists, one gather and one dot
+        base, t = 0, []
+        for j, name in enumerate(self.axes):
+            e = self._lists[j]
+            x = float(obs.get(name, 0.0)) - self._off[j]
+            if j in self.snap:
+                i = min(bisect_left(e, x), len(e) - 1)
+                if i > 0 and x - e[i - 1] <= e[i] - x:
+                    i -= 1
             else:
-                v = max(0.0, min(v, float(self.lim.get("drain_max", 3.0))))
-            out[a] = v
-        return out
+                x = min(max(x, e[0]), e[-1])
+                i = min(bisect_right(e, x) - 1, len(e) - 2)
+                t.append((x - e[i]) / (e[i + 1] - e[i]))
+            base += i * int(self._stride[j])
+        w = [1.0]
+        for tk in t:
+            w = [v * (1.0 - tk) for v in w] + [v * tk for v in w]
+        y = np.dot(w, self.flat[base + self._corner])
+        return {a: min(max(float(y[j]), 0.0), float(self._hi[j])) for j, a in enumerate(self.actions)}
+
+
+def interp_report(table_path: str, model_path: str, meta_path: str, n: int = 100_000,
+                  seed: int = 0) -> Dict[str, Any]:
+    """
+    |action - forest| of InterpPolicy and nearest-bin PolicyTable on `n` random
+    off-grid states inside the table box (norm_day 0.5, as exported), plus
+    per-decision timings for single and batched calls.
+    """
+    import time
+    import pandas as pd
+    from export_policy_table import synth_features_df
+    bc = BCPolicy(model_path, meta_path, engine="sklearn")
+    interp, nearest = InterpPolicy(table_path, limits=bc.lim), PolicyTable(table_path)
+    rng = np.random.default_rng(seed)
+    # table conventions (stage 0..7) for the forest, observation conventions for the tables
+    grid = pd.DataFrame({a: (rng.integers(0, len(e), n).astype(float) if a in ("stage", "month") else
+                             rng.uniform(e[0], e[-1], n)) for a, e in zip(interp.axes, interp.edges)})
+    for a, e in zip(interp.axes, interp.edges):
+        if a in ("stage", "month"):
+            grid[a] = e[grid[a].to_numpy(dtype=int)]
+    grid["norm_day"] = 0.5
+    truth = bc.act_rows(synth_features_df(grid, bc.meta).to_numpy(dtype=float))
+    obs = {a: grid[a].to_numpy() + float(interp.obs_offsets.get(a, 0.0)) for a in interp.axes}
+    cols = [interp.actions.index(a) for a in bc.actions]
+    report: Dict[str, Any] = {"n": n}
+    for name, tab in (("interp", interp), ("nearest", nearest)):
+        err = np.abs(tab.act_batch(obs)[:, cols] - truth)
+        report[name] = {a: {"max": float(err[:, j].max()), "p99": float(np.percentile(err[:, j], 99)),
+                            "mean": float(err[:, j].mean())} for j, a in enumerate(bc.actions)}
+    one = [{a: float(v[i]) for a, v in obs.items()} for i in range(min(n, 2000))]
+    t0 = time.perf_counter()
+    for o in one:
+        interp.act(o)
+    report["act_us"] = (time.perf_counter() - t0) / len(one) * 1e6
+    t0 = time.perf_counter()
+    interp.act_batch(obs)
+    report["act_batch_us_per_row"] = (time.perf_counter() - t0) / n * 1e6
+    return report
+
+
+# ----------------- Serving -----------------
+
+class PolicyServer:
+    """
+    asyncio front end for one BCPolicy. Requests that arrive within `window_ms`
+    of the first queued one (up to `max_batch`) are answered by a single
+    vectorized predict; limits are applied per response exactly as in act().
+    """
+
+    def __init__(self, policy: BCPolicy, window_ms: float = 2.0, max_batch: int = 1024,
+                 latency_window: int = 10_000):
+        import asyncio
+        from collections import deque
+        self.policy = policy
+        self.window = window_ms / 1e3
+        self.max_batch = max(1, int(max_batch))
+        self.queue: "asyncio.Queue" = asyncio.Queue()
+        self.latencies = deque(maxlen=latency_window)   # seconds, enqueue -> result
+        self.n_requests = 0
+        self.n_batches = 0
+
+    async def submit(self, obs: Dict[str, float]) -> Dict[str, float]:
+        import asyncio
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        await self.queue.put((obs, fut, loop.time()))
+        return await fut
+
+    async def run_batcher(self) -> None:
+        import asyncio
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                X = self.policy.feature_matrix([o for o, _, _ in batch])
+                # predict off the event loop so sockets keep filling the next batch
+                Y = await loop.run_in_executor(None, self.policy.act_rows, X)
+            except Exception as e:  # answer every waiter, keep serving
+                for _, fut, _ in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            now = loop.time()
+            for (_, fut, t0), y in zip(batch, Y):
+                if not fut.done():
+                    fut.set_result({a: float(v) for a, v in zip(self.policy.actions, y)})
+                self.latencies.append(now - t0)
+            self.n_requests += len(batch)
+            self.n_batches += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lat = np.asarray(self.latencies, dtype=float) * 1e3
+        return {
+            "queue_depth": self.queue.qsize(),
+            "requests": self.n_requests,
+            "batches": self.n_batches,
+            "mean_batch": round(self.n_requests / self.n_batches, 2) if self.n_batches else 0.0,
+            "p50_ms": round(float(np.percentile(lat, 50)), 3) if len(lat) else None,
+            "p99_ms": round(float(np.percentile(lat, 99)), 3) if len(lat) else None,
+            "cache": self.policy.cache.stats() if self.policy.cache is not None else None,
+        }
+
+    async def handle(self, reader, writer) -> None:
+        """
+        JSON lines: {"id": .., "obs": {...}} -> {"id": .., "action": {...}};
+        {"cmd": "stats"} -> stats(). Requests on one connection may be pipelined;
+        responses carry the request id and can come back out of order.
+        """
+        import asyncio
+
+        async def answer(req):
+            try:
+                if req.get("cmd") == "stats":
+                    resp = {"id": req.get("id"), "stats": self.stats()}
+                else:
+                    resp = {"id": req.get("id"), "action": await self.submit(req["obs"])}
+            except Exception as e:
+                resp = {"id": req.get("id"), "error": f"{type(e).__name__}: {e}"}
+            writer.write((json.dumps(resp) + "\n").encode("utf-8"))
+
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    req = json.loads(line)
+                except ValueError as e:
+                    writer.write((json.dumps({"error": f"bad json: {e}"}) + "\n").encode("utf-8"))
+                    continue
+                t = asyncio.ensure_future(answer(req))
+                tasks.add(t)
+                t.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+async def _serve(args) -> None:
+    import asyncio
+    import yaml
+    with open(args.config, "r", encoding="utf-8") as f:
+        cfg = yaml.safe_load(f)
+    ccfg = cfg.get("policy_cache", {})
+    cache_size = int(ccfg.get("size", 0)) if args.cache_size is None else args.cache_size
+    policy = BCPolicy(args.model or cfg["bc_model_path"], args.meta or cfg["meta_file"], engine=args.engine,
+                      cache_size=cache_size, cache_resolution=ccfg.get("resolution"))
+    warm = args.warm_table or (ccfg.get("warm_table") if ccfg.get("warm") else None)
+    if policy.cache is not None and warm:
+        print(f"[info] Warmed cache with {policy.warm_cache(warm):,} cells from {warm}", flush=True)
+    server = PolicyServer(policy, window_ms=args.window_ms, max_batch=args.max_batch)
+    if args.unix:
+        srv = await asyncio.start_unix_server(server.handle, path=args.unix)
+        where = args.unix
+    else:
+        srv = await asyncio.start_server(server.handle, host=args.host, port=args.port)
+        where = f"{args.host}:{args.port}"
+    print(f"[ok] Serving {policy.model_path} ({args.engine}) on {where}", flush=True)
+
+    async def report():
+        while True:
+            await asyncio.sleep(args.stats_every)
+            print("[stats]", json.dumps(server.stats()), flush=True)
+
+    tasks = [asyncio.ensure_future(server.run_batcher())]
+    if args.stats_every > 0:
+        tasks.append(asyncio.ensure_future(report()))
+    async with srv:
+        await srv.serve_forever()
+
+
+def main():
+    import argparse
+    import asyncio
+    ap = argparse.ArgumentParser("Policy utilities.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    sv = sub.add_parser("serve", help="Serve BCPolicy decisions over a local socket (JSON lines).")
+    sv.add_argument("--config", "-c", default="config.yaml")
+    sv.add_argument("--model", default=None, help="Override bc_model_path.")
+    sv.add_argument("--meta", default=None, help="Override meta_file.")
+    sv.add_argument("--engine", choices=["sklearn", "compiled"], default="sklearn")
+    sv.add_argument("--host", default="127.0.0.1")
+    sv.add_argument("--port", type=int, default=8765)
+    sv.add_argument("--unix", default=None, help="Listen on this Unix socket path instead of TCP.")
+    sv.add_argument("--window_ms", type=float, default=2.0, help="Micro-batching window.")
+    sv.add_argument("--max_batch", type=int, default=1024)
+    sv.add_argument("--cache_size", type=int, default=None,
+                    help="Observation cache entries (default policy_cache.size; 0 = off).")
+    sv.add_argument("--warm_table", default=None, help="Binary policy table to pre-fill the cache from.")
+    sv.add_argument("--stats_every", type=float, default=30.0, help="Seconds between stats lines (0 = off).")
+    ic = sub.add_parser("interp-check",
+                        help="Error of InterpPolicy (and nearest-bin lookup) against the forest on random states.")
+    ic.add_argument("--config", "-c", default="config.yaml")
+    ic.add_argument("--table", default=None, help="Override policy_table_bin.")
+    ic.add_argument("--n", type=int, default=100_000)
+    ic.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+
+    if args.cmd == "interp-check":
+        import yaml
+        with open(args.config, "r", encoding="utf-8") as f:
+            cfg = yaml.safe_load(f)
+        rep = interp_report(args.table or cfg["policy_table_bin"], cfg["bc_model_path"], cfg["meta_file"],
+                            n=args.n, seed=args.seed)
+        for name in ("interp", "nearest"):
+            print(f"[info] {name:>8} |error| max " +
+                  "  ".join(f"{a}={v['max']:.3f}" for a, v in rep[name].items()) +
+                  "   mean " + "  ".join(f"{v['mean']:.4f}" for v in rep[name].values()))
+        print(f"[info] InterpPolicy: {rep['act_us']:.1f} us per act(), "
+              f"{rep['act_batch_us_per_row']:.3f} us per row in act_batch ({rep['n']:,} rows)")
+    elif args.cmd == "serve":
+        try:
+            asyncio.run(_serve(args))
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
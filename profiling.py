@@ -0,0 +1,196 @@
+"""
+Lightweight stage instrumentation for the training / export scripts.
+
+    import profiling
+    profiling.start("train_bc", args.profile)
+    with profiling.span("parse_csv") as sp:
+        df = ...
+        sp.rows = len(df)
+    profiling.finish("models/bc_meta.profile.json")
+
+Spans nest (reported as "outer/inner") and repeated spans with the same path are
+aggregated. Per span: calls, wall and CPU seconds, rows and rows/s, the process
+peak RSS when it closed and how much that peak grew inside it. With
+PADDY_PROFILE=trace, also the tracemalloc peak / net allocation above the span's
+start (tracing slows allocation-heavy stages such as to_csv many times over, so
+timings from a traced run are not comparable). When profiling is off, span()
+only yields a dummy record.
+"""
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+try:
+    import resource
+except ImportError:             # not available on Windows: RSS columns stay empty
+    resource = None
+
+# "1" = timing + RSS, "trace" = also tracemalloc
+PROFILE_ENV = "PADDY_PROFILE"
+
+_MB = 1024.0 * 1024.0
+
+
+def _maxrss_mb(who: int = 0) -> Optional[float]:
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN if who else resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / _MB if sys.platform == "darwin" else rss / 1024.0
+
+
+class _Span:
+    __slots__ = ("path", "rows", "t0", "cpu0", "rss0", "mem0", "peak_seen")
+
+    def __init__(self, path: str, rows: Optional[int] = None):
+        self.path = path
+        self.rows = rows
+
+
+class Profiler:
+    def __init__(self, run: str, trace: bool = False):
+        self.run = run
+        self.trace = trace
+        self.started = time.time()
+        self.t0 = time.perf_counter()
+        self.stats: Dict[str, Dict[str, Any]] = {}
+        self.stack: List[_Span] = []
+        if trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def span(self, name: str, rows: Optional[int] = None) -> Iterator[_Span]:
+        sp = _Span(f"{self.stack[-1].path}/{name}" if self.stack else name, rows)
+        # created on entry so the report lists spans in the order they were opened
+        self.stats.setdefault(sp.path, {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "rows": None,
+                                        "rss_peak_mb": None, "rss_growth_mb": None})
+        if self.trace:
+            cur, peak = tracemalloc.get_traced_memory()
+            if self.stack:
+                # reset_peak below would lose the parent's peak so far
+                self.stack[-1].peak_seen = max(self.stack[-1].peak_seen, peak)
+            tracemalloc.reset_peak()
+            sp.mem0, sp.peak_seen = cur, cur
+        sp.rss0 = _maxrss_mb()
+        sp.cpu0 = time.process_time()
+        sp.t0 = time.perf_counter()
+        self.stack.append(sp)
+        try:
+            yield sp
+        finally:
+            self._close(sp)
+
+    def _close(self, sp: _Span) -> None:
+        wall = time.perf_counter() - sp.t0
+        cpu = time.process_time() - sp.cpu0
+        rss = _maxrss_mb()
+        self.stack.pop()
+        st = self.stats[sp.path]
+        st["calls"] += 1
+        st["wall_s"] += wall
+        st["cpu_s"] += cpu
+        if sp.rows is not None:
+            st["rows"] = (st["rows"] or 0) + int(sp.rows)
+        if rss is not None:
+            st["rss_peak_mb"] = rss
+            st["rss_growth_mb"] = (st["rss_growth_mb"] or 0.0) + rss - sp.rss0
+        if self.trace:
+            cur, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, sp.peak_seen)
+            st["py_peak_mb"] = max(st.get("py_peak_mb", 0.0), (peak - sp.mem0) / _MB)
+            st["py_net_mb"] = st.get("py_net_mb", 0.0) + (cur - sp.mem0) / _MB
+            if self.stack:
+                self.stack[-1].peak_seen = max(self.stack[-1].peak_seen, peak)
+
+    def report(self) -> Dict[str, Any]:
+        spans = {}
+        for path, st in self.stats.items():
+            rec = {k: (round(v, 4) if isinstance(v, float) else v) for k, v in st.items()}
+            if st["rows"] is not None:
+                rec["rows_per_s"] = round(st["rows"] / max(st["wall_s"], 1e-9), 1)
+            spans[path] = rec
+        out = {
+            "run": self.run,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "argv": sys.argv,
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+            "tracemalloc": self.trace,
+            "total_wall_s": round(time.perf_counter() - self.t0, 4),
+            "total_cpu_s": round(time.process_time(), 4),
+            "rss_peak_mb": _maxrss_mb(),
+            # worker processes (CSV parsing / PredictPool) that have been joined
+            "children_rss_peak_mb": _maxrss_mb(1),
+            "spans": spans,
+        }
+        if self.trace:
+            out["py_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / _MB, 4)
+        return out
+
+    def write(self, path: str) -> Dict[str, Any]:
+        """Write the report to `path` and append it as one line to the `.jsonl` history beside it."""
+        rep = self.report()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(rep, f, indent=2)
+        with open(os.path.splitext(path)[0] + ".jsonl", "a", encoding="utf-8") as f:
+            f.write(json.dumps(rep) + "\n")
+        return rep
+
+
+# ----------------- module-level switch -----------------
+
+_ACTIVE: Optional[Profiler] = None
+
+
+def enabled(flag: bool = False) -> bool:
+    return bool(flag) or os.environ.get(PROFILE_ENV, "").strip().lower() not in ("", "0", "false", "no")
+
+
+def start(run: str, flag: bool = False) -> Optional[Profiler]:
+    """Turn profiling on for this process if `flag` (--profile) or PADDY_PROFILE is set."""
+    global _ACTIVE
+    if enabled(flag):
+        _ACTIVE = Profiler(run, trace=os.environ.get(PROFILE_ENV, "").strip().lower() == "trace")
+    return _ACTIVE
+
+
+def active() -> Optional[Profiler]:
+    return _ACTIVE
+
+
+@contextmanager
+def span(name: str, rows: Optional[int] = None) -> Iterator[_Span]:
+    if _ACTIVE is None:
+        yield _Span(name, rows)
+        return
+    with _ACTIVE.span(name, rows) as sp:
+        yield sp
+
+
+def summary(rep: Dict[str, Any]) -> str:
+    w = max([34] + [len(p) + 2 for p in rep["spans"]])
+    lines = [f"{'span':<{w}}{'calls':>6}{'wall_s':>10}{'cpu_s':>10}{'rows/s':>14}{'rss_mb':>10}{'py_peak_mb':>12}"]
+    for path, st in rep["spans"].items():
+        rps = f"{st['rows_per_s']:,.0f}" if "rows_per_s" in st else "-"
+        rss = f"{st['rss_peak_mb']:.1f}" if st.get("rss_peak_mb") is not None else "-"
+        py = f"{st['py_peak_mb']:.1f}" if "py_peak_mb" in st else "-"
+        lines.append(f"{path:<{w}}{st['calls']:>6}{st['wall_s']:>10.3f}{st['cpu_s']:>10.3f}{rps:>14}{rss:>10}{py:>12}")
+    return "\n".join(lines)
+
+
+def finish(path: str) -> Optional[Dict[str, Any]]:
+    """Write the report (if profiling is on), print a per-span summary, and switch profiling off."""
+    global _ACTIVE
+    if _ACTIVE is None:
+        return None
+    rep = _ACTIVE.write(path)
+    _ACTIVE = None
+    print(summary(rep))
+    print(f"[info] Profile ({rep['total_wall_s']:.2f}s, peak RSS {rep['rss_peak_mb'] or 0:.0f} MB) -> {path}")
+    return rep
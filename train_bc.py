@@ -1,16 +1,22 @@
-import argparse, glob, json, os, warnings
+import argparse, glob, hashlib, json, os, time, warnings
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
-from typing import List, Dict, Any, Tuple
+from functools import partial
+from typing import Callable, List, Dict, Any, Optional, Tuple
 
 import numpy as np
 import pandas as pd
 from sklearn.metrics import mean_absolute_error
 from sklearn.model_selection import train_test_split
 from sklearn.multioutput import MultiOutputRegressor
-from sklearn.ensemble import RandomForestRegressor
+from sklearn.ensemble import ExtraTreesRegressor, HistGradientBoostingRegressor, RandomForestRegressor
 from joblib import dump
 import yaml
 
+import profiling
+from episode_store import MANIFEST, file_sha1, is_store, iter_store_episodes, iter_store_segments, read_manifest
+from forest_engine import write_compiled_cache
+
 warnings.filterwarnings("ignore", category=FutureWarning)
 
 # -------------------------- utils --------------------------
@@ -21,32 +27,45 @@ def read_config(path: str) -> Dict[str, Any]:
     return cfg
 
 def list_csvs(glob_pat: str) -> List[str]:
+    # an episode store directory (see merge_data.py) is read as one source
+    if is_store(glob_pat):
+        return [glob_pat]
     files = sorted(glob.glob(glob_pat))
     if not files:
         raise FileNotFoundError(f"No CSVs found for pattern: {glob_pat}")
     return files
 
-def coerce_numeric(df: pd.DataFrame) -> pd.DataFrame:
-    for c in df.columns:
-        df[c] = pd.to_numeric(df[c], errors="ignore")
-    return df
+def episode_ids(df: pd.DataFrame) -> np.ndarray:
+    """
+    Episode key per row: the source id in `__ep__` (if present), split again
+    wherever `tick` restarts, so a concatenated CSV (merged_dataset.csv) still
+    separates its episodes.
+    """
+    n = len(df)
+    new = np.zeros(n, dtype=bool)
+    if n:
+        new[0] = True
+    if "__ep__" in df.columns:
+        ep = df["__ep__"].to_numpy()
+        new[1:] |= ep[1:] != ep[:-1]
+    if "tick" in df.columns:
+        tick = df["tick"].to_numpy()
+        new[1:] |= tick[1:] <= tick[:-1]
+    return np.cumsum(new)
 
 def compute_norm_day(df: pd.DataFrame, stage_durations: List[int]) -> pd.DataFrame:
+    """Days since the current stage began (within the episode) / stage duration."""
     # stage is 1..8 in your CSVs; convert to int
     if "stage" not in df.columns:
         raise ValueError("CSV missing 'stage' column.")
-    st = df["stage"].astype(int).values
-    norm = np.zeros(len(df), dtype=float)
-    count_in_stage = 0
-    prev_stage = st[0]
-    for i, s in enumerate(st):
-        if s != prev_stage:
-            count_in_stage = 0
-            prev_stage = s
-        dur = stage_durations[min(max(int(s)-1, 0), len(stage_durations)-1)]
-        norm[i] = (count_in_stage / max(dur, 1))
-        count_in_stage += 1
-    df["norm_day"] = norm
+    st = df["stage"].to_numpy().astype(int)
+    ep = episode_ids(df)
+    pos = np.arange(len(df))
+    new_run = np.ones(len(df), dtype=bool)
+    new_run[1:] = (st[1:] != st[:-1]) | (ep[1:] != ep[:-1])
+    run_start = np.maximum.accumulate(np.where(new_run, pos, 0)) if len(df) else pos
+    dur = np.asarray(stage_durations)[np.clip(st - 1, 0, len(stage_durations) - 1)]
+    df["norm_day"] = (pos - run_start) / np.maximum(dur, 1)
     return df
 
 def add_stage_flags(df: pd.DataFrame, drain_stages: List[int], flood_stages: List[int]) -> pd.DataFrame:
@@ -79,108 +98,521 @@ class TrainArtifacts:
     train_mae: Dict[str, float]
     val_mae: Dict[str, float]
     n_rows: int
-    n_files: int
+    n_episodes: int
+    backend: str = "random_forest"
+    fit_s: float = 0.0
+    predict_rows_per_s: float = 0.0
+
+# Columns computed here rather than read from the logs
+DERIVED_COLUMNS = ("norm_day", "is_drain_stage", "is_flood_stage")
+# Back-compat: newer logs use rain_today_mm/actual_loss_mm for rain_mm/loss_mm
+RENAMES = {"rain_today_mm": "rain_mm", "actual_loss_mm": "loss_mm"}
+# Optional columns that may or may not exist (backwards compatibility)
+OPTIONAL_DEFAULTS = {"rain_mm": 0.0, "loss_mm": 0.0}
+
+def raw_columns(cfg: Dict[str, Any]) -> List[str]:
+    """Log columns needed to build cfg features/actions (everything else is never parsed)."""
+    need = set(cfg["features"]) | set(cfg["actions"]) | {"stage", "pool_ratio", "tick"}
+    need -= set(DERIVED_COLUMNS)
+    need |= {old for old, new in RENAMES.items() if new in need}
+    return sorted(need)
+
+def normalize_raw(df: pd.DataFrame) -> pd.DataFrame:
+    """Per-source header fixes so frames from old and new logs concatenate cleanly."""
+    for old, new in RENAMES.items():
+        if (new not in df.columns) and (old in df.columns):
+            df = df.rename(columns={old: new})
+
+    # Fill optional columns if missing
+    for c, default in OPTIONAL_DEFAULTS.items():
+        if c not in df.columns:
+            df[c] = np.float32(default)
+    return df
 
-def load_dataset(files: List[str],
-                 cfg: Dict[str, Any]) -> Tuple[pd.DataFrame, pd.DataFrame]:
-    stage_durations = cfg["stage_durations"]
-    drain_stages = cfg["drain_stages"]
-    flood_stages = cfg["flood_stages"]
+def read_episode(path: str, cfg: Dict[str, Any]) -> pd.DataFrame:
+    """Parse only the needed columns of one rollout CSV, as float32."""
+    wanted = set(raw_columns(cfg))
+    df = pd.read_csv(path, usecols=lambda c: c in wanted,
+                     dtype={c: np.float32 for c in wanted})
+    return normalize_raw(df)
+
+def build_features(df: pd.DataFrame, cfg: Dict[str, Any]) -> pd.DataFrame:
+    """
+    Derived features over all episodes at once (grouped by `__ep__`/tick restarts
+    and stage runs), then float32 features + actions with NaN rows dropped.
+    """
     features_cfg = list(cfg["features"])
     action_names = list(cfg["actions"])
 
-    # Optional columns that may or may not exist (backwards compatibility)
-    optional_cols_defaults = {
-        "rain_mm": 0.0,
-        "loss_mm": 0.0,
-        # keep names exactly as in logs (rain_today_mm -> rain_mm in header)
-        # If your header uses 'rain_today_mm' / 'actual_loss_mm', map below:
-        "rain_today_mm": 0.0,
-        "actual_loss_mm": 0.0,
-    }
+    # Deriveds
+    with profiling.span("compute_norm_day", rows=len(df)):
+        df = compute_norm_day(df, cfg["stage_durations"])
+    with profiling.span("add_stage_flags", rows=len(df)):
+        df = add_stage_flags(df, cfg["drain_stages"], cfg["flood_stages"])
 
-    frames = []
-    for f in files:
-        df = pd.read_csv(f)
-        df = coerce_numeric(df)
+    # house-keeping
+    df["pool_ratio"] = df["pool_ratio"].clip(0, 1)
 
-        # Back-compat: rename if your new logs use rain_today_mm/actual_loss_mm
-        if ("rain_mm" not in df.columns) and ("rain_today_mm" in df.columns):
-            df = df.rename(columns={"rain_today_mm": "rain_mm"})
-        if ("loss_mm" not in df.columns) and ("actual_loss_mm" in df.columns):
-            df = df.rename(columns={"actual_loss_mm": "loss_mm"})
+    # sanity: ensure required columns exist
+    ensure_columns(df, features_cfg + action_names)
 
-        # Fill optional columns if missing
-        for c, default in optional_cols_defaults.items():
-            if c in ("rain_today_mm", "actual_loss_mm"):  # handled via rename above
-                continue
-            if c not in df.columns:
-                df[c] = default
+    # Drop any rows with NaNs in features/labels (shouldn’t happen, but safe)
+    with profiling.span("select_float32", rows=len(df)):
+        return df[features_cfg + action_names].dropna().astype(np.float32)
 
-        # Deriveds
-        df = compute_norm_day(df, stage_durations)
-        df = add_stage_flags(df, drain_stages, flood_stages)
+# -------------------------- feature cache --------------------------
 
-        # house-keeping
-        df["pool_ratio"] = df["pool_ratio"].clip(0, 1)
+FEATURE_CACHE_VERSION = 1
+# config fields that change the feature matrix
+FEATURE_CFG_KEYS = ("stage_durations", "drain_stages", "flood_stages", "features", "actions")
 
-        # sanity: ensure required columns exist
-        ensure_columns(df, features_cfg + action_names)
+def feature_cache_key(files: List[str], cfg: Dict[str, Any]) -> str:
+    """Hash of the source bytes (store manifests / CSV contents) + relevant config."""
+    h = hashlib.sha1()
+    spec = {k: cfg.get(k) for k in FEATURE_CFG_KEYS}
+    spec["version"] = FEATURE_CACHE_VERSION
+    h.update(json.dumps(spec, sort_keys=True).encode("utf-8"))
+    for f in files:
+        src = os.path.join(f, MANIFEST) if is_store(f) else f
+        h.update(file_sha1(src).encode("ascii"))
+    return h.hexdigest()[:24]
 
-        df["__ep__"] = os.path.splitext(os.path.basename(f))[0]  # for info
-        frames.append(df)
+def load_dataset(files: List[str],
+                 cfg: Dict[str, Any]) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Load features/labels from rollout CSVs and/or episode stores.
+    CSVs are parsed in a process pool (train.load_workers; 0 = all cores).
+    With `feature_cache` set, the result is cached on disk under a hash of the
+    sources and FEATURE_CFG_KEYS, and later calls skip parsing/feature work.
+    """
+    features_cfg = list(cfg["features"])
+    action_names = list(cfg["actions"])
 
-    full = pd.concat(frames, ignore_index=True)
-    # Drop any rows with NaNs in features/labels (shouldn’t happen, but safe)
-    full = full.dropna(subset=features_cfg + action_names)
-    return full[features_cfg], full[action_names]
+    cache_dir = cfg.get("feature_cache")
+    cache_path = None
+    if cache_dir:
+        with profiling.span("feature_cache_key"):
+            cache_path = os.path.join(cache_dir, f"features_{feature_cache_key(files, cfg)}.npz")
+        if os.path.isfile(cache_path):
+            with profiling.span("feature_cache_load") as sp, np.load(cache_path) as z:
+                sp.rows = len(z["X"])
+                return (pd.DataFrame(z["X"], columns=features_cfg),
+                        pd.DataFrame(z["Y"], columns=action_names))
+
+    csvs = [f for f in files if not is_store(f)]
+    workers = int(cfg.get("train", {}).get("load_workers", 0)) or os.cpu_count() or 1
+    workers = min(workers, len(csvs))
+    with profiling.span("parse_csv") as sp:
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as ex:
+                parsed = ex.map(partial(read_episode, cfg=cfg), csvs,
+                                chunksize=max(1, len(csvs) // (4 * workers)))
+                by_csv = dict(zip(csvs, parsed))
+        else:
+            by_csv = {f: read_episode(f, cfg) for f in csvs}
+        sp.rows = sum(len(df) for df in by_csv.values())
+
+    wanted = set(raw_columns(cfg))
+    frames = []
+    with profiling.span("read_store") as sp:
+        for f in files:
+            if is_store(f):
+                frames.extend(normalize_raw(df[[c for c in df.columns if c in wanted]])
+                              for _, df in iter_store_episodes(f))
+            else:
+                frames.append(by_csv[f])
+        sp.rows = sum(len(df) for df in frames) - sum(len(df) for df in by_csv.values())
+    for i, df in enumerate(frames):
+        df["__ep__"] = np.int32(i)
+
+    with profiling.span("concat") as sp:
+        full = pd.concat(frames, ignore_index=True)
+        sp.rows = len(full)
+    with profiling.span("build_features", rows=len(full)):
+        full = build_features(full, cfg)
+    X, Y = full[features_cfg], full[action_names]
+
+    if cache_path:
+        with profiling.span("feature_cache_save", rows=len(X)):
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = cache_path + ".tmp.npz"
+            np.savez(tmp, X=X.to_numpy(), Y=Y.to_numpy())
+            os.replace(tmp, cache_path)
+    return X, Y
+
+# -------------------------- out-of-core arrays --------------------------
+#
+# Peak memory of the frame path above is several full copies of the parsed columns
+# (per-episode frames, their concat, derived columns, the float32 slice, then
+# train_test_split's copies). This path streams episodes into preallocated float32
+# train/val arrays, each episode routed whole to one side, so the split is two
+# views and nothing is copied after parsing:
+#   arrays  rows * (n_features + n_actions) * 4 bytes    (on disk when memory-mapped)
+#   working set  one parsing window of CSVs / one store segment at a time
+
+OUT_OF_CORE_DEFAULTS = {"enabled": False, "dir": "cache/arrays", "memmap_min_rows": 2_000_000,
+                        "chunk_files": 64}
+
+def count_csv_rows(path: str) -> int:
+    """Data lines in a CSV (upper bound on parsed rows)."""
+    n, last = 0, b"\n"
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            n += block.count(b"\n")
+            last = block[-1:]
+    return max(0, n - 1 + (last != b"\n"))
+
+def feature_arrays(df: pd.DataFrame, cfg: Dict[str, Any]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """build_features of a multi-episode frame as float32 (X, Y) + the `__ep__` of each kept row."""
+    df = df.reset_index(drop=True)
+    ep = df["__ep__"].to_numpy()
+    full = build_features(df, cfg)
+    return (full[list(cfg["features"])].to_numpy(np.float32), full[list(cfg["actions"])].to_numpy(np.float32),
+            ep[full.index.to_numpy()])
+
+def _csv_chunk_arrays(paths: List[str], cfg: Dict[str, Any]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    frames = []
+    for i, p in enumerate(paths):
+        df = read_episode(p, cfg)
+        df["__ep__"] = np.int32(i)
+        frames.append(df)
+    return feature_arrays(pd.concat(frames, ignore_index=True), cfg)
 
-def train(cfg: Dict[str, Any]) -> TrainArtifacts:
-    data_glob = cfg["data_glob"]
-    model_path = cfg["bc_model_path"]
-    meta_path = cfg["meta_file"]
-    features = list(cfg["features"])
-    actions = list(cfg["actions"])
+def episode_units(files: List[str]) -> List[Tuple[str, int]]:
+    """(episode name, row upper bound) per CSV and per store episode, in load order."""
+    units = []
+    for f in files:
+        if is_store(f):
+            units += [(f"{f}::{p}", int(e["rows"])) for p, e in sorted(read_manifest(f)["files"].items())]
+        else:
+            units.append((f, count_csv_rows(f)))
+    return units
+
+def count_episodes(files: List[str]) -> int:
+    """Training units in `files`: one per CSV, one per episode in each store (manifest only)."""
+    return sum(len(read_manifest(f)["files"]) if is_store(f) else 1 for f in files)
+
+def split_episodes(n_units: int, tr: Dict[str, Any]) -> np.ndarray:
+    """Boolean val mask over episodes (val_split of them; the last ones when shuffle is off)."""
+    if n_units < 2:
+        raise ValueError("An episode-level split needs at least 2 episodes.")
+    n_val = min(n_units - 1, max(1, int(round(float(tr["val_split"]) * n_units))))
+    order = np.random.default_rng(int(tr.get("seed", 42))).permutation(n_units) \
+        if bool(tr.get("shuffle", True)) else np.arange(n_units)
+    is_val = np.zeros(n_units, dtype=bool)
+    is_val[order[-n_val:]] = True
+    return is_val
+
+def _alloc(shape: Tuple[int, int], path: Optional[str]) -> np.ndarray:
+    if path is None:
+        return np.empty(shape, dtype=np.float32)
+    return np.lib.format.open_memmap(path + ".tmp.npy", mode="w+", dtype=np.float32, shape=shape)
+
+def load_arrays(files: List[str], cfg: Dict[str, Any]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    (X_train, X_val, Y_train, Y_val) as float32 views of preallocated arrays, split by
+    episode (CSV file or store episode). Arrays of >= out_of_core.memmap_min_rows
+    rows are memory-mapped .npy files in out_of_core.dir, reused while the sources,
+    feature config and split settings are unchanged.
+    """
     tr = cfg["train"]
-    limits = tr.get("limits", {"irrigate_max": 5.0, "drain_max": 3.0})
-
-    files = list_csvs(data_glob)
-    X, Y = load_dataset(files, cfg)
+    ooc = {**OUT_OF_CORE_DEFAULTS, **(tr.get("out_of_core") or {})}
+    nf, na = len(cfg["features"]), len(cfg["actions"])
+
+    with profiling.span("count_rows") as sp:
+        units = episode_units(files)
+        bounds = np.array([b for _, b in units], dtype=np.int64)
+        sp.rows = int(bounds.sum())
+    is_val = split_episodes(len(units), tr)
+    size = {"train": int(bounds[~is_val].sum()), "val": int(bounds[is_val].sum())}
+
+    prefix = None
+    if bounds.sum() >= int(ooc["memmap_min_rows"]):
+        split = {k: tr.get(k) for k in ("val_split", "shuffle", "seed")}
+        key = hashlib.sha1((feature_cache_key(files, cfg) + json.dumps(split, sort_keys=True)).encode()).hexdigest()
+        prefix = os.path.join(ooc["dir"], f"arrays_{key[:24]}")
+        if os.path.isfile(prefix + ".json"):
+            with open(prefix + ".json", "r", encoding="utf-8") as f:
+                n = json.load(f)["rows"]
+            print(f"[info] Reusing memory-mapped arrays {prefix}_*.npy")
+            return tuple(np.load(f"{prefix}_{a}.npy", mmap_mode="r")[:n[side]]
+                         for a, side in (("Xtr", "train"), ("Xva", "val"), ("Ytr", "train"), ("Yva", "val")))
+        os.makedirs(ooc["dir"], exist_ok=True)
+    paths = {a: None if prefix is None else f"{prefix}_{a}" for a in ("Xtr", "Xva", "Ytr", "Yva")}
+    X = {"train": _alloc((size["train"], nf), paths["Xtr"]), "val": _alloc((size["val"], nf), paths["Xva"])}
+    Y = {"train": _alloc((size["train"], na), paths["Ytr"]), "val": _alloc((size["val"], na), paths["Yva"])}
+    pos = {"train": 0, "val": 0}
+
+    def put(Xc: np.ndarray, Yc: np.ndarray, unit: np.ndarray) -> None:
+        # rows arrive grouped by episode (`unit` = index into units per row)
+        val = is_val[unit]
+        for side, m in (("train", ~val), ("val", val)):
+            k = int(m.sum())
+            X[side][pos[side]:pos[side] + k] = Xc[m]
+            Y[side][pos[side]:pos[side] + k] = Yc[m]
+            pos[side] += k
+
+    index = {name: i for i, (name, _) in enumerate(units)}
+    csvs = [f for f in files if not is_store(f)]
+    step = max(1, int(ooc["chunk_files"]))
+    chunks = [csvs[i:i + step] for i in range(0, len(csvs), step)]
+    workers = min(int(tr.get("load_workers", 0)) or os.cpu_count() or 1, max(1, len(chunks)))
+    with profiling.span("stream_episodes", rows=int(bounds.sum())):
+        ex = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        try:
+            # a window of chunks in flight at a time bounds the parsed-but-unwritten arrays
+            for w in range(0, len(chunks), 2 * workers):
+                window = chunks[w:w + 2 * workers]
+                results = ex.map(partial(_csv_chunk_arrays, cfg=cfg), window) if ex \
+                    else (_csv_chunk_arrays(c, cfg) for c in window)
+                for chunk, (Xc, Yc, ep) in zip(window, results):
+                    put(Xc, Yc, np.array([index[p] for p in chunk])[ep])
+        finally:
+            if ex:
+                ex.shutdown()
+        for f in files:
+            if is_store(f):
+                for names, df in iter_store_segments(f, raw_columns(cfg)):
+                    Xc, Yc, ep = feature_arrays(normalize_raw(df), cfg)
+                    put(Xc, Yc, np.array([index[f"{f}::{p}"] for p in names])[ep])
+
+    if prefix is None:
+        return X["train"][:pos["train"]], X["val"][:pos["val"]], Y["train"][:pos["train"]], Y["val"][:pos["val"]]
+    for a, arr in (("Xtr", X["train"]), ("Xva", X["val"]), ("Ytr", Y["train"]), ("Yva", Y["val"])):
+        arr.flush()
+        os.replace(f"{prefix}_{a}.tmp.npy", f"{prefix}_{a}.npy")
+    with open(prefix + ".json", "w", encoding="utf-8") as f:
+        json.dump({"rows": pos, "episodes": len(units), "val_episodes": int(is_val.sum())}, f)
+    return tuple(np.load(f"{prefix}_{a}.npy", mmap_mode="r")[:pos[side]]
+                 for a, side in (("Xtr", "train"), ("Xva", "val"), ("Ytr", "train"), ("Yva", "val")))
+
+# -------------------------- model backends --------------------------
+
+def _forest_kwargs(mcfg: Dict[str, Any]) -> Dict[str, Any]:
+    return dict(
+        n_estimators=int(mcfg.get("n_estimators", 300)),
+        max_depth=None if mcfg.get("max_depth") is None else int(mcfg["max_depth"]),
+        random_state=int(mcfg.get("random_state", 42)),
+        n_jobs=int(mcfg.get("n_jobs", -1)),
+    )
 
-    X_train, X_val, Y_train, Y_val = train_test_split(
+def _random_forest(mcfg: Dict[str, Any]):
+    # one forest predicting all actions (sklearn forests are natively multi-output)
+    return RandomForestRegressor(**_forest_kwargs(mcfg))
+
+def _random_forest_per_action(mcfg: Dict[str, Any]):
+    # legacy layout: one independent forest per action
+    kw = _forest_kwargs(mcfg)
+    n_jobs = kw.pop("n_jobs")
+    return MultiOutputRegressor(RandomForestRegressor(**kw), n_jobs=n_jobs)
+
+def _extra_trees(mcfg: Dict[str, Any]):
+    return ExtraTreesRegressor(**_forest_kwargs(mcfg))
+
+def _hist_gb(mcfg: Dict[str, Any]):
+    base = HistGradientBoostingRegressor(
+        max_iter=int(mcfg.get("max_iter", mcfg.get("n_estimators", 300))),
+        max_depth=None if mcfg.get("max_depth") is None else int(mcfg["max_depth"]),
+        learning_rate=float(mcfg.get("learning_rate", 0.1)),
+        random_state=int(mcfg.get("random_state", 42)),
+    )
+    return MultiOutputRegressor(base, n_jobs=int(mcfg.get("n_jobs", -1)))
+
+# model.type in config.yaml -> estimator factory
+MODEL_BACKENDS: Dict[str, Callable[[Dict[str, Any]], Any]] = {
+    "random_forest": _random_forest,
+    "random_forest_per_action": _random_forest_per_action,
+    "extra_trees": _extra_trees,
+    "hist_gb": _hist_gb,
+}
+
+def build_model(mcfg: Dict[str, Any]):
+    kind = mcfg.get("type", "random_forest")
+    if kind not in MODEL_BACKENDS:
+        raise ValueError(f"Unknown model.type {kind!r}; expected one of {sorted(MODEL_BACKENDS)}")
+    return MODEL_BACKENDS[kind](mcfg)
+
+def set_n_jobs(model, n_jobs: int):
+    """Set n_jobs on the model and any wrapped estimators that accept it."""
+    params = model.get_params()
+    model.set_params(**{k: n_jobs for k in params if k == "n_jobs" or k.endswith("__n_jobs")})
+    for est in getattr(model, "estimators_", []):
+        if hasattr(est, "n_jobs"):
+            est.n_jobs = n_jobs
+    return model
+
+# -------------------------- fit / evaluate --------------------------
+
+def split_dataset(X: pd.DataFrame, Y: pd.DataFrame, tr: Dict[str, Any]):
+    return train_test_split(
         X.values, Y.values, test_size=float(tr["val_split"]),
         shuffle=bool(tr.get("shuffle", True)), random_state=int(tr.get("seed", 42))
     )
 
-    base = RandomForestRegressor(
-        n_estimators=int(cfg["model"]["n_estimators"]),
-        max_depth=int(cfg["model"]["max_depth"]),
-        random_state=int(cfg["model"]["random_state"])
-    )
-    model = MultiOutputRegressor(base)
-    model.fit(X_train, Y_train)
+def mae_by_action(Y: np.ndarray, Y_hat: np.ndarray, actions: List[str]) -> Dict[str, float]:
+    return {a: float(mean_absolute_error(Y[:, j], Y_hat[:, j])) for j, a in enumerate(actions)}
+
+def fit_backend(cfg: Dict[str, Any], kind: str, X_train: np.ndarray, Y_train: np.ndarray,
+                X_val: np.ndarray, Y_val: np.ndarray) -> Tuple[Any, Dict[str, Any]]:
+    """Fit one backend; report fit time, predict throughput and train/val MAE."""
+    actions = list(cfg["actions"])
+    tr = cfg["train"]
+    limits = tr.get("limits", {"irrigate_max": 5.0, "drain_max": 3.0})
+
+    model = build_model({**cfg["model"], "type": kind})
+    t0 = time.perf_counter()
+    with profiling.span(f"fit[{kind}]", rows=len(X_train)):
+        model.fit(X_train, Y_train)
+    fit_s = time.perf_counter() - t0
+    # saved models predict single-threaded: BCPolicy calls are tiny, and the
+    # exporters parallelise with --workers instead
+    set_n_jobs(model, 1)
 
     # Evaluate
-    Y_tr_hat = model.predict(X_train)
-    Y_va_hat = model.predict(X_val)
+    with profiling.span("predict_train", rows=len(X_train)):
+        Y_tr_hat = model.predict(X_train)
+    t0 = time.perf_counter()
+    with profiling.span("predict_val", rows=len(X_val)):
+        Y_va_hat = model.predict(X_val)
+    predict_s = time.perf_counter() - t0
 
     if bool(tr.get("clip_actions", True)):
         Y_tr_hat = safe_clip_actions(Y_tr_hat, limits, actions)
         Y_va_hat = safe_clip_actions(Y_va_hat, limits, actions)
 
-    train_mae = {a: float(mean_absolute_error(Y_train[:, j], Y_tr_hat[:, j]))
-                 for j, a in enumerate(actions)}
-    val_mae = {a: float(mean_absolute_error(Y_val[:, j], Y_va_hat[:, j]))
-               for j, a in enumerate(actions)}
+    report = {
+        "backend": kind,
+        "fit_s": round(fit_s, 3),
+        "predict_rows_per_s": round(len(X_val) / max(predict_s, 1e-9), 1),
+        "train_mae": mae_by_action(Y_train, Y_tr_hat, actions),
+        "val_mae": mae_by_action(Y_val, Y_va_hat, actions),
+    }
+    return model, report
+
+def out_of_core(cfg: Dict[str, Any]) -> bool:
+    return bool((cfg["train"].get("out_of_core") or {}).get("enabled"))
+
+def load_split(files: List[str], cfg: Dict[str, Any]):
+    """
+    (X_train, X_val, Y_train, Y_val): load_dataset + a row-level split, or with
+    train.out_of_core.enabled the streamed float32 arrays split by episode.
+    """
+    if out_of_core(cfg):
+        with profiling.span("load_arrays") as sp:
+            parts = load_arrays(files, cfg)
+            sp.rows = len(parts[0]) + len(parts[1])
+        return parts
+    with profiling.span("load_dataset") as sp:
+        X, Y = load_dataset(files, cfg)
+        sp.rows = len(X)
+    with profiling.span("split", rows=len(X)):
+        return split_dataset(X, Y, cfg["train"])
+
+def compare_backends(cfg: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Fit every registered backend on the same split (nothing is saved)."""
+    X_train, X_val, Y_train, Y_val = load_split(list_csvs(cfg["data_glob"]), cfg)
+    return [fit_backend(cfg, kind, X_train, Y_train, X_val, Y_val)[1] for kind in MODEL_BACKENDS]
+
+# -------------------------- forest size search --------------------------
+
+def _predict_latency_ms(model, X: np.ndarray, repeats: int) -> float:
+    """Median wall time of one single-row predict call."""
+    x = X[:1]
+    model.predict(x)  # warm-up
+    times = []
+    for _ in range(max(1, repeats)):
+        t0 = time.perf_counter()
+        model.predict(x)
+        times.append(time.perf_counter() - t0)
+    return float(np.median(times)) * 1e3
+
+def search_forest_size(cfg: Dict[str, Any], X_train: np.ndarray, Y_train: np.ndarray,
+                       X_val: np.ndarray, Y_val: np.ndarray) -> Dict[str, Any]:
+    """
+    Grow the configured forest tree by tree (warm_start) for each candidate depth,
+    recording val MAE per action and single-row predict latency at each size.
+    Picks the smallest (n_estimators, max_depth) whose val MAE for every action is
+    within `size_search.mae_tolerance` (relative) of the configured full model.
+    """
+    mcfg = cfg["model"]
+    kind = mcfg.get("type", "random_forest")
+    if kind not in ("random_forest", "extra_trees"):
+        raise ValueError(f"Size search needs a native forest backend, not {kind!r}")
+    scfg = cfg.get("size_search", {})
+    actions = list(cfg["actions"])
+    tr = cfg["train"]
+    limits = tr.get("limits", {"irrigate_max": 5.0, "drain_max": 3.0})
+    # max_depth None = unlimited (see build_model); it sorts as the deepest option
+    as_depth = lambda d: None if d is None else int(d)
+    depth_key = lambda d: float("inf") if d is None else d
+    full_n, full_d = int(mcfg["n_estimators"]), as_depth(mcfg.get("max_depth"))
+    steps = sorted({int(n) for n in scfg.get("n_estimators", [10, 25, 50, 100, 200])} | {full_n})
+    depths = sorted({as_depth(d) for d in scfg.get("max_depths", [6, 8, 10])} | {full_d}, key=depth_key)
+    tol = float(scfg.get("mae_tolerance", 0.05))
+    repeats = int(scfg.get("latency_repeats", 20))
+    fit_jobs = int(mcfg.get("n_jobs", -1))
+
+    curve = []
+    for d in depths:
+        model = build_model({**mcfg, "max_depth": d, "n_estimators": steps[0]})
+        model.set_params(warm_start=True)
+        for n in steps:
+            model.set_params(n_estimators=n, n_jobs=fit_jobs)
+            model.fit(X_train, Y_train)   # adds only the new trees
+            model.set_params(n_jobs=1)
+            Y_hat = model.predict(X_val)
+            if bool(tr.get("clip_actions", True)):
+                Y_hat = safe_clip_actions(Y_hat, limits, actions)
+            curve.append({
+                "n_estimators": n,
+                "max_depth": d,
+                "val_mae": mae_by_action(Y_val, Y_hat, actions),
+                "latency_ms": round(_predict_latency_ms(model, X_val, repeats), 4),
+            })
+
+    ref = next(p for p in curve if p["n_estimators"] == full_n and p["max_depth"] == full_d)
+    ok = [p for p in curve
+          if all(p["val_mae"][a] <= ref["val_mae"][a] * (1.0 + tol) + 1e-12 for a in actions)]
+    chosen = min(ok, key=lambda p: (p["n_estimators"], depth_key(p["max_depth"])))
+    return {"mae_tolerance": tol, "reference": ref, "chosen": chosen, "curve": curve}
+
+def train(cfg: Dict[str, Any], size_search: bool = False) -> TrainArtifacts:
+    data_glob = cfg["data_glob"]
+    model_path = cfg["bc_model_path"]
+    meta_path = cfg["meta_file"]
+    features = list(cfg["features"])
+    actions = list(cfg["actions"])
+    tr = cfg["train"]
+    limits = tr.get("limits", {"irrigate_max": 5.0, "drain_max": 3.0})
+
+    files = list_csvs(data_glob)
+    X_train, X_val, Y_train, Y_val = load_split(files, cfg)
+
+    search = None
+    if size_search:
+        with profiling.span("size_search", rows=len(X_train)):
+            search = search_forest_size(cfg, X_train, Y_train, X_val, Y_val)
+        chosen = search["chosen"]
+        cfg = {**cfg, "model": {**cfg["model"], "n_estimators": chosen["n_estimators"],
+                                "max_depth": chosen["max_depth"]}}
+
+    kind = cfg["model"].get("type", "random_forest")
+    model, report = fit_backend(cfg, kind, X_train, Y_train, X_val, Y_val)
+    train_mae, val_mae = report["train_mae"], report["val_mae"]
 
     # Ensure dirs
     os.makedirs(os.path.dirname(model_path), exist_ok=True)
 
-    # Save model + meta
-    dump(model, model_path)
+    # Save model + meta (uncompressed, so BCPolicy/exporter workers can mmap it)
+    with profiling.span("dump_model"):
+        dump(model, model_path, compress=0)
     meta = {
         "features": features,
         "actions": actions,
+        "backend": kind,
+        "timing": {"fit_s": report["fit_s"], "predict_rows_per_s": report["predict_rows_per_s"]},
+        "split": {"unit": "episode" if out_of_core(cfg) else "row",
+                  "train_rows": int(len(X_train)), "val_rows": int(len(X_val))},
         "train_mae": train_mae,
         "val_mae": val_mae,
         "limits": limits,
@@ -189,9 +621,16 @@ def train(cfg: Dict[str, Any]) -> TrainArtifacts:
         "flood_stages": cfg["flood_stages"],
         # Used by exporter to derive target_mm and north/south_mm from def*
         "target_by_stage": cfg.get("target_by_stage", [15, 35, 25, 0, 25, 25, 25, 0]),
+        "n_estimators": int(cfg["model"].get("n_estimators", 0)),
+        "max_depth": cfg["model"].get("max_depth"),
     }
+    if search is not None:
+        meta["size_search"] = search
     with open(meta_path, "w", encoding="utf-8") as f:
         json.dump(meta, f, indent=2)
+    # pre-compiled flat arrays next to the meta for fast BCPolicy(engine="compiled") starts
+    with profiling.span("compile_cache"):
+        write_compiled_cache(model, model_path, meta_path, X_check=np.asarray(X_val[:2000], dtype=float))
 
     return TrainArtifacts(
         model_path=model_path,
@@ -200,24 +639,69 @@ def train(cfg: Dict[str, Any]) -> TrainArtifacts:
         action_names=actions,
         train_mae=train_mae,
         val_mae=val_mae,
-        n_rows=int(X.shape[0]),
-        n_files=len(files),
+        n_rows=int(len(X_train) + len(X_val)),
+        n_episodes=count_episodes(files),
+        backend=kind,
+        fit_s=report["fit_s"],
+        predict_rows_per_s=report["predict_rows_per_s"],
     )
 
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--config", "-c", default="config.yaml")
+    ap.add_argument("--backend", choices=sorted(MODEL_BACKENDS), default=None,
+                    help="Override model.type from the config.")
+    ap.add_argument("--size_search", action="store_true",
+                    help="Pick the smallest forest within size_search.mae_tolerance of the full model.")
+    ap.add_argument("--compare", action="store_true",
+                    help="Fit every backend on the same split and print a comparison (saves nothing).")
+    ap.add_argument("--profile", action="store_true",
+                    help=f"Time/memory per stage -> <meta>.profile.json (or set {profiling.PROFILE_ENV}=1).")
+    ap.add_argument("--out_of_core", action="store_true",
+                    help="Stream episodes into float32 (memory-mapped when large) arrays with an "
+                         "episode-level train/val split (train.out_of_core).")
     args = ap.parse_args()
 
     cfg = read_config(args.config)
-    arts = train(cfg)
+    if args.backend:
+        cfg["model"]["type"] = args.backend
+    if args.out_of_core:
+        cfg["train"]["out_of_core"] = {**(cfg["train"].get("out_of_core") or {}), "enabled": True}
+    profiling.start("train_bc --compare" if args.compare else "train_bc", args.profile)
+    profile_path = os.path.splitext(cfg["meta_file"])[0] + ".profile.json"
+
+    if args.compare:
+        reports = compare_backends(cfg)
+        rows = [{"backend": r["backend"], "fit_s": r["fit_s"],
+                 "predict_rows_per_s": r["predict_rows_per_s"],
+                 "val_mae_mean": round(float(np.mean(list(r["val_mae"].values()))), 4),
+                 **{f"val_mae[{a}]": round(v, 4) for a, v in r["val_mae"].items()}}
+                for r in reports]
+        print(pd.DataFrame(rows).to_string(index=False))
+        profiling.finish(profile_path)
+        return
+
+    arts = train(cfg, size_search=args.size_search)
 
     print("=== Training complete ===")
-    print(f"Rows: {arts.n_rows}  Files: {arts.n_files}")
+    print(f"Rows: {arts.n_rows}  Episodes: {arts.n_episodes}")
+    print(f"Backend: {arts.backend}  fit {arts.fit_s:.2f}s  predict {arts.predict_rows_per_s:,.0f} rows/s")
+    if args.size_search:
+        with open(arts.meta_path, "r", encoding="utf-8") as f:
+            search = json.load(f)["size_search"]
+        curve = pd.DataFrame([{"n_estimators": p["n_estimators"], "max_depth": p["max_depth"],
+                               "latency_ms": p["latency_ms"],
+                               "val_mae_mean": round(float(np.mean(list(p["val_mae"].values()))), 4)}
+                              for p in search["curve"]])
+        print(curve.to_string(index=False))
+        c = search["chosen"]
+        print(f"Chosen size: n_estimators={c['n_estimators']} max_depth={c['max_depth']} "
+              f"(tolerance {search['mae_tolerance']:.0%} of full-model val MAE)")
     print("Train MAE:", arts.train_mae)
     print(" Val  MAE:", arts.val_mae)
     print(f"Saved model -> {arts.model_path}")
     print(f"Saved meta  -> {arts.meta_path}")
+    profiling.finish(profile_path)
 
 if __name__ == "__main__":
     main()